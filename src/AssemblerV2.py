@@ -1,36 +1,87 @@
-from typing import List, Dict, Type
-from Dbg import dbg, dbgassert
-from CPU import Register, Symbol, Instructions, Instruction, Operand
-from Memory import Memory, Segment
-from SymbolMap import SymbolMap
+from typing import List, Dict, Type, Tuple, Iterator
+from Dbg import dbg, dbgassert, get_logger
+from CPU import Symbol, Instructions, Operand
+from Memory import Memory, Segment, ADDRESS_SPACE
+from SymbolMap import SymbolMap, Relocation
+from Lexer import Token, TokenKind, lex_line, mask_strings, DIRECTIVES
+from Optimizer import optimize
+from Image import write_image, SYMBOL_EXTERN, SYMBOL_GLOBAL
 from enum import Enum
-import os
+import os, json, hashlib
+log = get_logger("assembler")
+
+# operand kinds that hold a symbol and need a relocation
+SYMBOL_OPERANDS :Tuple[Operand, ...] = (Operand.VALUE, Operand.ADDRESS, Operand.SYMBOL)
+# opcode -> (number of arguments, allowed operand kinds of each argument as ints)
+_encodings :Tuple[Tuple[int, Tuple[int, ...]], ...] = tuple((tInst.value.nargs, tuple(t.value for t in tInst.value.operand_types)) for tInst in Instructions)
+# bump the revision when the assembler encodes programs differently, the instruction set is part of the version
+# so adding or moving an opcode changes it too. Caches of assembled programs are keyed by it
+ASSEMBLER_REVISION :int = 1
+ASSEMBLER_VERSION :str = f"{ASSEMBLER_REVISION}-" + hashlib.sha256(repr([(tInst.name, encoding) for tInst, encoding in zip(Instructions, _encodings)]).encode()).hexdigest()[:12]
+
 class BlockType(Enum):
-    CODE, DATA, LABEL = range(0,3)
+    CODE, DATA, LABEL, LINKAGE = range(0,4)
+
+# first word of the lines of a LINKAGE block : extern names symbols of other modules, global exports symbols of
+# this one, see Linker.py
+LINKAGE_KEYWORDS :Tuple[str, ...] = ("extern", "global")
+
+class Block(list):
+    """The lines of a block, lines and columns hold the source position (starting at 1) of each of them
+    """
+    def __init__(self, lines :List[str] = (), numbers :List[int] = (), columns :List[int] = ()) -> None:
+        super().__init__(lines)
+        self.lines :List[int] = list(numbers)
+        self.columns :List[int] = list(columns)
+
+    @property
+    def line(self) -> int:
+        """Source line of the first line of the block
+        """
+        return self.lines[0] if self.lines else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Block(super().__getitem__(index), self.lines[index], self.columns[index])
+        return super().__getitem__(index)
 
 class BlockParser:
     """Parse and split a file into blocks
+
+    In streaming mode the file is not loaded, every iteration over the parser reads it again
+    and yields the blocks one by one, so only the current block is in memory.
     """
-    def __init__(self, filein):
-        self.blocks :List[List[str]] = []
+    def __init__(self, filein, streaming :bool = False):
+        self.blocks :List[Block] = []
         self.filein :str = filein
         self.filedata :List[str] = []
-        
-        if os.path.isfile(filein):
+        self.is_file :bool = os.path.isfile(filein)
+        self.streaming :bool = streaming and self.is_file
+
+        if self.streaming:
+            return
+        if self.is_file:
             self.load_file()
         else:
             self.filedata = self.filein.splitlines()
         self.parse_blocks()
-        
-    def strip_comments(self, block :List[str]):
-        ret = []
+
+    def __iter__(self) -> Iterator[Block]:
+        if self.streaming:
+            return self.iter_blocks()
+        return iter(self.blocks)
+
+    def strip_comments(self, block :Block) -> Block:
+        ret = Block()
         is_comment = False
-        for i, line in enumerate(block):
-            if line[0] ==  ";" and line[-1] == ";": # full line comment
+        for line, number, column in zip(block, block.lines, block.columns):
+            # a ; inside a string literal is not a comment
+            code :str = mask_strings(line) if '"' in line else line
+            if code[0] ==  ";" and code[-1] == ";": # full line comment
                 continue
-            elif line.count(";") == 2:
-                line = line.split(";", 1)[0].strip()
-            elif line.count(";") == 1:
+            elif code.count(";") == 2:
+                line = line[:code.index(";")].strip()
+            elif code.count(";") == 1:
                 if not is_comment:
                     is_comment = True
                 else:
@@ -38,10 +89,12 @@ class BlockParser:
                 continue
             elif is_comment:
                 continue
-            
+
             ret.append(line)
+            ret.lines.append(number)
+            ret.columns.append(column)
         return ret
-    
+
     def load_file(self):
         try:
             with open(self.filein, 'r') as file:
@@ -50,245 +103,415 @@ class BlockParser:
         except FileNotFoundError:
             print(f"The file {self.filein} is not in scope.")
             exit()
-        
-    
-    def parse_blocks(self):
+
+    def read_lines(self) -> Iterator[str]:
+        if not self.streaming:
+            yield from self.filedata
+            return
         try:
-            blocks = []
-            current_block = []
-
-            for line in self.filedata:
-                if not line.strip():
-                    if current_block:
-                        blocks.append(self.strip_comments(current_block))
-                        current_block = []
-                else:
-                    current_block.append(line.strip())
+            with open(self.filein, 'r') as file:
+                yield from file
+        except FileNotFoundError:
+            print(f"The file {self.filein} is not in scope.")
+            exit()
 
-            # Add the last block if there is one
-            if current_block:
-                blocks.append(self.strip_comments(current_block))
+    def iter_blocks(self) -> Iterator[Block]:
+        """Split the source into blocks as it is read, blocks are separated by empty lines
+        """
+        current_block = Block()
+        for number, raw in enumerate(self.read_lines(), 1):
+            line = raw.strip()
+            if not line:
+                if current_block:
+                    block = self.strip_comments(current_block)
+                    if block:
+                        yield block
+                    current_block = Block()
+            else:
+                current_block.append(line)
+                current_block.lines.append(number)
+                current_block.columns.append(len(raw) - len(raw.lstrip()) + 1)
+
+        # Add the last block if there is one
+        if current_block:
+            block = self.strip_comments(current_block)
+            if block:
+                yield block
 
-            self.blocks = blocks
+    def parse_blocks(self):
+        try:
+            self.blocks = list(self.iter_blocks())
         except:
-            print("Block parser failed")            
-        
-            
+            print("Block parser failed")
+
+
+class BlockCache:
+    """Persistent cache of assembled blocks, keyed by the hash of their content
+
+    Code blocks keep their opcodes, their relocations (by symbol name) and the type of every symbol
+    they use, a block is only reused if none of those symbols changed. Data blocks keep the symbols they declare.
+    """
+    def __init__(self, folder :str) -> None:
+        self.path :str = os.path.join(folder, "blocks.json")
+        self.entries :Dict[str, Dict] = {}
+        # only the entries used by the last assembly are written back, the cache never grows past one program
+        self.used :Dict[str, Dict] = {}
+        self.hits :int = 0
+        self.misses :int = 0
+        self.dirty :bool = False
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r") as file:
+                    self.entries = json.load(file)
+            except (OSError, ValueError):
+                log.warning("block cache %s is unreadable, starting from scratch", self.path)
+
+    @staticmethod
+    def key(kind :BlockType, block :List[str], optimized :bool = False) -> str:
+        # the same block is encoded differently with the optimizer or by another assembler version
+        header :str = f"{ASSEMBLER_VERSION}-{kind.name}" + ("-O" if optimized else "")
+        return hashlib.sha256((header + "\n" + "\n".join(block)).encode()).hexdigest()
+
+    def get(self, key :str) -> Dict | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used[key] = entry
+        return entry
+
+    def put(self, key :str, entry :Dict):
+        self.entries[key] = entry
+        self.used[key] = entry
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty and len(self.used) == len(self.entries):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary :str = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            # dumps uses the C encoder, dump does not
+            file.write(json.dumps(self.used))
+        os.replace(temporary, self.path)
+
 class AssemblerV2:
-    def __init__(self, file) -> None:
-        self.parser :BlockParser = BlockParser(file)
-        self.blocktypes :Dict[int, BlockType] = {}
-        self.memory :Memory = Memory()
+    def __init__(self, file, cache_dir :str | None = None, streaming :bool = False, optimize :bool = False, paged :bool = False) -> None:
+        """Assemble a file or a string
+
+        Args:
+            file: path of the source file, or the source itself
+            cache_dir (str, optional): folder of the persistent block cache, blocks that did not change are not encoded again
+            streaming (bool, optional): read the file once per pass instead of keeping its blocks in memory, for very large sources
+            optimize (bool, optional): run the peephole optimizer on the code blocks, see Optimizer.py
+            paged (bool, optional): assemble into a paged memory covering the whole 32 bits address space of every segment
+        """
+        self.parser :BlockParser = BlockParser(file, streaming)
+        self.block_cache :BlockCache | None = BlockCache(cache_dir) if cache_dir else None
+        self.optimize :bool = optimize
+        # code location of every instruction -> source line it comes from (0 for strings without lines)
+        self.line_map :Dict[int, int] = {}
+        self.memory :Memory = Memory(ADDRESS_SPACE, ADDRESS_SPACE, ADDRESS_SPACE, paged=True) if paged else Memory()
         self.symbol_map :SymbolMap = SymbolMap(self.memory)
+        # code location -> relocation, kept after linking so tools can find back symbol names
+        self.relocations :Dict[int, Relocation] = {}
+        # symbols declared extern, defined by another module and resolved by the Linker, and symbols declared global
+        self.externs :Dict[str, Symbol] = {}
+        self.exports :List[str] = []
+        # errors reported without stopping the assembly, a program with errors must not be saved or run
+        self.errors :List[str] = []
         self.process_blocks()
     
-    def tokenize_line(self, line):
-        return line.strip().replace("\t", ' ').split(' ')
-    
-    def is_symbol_declaration(self, token :str):
-        return ":" in token
-    
-    def is_instruction(self, token :str):
-        for tInst in Instructions:
-            if tInst.name == token:
-                return True
-        return False
-    
-    def guess_block_types(self):
-        for i, block in enumerate(self.parser.blocks):
-            #dbg(block)
-            self.tokenize_line(block[0])[0]
-            if self.is_symbol_declaration(self.tokenize_line(block[0])[0]):
-                if len(self.tokenize_line(block[0])) > 1:
-                    self.blocktypes[i] = BlockType.DATA
-                else:
-                    self.blocktypes[i] = BlockType.LABEL
-                    
-            elif self.is_instruction(self.tokenize_line(block[0])[0]):
-                self.blocktypes[i] = BlockType.CODE
-                
+    def tokenize(self, block :List[str], i :int) -> List[Token]:
+        """Lex the line i of a block, with its source position when the block has one
+        """
+        if isinstance(block, Block):
+            return lex_line(block[i], block.lines[i], block.columns[i])
+        return lex_line(block[i])
+
+    def block_type(self, block :Block) -> BlockType:
+        tokens = self.tokenize(block, 0)
+        if tokens[0].kind == TokenKind.LABEL:
+            if len(tokens) > 1:
+                return BlockType.DATA
             else:
-                print(f"Unknown block type {i}")
-                exit()
-    
-    def symbol_type_to_symbol(self, typ :str):
-        if typ == "db":
-            return Symbol.BYTE
-        elif typ == "ds":
-            return Symbol.SHORT
-        elif typ == "di":
-            return Symbol.INTEGER
-        elif typ == "dd":
-            return Symbol.DOUBLE
-        elif typ == "dc":
-            return Symbol.STRING
+                return BlockType.LABEL
+
+        elif tokens[0].kind == TokenKind.MNEMONIC:
+            return BlockType.CODE
+
+        elif tokens[0].kind == TokenKind.NAME and tokens[0].value in LINKAGE_KEYWORDS:
+            return BlockType.LINKAGE
+
         else:
-            raise NotImplementedError()
-    
-    def is_symbol_type(self, typ :str):
-        return typ in ["db", "di", "dd", "dc", "ds"]
-    
-    def process_data_block(self, block :str):
-        for i, line in enumerate(block):
-           tokens = self.tokenize_line(line)
-           sym_name = tokens[0]
-           if self.is_symbol_declaration(sym_name):
-            try:
-                typ = tokens[1]
-                if self.is_symbol_type(typ):
-                    sym :Symbol = self.symbol_type_to_symbol(typ)
-                    value :str = tokens[2]
-                    if value.startswith("0x"):
-                        value = int(value, 16)
-                    self.symbol_map.add_symbol(sym, sym_name[0:-1], int(value))
-            except IndexError:
-                print(f"Symbol {sym_name} was declared incorrectly")
-                
+            print(f"Unknown block type at line {block.line}")
+            exit()
+
+    def process_data_block(self, block :List[str]):
+        if self.block_cache is None:
+            declarations = self.parse_data_block(block)
+        else:
+            key :str = BlockCache.key(BlockType.DATA, block)
+            entry = self.block_cache.get(key)
+            if entry is None:
+                entry = {"symbols": self.parse_data_block(block)}
+                self.block_cache.put(key, entry)
+            declarations = entry["symbols"]
+        for typ, name, value in declarations:
+            self.symbol_map.add_symbol(Symbol(typ), name, value)
+
+    def parse_data_block(self, block :List[str]) -> List[List]:
+        """Get the symbols declared by a data block as [symbol type, name, value]
+        """
+        declarations = []
+        for i in range(len(block)):
+            tokens = self.tokenize(block, i)
+            if tokens[0].kind == TokenKind.LABEL:
+                # dc takes a string literal, the other directives an integer
+                kind :TokenKind = TokenKind.STRING if len(tokens) > 1 and tokens[1].value == Symbol.STRING else TokenKind.INTEGER
+                if len(tokens) < 3 or tokens[1].kind != TokenKind.DIRECTIVE or tokens[2].kind != kind or tokens[2].value is None:
+                    print(f"Symbol {tokens[0].value} was declared incorrectly at {tokens[0].line}:{tokens[0].col}")
+                    continue
+                declarations.append([tokens[1].value.value, tokens[0].value, tokens[2].value])
+        return declarations
+
+    def process_linkage_block(self, block :List[str]):
+        """Declare the extern symbols of a LINKAGE block and record its global ones
+
+        extern name         a label of another module
+        extern name di      a data symbol of another module (any data directive)
+        global name, ...    symbols of this module other modules can use
+        """
+        for i in range(len(block)):
+            tokens = self.tokenize(block, i)
+            if tokens[0].kind != TokenKind.NAME or tokens[0].value not in LINKAGE_KEYWORDS or len(tokens) < 2:
+                print(f"Expected extern or global followed by names at {tokens[0].line}:{tokens[0].col}")
+                exit()
+            if tokens[0].value == "global":
+                self.exports.extend(token.text for token in tokens[1:])
+                continue
+            typ :Symbol = Symbol.LABEL
+            if len(tokens) == 3 and tokens[2].text in DIRECTIVES:
+                typ = DIRECTIVES[tokens[2].text]
+            elif len(tokens) != 2 or tokens[1].kind != TokenKind.NAME:
+                print(f"Expected extern name or extern name directive at {tokens[0].line}:{tokens[0].col}")
+                exit()
+            self.externs[tokens[1].value] = typ
+            # no location until the Linker finds the module defining it
+            self.symbol_map._declare(typ, tokens[1].value, -1, 0)
+
     def process_symbol_blocks(self):
-        for i, block in enumerate(self.parser.blocks):
-            if self.blocktypes[i] == BlockType.LABEL:
-                self.symbol_map.add_symbol(Symbol.LABEL, self.tokenize_line(block[0])[0][:-1], -1)
-            elif self.blocktypes[i] == BlockType.DATA:
+        # only the symbols are kept, the code blocks are read again by the second pass
+        for block in self.parser:
+            typ :BlockType = self.block_type(block)
+            if typ == BlockType.LABEL:
+                self.symbol_map.add_symbol(Symbol.LABEL, self.tokenize(block, 0)[0].value, -1)
+            elif typ == BlockType.DATA:
                 self.process_data_block(block)
+            elif typ == BlockType.LINKAGE:
+                self.process_linkage_block(block)
+        for name in self.exports:
+            if not self.symbol_map.has_symbol(name) or name in self.externs:
+                print(f"Global symbol {name} is not defined by this module")
+                exit()
 
-    def remove_comma(self, tokens :List[str]) -> List[str]:
-        ret = []
-        for token in tokens:
-            if token== ",":
-                pass
-            elif token[-1] == ",": # a single comma can trigger this too , so we supress it first
-                ret.append(token[:-1])
-            else:
-                ret.append(token)
-        return ret
-    
-    def token2instruction(self, token :str) -> Instruction:
-        for tType in Instructions:
-            if tType.name == token:
-                return tType.value
-        raise IndexError()
-    
-    def instruction2name(self, inst :Instruction) -> str:
-        for tType in Instructions:
-            if tType.value == inst:
-                return tType.name
-        raise IndexError()
-    
-    def instruction2opcode(self, inst :str) -> int:
-        idx :int = 0
-        for tType in Instructions:
-            if tType.name == inst:
-                return idx
-            idx += 1
-    
-    def is_register(self, token :str):
-        for tType in Register:
-            if tType.name == token:
-                return True
-        return False
-    
-    def is_value(self, token :str):
-        return token[0] == "[" and token[-1] == "]"
-    
     def is_symbol(self, token :str):
-        return token in self.symbol_map.symbol_table
-    
-    def token2symboltype(self, token :str):
-        return self.symbol_map.symbol_type[token]
-    
-    def token2type(self, token :str) -> None | Operand:
-        if self.is_register(token):
-            return Operand.REGISTER
-        elif self.is_symbol(token):
-            if self.is_value(token):
+        return self.symbol_map.has_symbol(token)
+
+    def token2type(self, token :Token) -> None | Operand:
+        match token.kind:
+            case TokenKind.REGISTER:
+                return Operand.REGISTER
+            case TokenKind.INTEGER:
+                return Operand.INTEGER
+            case TokenKind.VALUE if self.is_symbol(token.value):
                 return Operand.VALUE
-            else:
-                match self.token2symboltype(token):
-                    case Symbol.LABEL:
-                        return Operand.SYMBOL
-                    case Symbol.BYTE | Symbol.INTEGER | Symbol.SHORT | Symbol.DOUBLE | Symbol.STRING:
-                        return Operand.ADDRESS
-        elif token.isdigit():
-            return Operand.INTEGER
-        else:
-            return None
-    
-    def arg2opcode(self, typ :Operand, value :str) -> int:
-        match typ:
-            case Operand.REGISTER:
-                return Register.from_name(value).index()
-            case Operand.INTEGER:
-                if value.startswith("0x"):
-                    return int(value, 16)
-                else:
-                    return int(value)
-            case Operand.VALUE:
-                return self.symbol_map.get_symbol_index(value[1:-1])
-            case Operand.ADDRESS: # i should add support for manual memory addresses in case u want to add a flag or unmanaged memory space
-                return self.symbol_map.get_symbol_index(value)
-            case Operand.SYMBOL:
-                return self.symbol_map.get_symbol_index(value)
-                
-    
+            case TokenKind.NAME if self.is_symbol(token.value):
+                if self.symbol_map.get_symbol_type(token.value) == Symbol.LABEL:
+                    return Operand.SYMBOL
+                return Operand.ADDRESS
+        return None
+
+    def arg2opcode(self, typ :Operand, token :Token) -> int:
+        if typ is Operand.REGISTER or typ is Operand.INTEGER:
+            return token.value
+        # i should add support for manual memory addresses in case u want to add a flag or unmanaged memory space
+        return self.symbol_map.get_symbol_index(token.value)
+
     # convert a block into a list of opcodes and instructions
-    def block2opcode(self, block :List[str]) -> List[int]:
+    # symbol operands are written as symbol ids, their location inside the block is added to relocations
+    # dependencies receives the type of every symbol the block uses (None for unknown names)
+    # lines receives (location inside the block, source line) of every instruction
+    def block2opcode(self, block :List[str], relocations :List[Relocation] | None = None, dependencies :Dict[str, int | None] | None = None,
+                     lines :List[Tuple[int, int]] | None = None) -> List[int]:
         block_opcodes = []
-        for i,line in enumerate(block):
-            line_opcodes = []
-            tokens = self.tokenize_line(line)
-            tokens = self.remove_comma(tokens)
-            inst :Instruction = self.token2instruction(tokens[0])
-            dbgassert((len(tokens) -1) == inst.nargs, f"Instruction {tokens[0]} expected {inst.nargs} arguments, but only {len(tokens) - 1} were given")
+        instructions :List[List[Token]] = [self.tokenize(block, i) for i in range(len(block))]
+        if self.optimize:
+            instructions = optimize(instructions)
+        for tokens in instructions:
+            if lines is not None:
+                lines.append((len(block_opcodes), tokens[0].line))
+            if tokens[0].kind != TokenKind.MNEMONIC:
+                print(f"Unknown instruction {tokens[0].text} at {tokens[0].line}:{tokens[0].col}")
+                exit()
+            nargs, allowed = _encodings[tokens[0].value]
+            if (len(tokens) - 1) != nargs:
+                message :str = f"Instruction {tokens[0].text} at line {tokens[0].line} expected {nargs} arguments, but only {len(tokens) - 1} were given"
+                dbgassert(False, message)
+                self.errors.append(message)
+            block_opcodes.append(tokens[0].value)
             if len(tokens) > 1:
-                line_opcodes.append(self.instruction2opcode(tokens[0]))
                 argtypes = []
                 argvalues = []
+                symbols = []
                 # argument checker and operand type writing
                 for j in range(1, len(tokens)):
+                    if dependencies is not None:
+                        self.add_dependency(tokens[j], dependencies)
 
                     typ :Operand = self.token2type(tokens[j])
-                    if typ.value & inst.operand_types[j-1]:
-                        #dbg("Type check is cool asf today")
+                    if typ is None:
+                        print(f"Unknown symbol {tokens[j].text} at {tokens[j].line}:{tokens[j].col}")
+                        exit()
+                    if typ.value & allowed[j-1]:
                         argtypes.append(typ.value)
-                        dbg(self.arg2opcode(typ, tokens[j]))
+                        if log.enabled:
+                            log.debug("%s encoded as %s %d", tokens[j].text, typ.name, self.arg2opcode(typ, tokens[j]))
+                        if typ in SYMBOL_OPERANDS:
+                            symbols.append((len(argvalues), typ))
                         argvalues.append(self.arg2opcode(typ, tokens[j]))
-                        
-                line_opcodes.extend(argtypes)
-                line_opcodes.extend(argvalues)
-            else:
-                line_opcodes.append(self.instruction2opcode(tokens[0]))
-            block_opcodes.extend(line_opcodes)
+
+                if relocations is not None:
+                    for k, typ in symbols:
+                        offset :int = len(block_opcodes) + len(argtypes) + k
+                        relocations.append(Relocation(offset, argvalues[k], typ))
+                block_opcodes.extend(argtypes)
+                block_opcodes.extend(argvalues)
         return block_opcodes
 
-        
+    def add_dependency(self, token :Token, dependencies :Dict[str, int | None]):
+        if token.kind in (TokenKind.VALUE, TokenKind.NAME):
+            dependencies[token.value] = self.symbol_map.get_symbol_type(token.value).value if self.is_symbol(token.value) else None
+
+    def encode_block(self, block :List[str]) -> Tuple[List[int], List[Relocation], List[Tuple[int, int]]]:
+        """Encode the instructions of a block, through the block cache if there is one
+
+        Returns:
+            the opcodes, the relocations and the (location, source line) of every instruction, relative to the start of the block
+        """
+        relocations :List[Relocation] = []
+        lines :List[Tuple[int, int]] = []
+        if self.block_cache is None:
+            return self.block2opcode(block, relocations, None, lines), relocations, lines
+        # the cache keeps the lines relative to the block, the same block can move inside the file
+        first :int = block.line if isinstance(block, Block) else 0
+        key :str = BlockCache.key(BlockType.CODE, block, self.optimize)
+        entry = self.block_cache.get(key)
+        if entry is not None and all(self.symbol_map.get_symbol_type(name).value == typ if self.is_symbol(name) else typ is None
+                                     for name, typ in entry["dependencies"].items()):
+            relocations = [Relocation(offset, self.symbol_map.get_symbol_index(name), Operand(kind)) for offset, name, kind in entry["relocations"]]
+            lines = [(offset, first + line) for offset, line in entry["lines"]]
+            return list(entry["opcodes"]), relocations, lines
+        dependencies :Dict[str, int | None] = {}
+        errors :int = len(self.errors)
+        opcodes :List[int] = self.block2opcode(block, relocations, dependencies, lines)
+        if len(self.errors) > errors:
+            # a broken block is not cached, the next assembly reports its errors again
+            return opcodes, relocations, lines
+        self.block_cache.put(key, {
+            "opcodes": opcodes,
+            "relocations": [[r.offset, self.symbol_map.symbols[r.symbol].name, r.kind.value] for r in relocations],
+            "dependencies": dependencies,
+            "lines": [[offset, line - first] for offset, line in lines],
+        })
+        return opcodes, relocations, lines
+    
+    def write_code_block(self, opcodes :List[int], relocations :List[Relocation], lines :List[Tuple[int, int]] = ()) -> int:
+        location :int = self.memory._alloc(Segment.CODE, len(opcodes))
+        self.memory.write_array(Segment.CODE, location, opcodes)
+        for relocation in relocations:
+            relocation.offset += location
+            self.relocations[relocation.offset] = relocation
+        for offset, line in lines:
+            self.line_map[location + offset] = line
+        return location
+    
     def process_code_blocks(self):
-        for i, block in enumerate(self.parser.blocks):
-            if self.blocktypes[i] == BlockType.LABEL:
-                label_name = self.tokenize_line(block[0])[0][:-1]
-                opcodes = self.block2opcode(block[1:])
-                location :int = self.memory._alloc(Segment.CODE, len(opcodes))
-                self.memory.write_array(Segment.CODE, location, opcodes)
-                self.symbol_map.update_symbol(label_name, location)
-            elif self.blocktypes[i] == BlockType.CODE:
+        for block in self.parser:
+            typ :BlockType = self.block_type(block)
+            if typ == BlockType.LABEL:
+                label_name = self.tokenize(block, 0)[0].value
+                opcodes, relocations, lines = self.encode_block(block[1:])
+                location :int = self.write_code_block(opcodes, relocations, lines)
+                self.symbol_map.update_symbol(label_name, location, len(opcodes))
+            elif typ == BlockType.CODE:
                 #dbg(block)
-                opcodes = self.block2opcode(block)
-                location :int = self.memory._alloc(Segment.CODE, len(opcodes))
-                self.memory.write_array(Segment.CODE, location, opcodes)
-                pass
+                opcodes, relocations, lines = self.encode_block(block)
+                self.write_code_block(opcodes, relocations, lines)
             else:
                 pass
+    
+    def link(self):
+        """Rewrite every symbol operand with the final location of its symbol, the emulator only sees absolute addresses
+        """
+        code = self.memory[Segment.CODE]
+        symbols = self.symbol_map.symbols
+        for offset, relocation in self.relocations.items():
+            entry = symbols[relocation.symbol]
+            # the operands using extern symbols are left to the Linker
+            if entry.name not in self.externs:
+                code[offset] = entry.location
+    
+    def defragment(self):
+        """Compact the data segment, then link again so the code follows the moved symbols
+        """
+        self.symbol_map.relocate(self.memory.defragment(Segment.DATA))
+        self.link()
+    
+    def save(self, path :str, metadata :Dict | None = None):
+        """Write the assembled program as an executable image, the emulator can run it without assembling again
+
+        Args:
+            path (str): image file
+            metadata (Dict, optional): extra metadata entries, the Linker stores the source hash of its objects
+        Raises:
+            ValueError: the assembler reported errors, no image is written
+        """
+        if self.errors:
+            raise ValueError(f"{len(self.errors)} assembly errors, first : {self.errors[0]}")
+        source :str = self.parser.filein if self.parser.is_file else "<string>"
+        # a module with extern symbols is an object, only the Linker can turn it into a program
+        flags :Dict[str, int] = {name: SYMBOL_EXTERN for name in self.externs}
+        for name in self.exports:
+            flags[name] = flags.get(name, 0) | SYMBOL_GLOBAL
+        write_image(path, self.memory, self.symbol_map, self.relocations, {"source": source, **(metadata or {})}, flags)
+    
+    def get_line(self, location :int) -> int | None:
+        """Get the source line of the instruction at a code location, if there is one
+        """
+        return self.line_map.get(location)
+
+    def get_relocation(self, location :int) -> Relocation | None:
+        """Get the relocation applied at a code location, if there is one
+        """
+        return self.relocations.get(location)
                 
     def process_blocks(self):
-        self.guess_block_types()
-        dbg(self.blocktypes)
         self.process_symbol_blocks()
+        # every string literal is known, the pool takes a single block of the data segment
+        self.symbol_map.allocate_strings()
         self.process_code_blocks()
+        self.link()
+        if self.block_cache is not None:
+            log.debug("block cache : %d hits, %d misses", self.block_cache.hits, self.block_cache.misses)
+            self.block_cache.save()
         """
         dbg(self.parser.blocks)
         dbg(self.blocktypes)
-        dbg(self.symbol_map.symbol_table)
-        for symbol in self.symbol_map.symbol_table:
-            dbg(self.symbol_map.get_symbol_name_from_index(self.symbol_map.get_symbol_index(symbol)))
+        dbg(self.symbol_map.symbols)
+        for entry in self.symbol_map.symbols:
+            dbg(self.symbol_map.get_symbol_name_from_index(self.symbol_map.get_symbol_index(entry.name)))
         """
         
 
@@ -298,5 +521,16 @@ import argparse
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='OpenArchitecture Assembler', description="Assembler of an open architecture")
     parser.add_argument('filein', help="your microcode file which contains instructions")
+    parser.add_argument('-o', '--output', help="write the executable image to this file")
+    parser.add_argument('--cache', help="folder of the block cache, only the blocks that changed are assembled again")
+    parser.add_argument('--stream', action='store_true', help="do not load the whole source in memory, for very large files")
+    parser.add_argument('-O', '--optimize', action='store_true', help="run the peephole optimizer and emit superinstructions")
+    parser.add_argument('--paged', action='store_true', help="use the whole 32 bits address space, pages are allocated when they are written")
     args = parser.parse_args(sys.argv[1:])
-    assm :AssemblerV2 = AssemblerV2(args.filein)
\ No newline at end of file
+    assm :AssemblerV2 = AssemblerV2(args.filein, args.cache, args.stream, args.optimize, args.paged)
+    if assm.errors:
+        # the errors are printed as they are found
+        print(f"{len(assm.errors)} errors" + (", no image written" if args.output else ""))
+        sys.exit(1)
+    if args.output:
+        assm.save(args.output)
\ No newline at end of file
@@ -0,0 +1,319 @@
+from typing import List, Dict, Tuple, Callable
+from AssemblerV2 import AssemblerV2
+from CPU import Register, Operand, Instructions, PARITY
+from Emulator import DecodedInstruction, decode_instruction
+from Dispatch import IMMEDIATES
+from Dbg import get_logger
+
+# numpy is optional, only the batched engine needs it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = get_logger("batch")
+
+PC :int = Register.PC.value
+AR :int = Register.AR.value
+ST :int = Register.ST.value
+MASK :int = 2**32 - 1
+
+# Batch handlers receive the engine, the decoded instruction and the lanes (an index array) whose PC is
+# on that instruction. They do the work of the scalar handlers of Dispatch.py for all of those lanes at once.
+BatchHandler = Callable[["BatchEmulator", DecodedInstruction, "np.ndarray"], None]
+
+def _advance(batch, decoded, lanes):
+    regs = batch.regs
+    regs[lanes, PC] = regs[lanes, PC] + decoded.size
+    regs[lanes, AR] = regs[lanes, PC]
+
+def halt(batch, decoded, lanes):
+    batch.halted[lanes] = True
+
+def nop(batch, decoded, lanes):
+    _advance(batch, decoded, lanes)
+
+def jmp(batch, decoded, lanes):
+    batch.regs[lanes, PC] = decoded.operands[0]
+    batch.regs[lanes, AR] = decoded.operands[0]
+
+def call(batch, decoded, lanes):
+    lanes, top = batch.stack_lanes(lanes, 0)
+    regs = batch.regs
+    batch.stack[lanes, top] = regs[lanes, PC] + decoded.size
+    regs[lanes, ST] = top + 1
+    regs[lanes, PC] = decoded.operands[0]
+    regs[lanes, AR] = decoded.operands[0]
+
+def _binary(operation :Callable, kind :Operand, store :bool = True, flags :bool = True) -> BatchHandler:
+    """Build the handler of REGISTER, kind instructions, operation gets (destination, source) columns
+
+    Args:
+        store (bool, optional): write the result to the register, CMP does not
+        flags (bool, optional): keep the result for the conditional jumps, MOV does not
+    """
+    def handler(batch, decoded, lanes):
+        regs = batch.regs
+        reg, src = decoded.operands
+        if kind == Operand.REGISTER:
+            value = regs[lanes, src]
+        elif kind == Operand.VALUE:
+            value = batch.data[lanes, src].astype(regs.dtype)
+        else:
+            value = regs.dtype.type(src & MASK)
+        result = operation(regs[lanes, reg], value)
+        if store:
+            regs[lanes, reg] = result
+        if flags:
+            batch.result[lanes] = result
+        _advance(batch, decoded, lanes)
+    return handler
+
+def _branch(condition :Callable) -> BatchHandler:
+    """Build a conditional jump, condition gets the flags result column and returns which lanes jump
+    """
+    def handler(batch, decoded, lanes):
+        taken = condition(batch.result[lanes])
+        target = decoded.operands[0]
+        batch.regs[lanes[taken], PC] = target
+        batch.regs[lanes[taken], AR] = target
+        _advance(batch, decoded, lanes[~taken])
+    return handler
+
+# low byte -> PF
+_parity = np.array(PARITY, dtype=bool) if np is not None else None
+
+def _assert(kind :Operand) -> BatchHandler:
+    # a failed assert halts its lane instead of stopping the whole batch
+    def handler(batch, decoded, lanes):
+        regs = batch.regs
+        reg, src = decoded.operands
+        if kind == Operand.REGISTER:
+            value = regs[lanes, src]
+        elif kind == Operand.VALUE:
+            value = batch.data[lanes, src]
+        else:
+            value = src
+        failed = regs[lanes, reg] != value
+        if failed.any():
+            batch.fail(lanes[failed], batch.regs[lanes[failed], PC])
+            lanes = lanes[~failed]
+        _advance(batch, decoded, lanes)
+    return handler
+
+def _push(kind :Operand) -> BatchHandler:
+    def handler(batch, decoded, lanes):
+        lanes, top = batch.stack_lanes(lanes, 0)
+        operand :int = decoded.operands[0]
+        if kind == Operand.REGISTER:
+            value = batch.regs[lanes, operand]
+        elif kind == Operand.VALUE:
+            value = batch.data[lanes, operand]
+        else:
+            value = operand
+        batch.stack[lanes, top] = value
+        batch.regs[lanes, ST] = top + 1
+        _advance(batch, decoded, lanes)
+    return handler
+
+def _operand(batch, kind :Operand, operand :int, lanes):
+    if kind == Operand.REGISTER:
+        return batch.regs[lanes, operand]
+    if kind == Operand.VALUE:
+        return batch.data[lanes, operand].astype(batch.regs.dtype)
+    return batch.regs.dtype.type(operand & MASK)
+
+def _movadd(kind1 :Operand, kind2 :Operand) -> BatchHandler:
+    def handler(batch, decoded, lanes):
+        reg, source1, source2 = decoded.operands
+        batch.regs[lanes, reg] = batch.result[lanes] = _operand(batch, kind1, source1, lanes) + _operand(batch, kind2, source2, lanes)
+        _advance(batch, decoded, lanes)
+    return handler
+
+# every lane has its own data, the atomic instructions have nobody to race with
+def xadd(batch, decoded, lanes):
+    location, reg = decoded.operands
+    regs = batch.regs
+    old = batch.data[lanes, location].astype(regs.dtype)
+    batch.result[lanes] = old + regs[lanes, reg]
+    batch.data[lanes, location] = batch.result[lanes]
+    regs[lanes, reg] = old
+    _advance(batch, decoded, lanes)
+
+def xchg(batch, decoded, lanes):
+    location, reg = decoded.operands
+    regs = batch.regs
+    old = batch.data[lanes, location].astype(regs.dtype)
+    batch.data[lanes, location] = regs[lanes, reg]
+    regs[lanes, reg] = old
+    _advance(batch, decoded, lanes)
+
+def _cmpxchg(kind :Operand) -> BatchHandler:
+    def handler(batch, decoded, lanes):
+        location, reg, source = decoded.operands
+        regs = batch.regs
+        old = batch.data[lanes, location].astype(regs.dtype)
+        equal = old == regs[lanes, reg]
+        batch.data[lanes[equal], location] = _operand(batch, kind, source, lanes[equal])
+        batch.result[lanes] = old - regs[lanes, reg]
+        regs[lanes, reg] = old
+        _advance(batch, decoded, lanes)
+    return handler
+
+def pop_reg(batch, decoded, lanes):
+    lanes, top = batch.stack_lanes(lanes, -1)
+    batch.regs[lanes, decoded.operands[0]] = batch.stack[lanes, top]
+    batch.stack[lanes, top] = 0
+    batch.regs[lanes, ST] = top
+    _advance(batch, decoded, lanes)
+
+def _build_tables() -> Dict[Tuple[int, Tuple[Operand, ...]], BatchHandler]:
+    table :Dict[Tuple[int, Tuple[Operand, ...]], BatchHandler] = {}
+    kinds = tuple(Operand)
+    table[(Instructions.NONE.index(), ())] = halt
+    table[(Instructions.HALT.index(), ())] = halt
+    table[(Instructions.JMP.index(), (Operand.SYMBOL,))] = jmp
+    table[(Instructions.CALL.index(), (Operand.SYMBOL,))] = call
+    table[(Instructions.POP.index(), (Operand.REGISTER,))] = pop_reg
+    for kind in kinds:
+        table[(Instructions.PUSH.index(), (kind,))] = _push(kind)
+
+    branches = {
+        Instructions.JZ: lambda result: result == 0,
+        Instructions.JNZ: lambda result: result != 0,
+        Instructions.JS: lambda result: (result >> 31) != 0,
+        Instructions.JNS: lambda result: (result >> 31) == 0,
+        Instructions.JP: lambda result: _parity[result & 0xFF],
+        Instructions.JNP: lambda result: ~_parity[result & 0xFF],
+    }
+    for tInst, condition in branches.items():
+        table[(tInst.index(), (Operand.SYMBOL,))] = _branch(condition)
+    table[(Instructions.XADD.index(), (Operand.VALUE, Operand.REGISTER))] = xadd
+    table[(Instructions.XCHG.index(), (Operand.VALUE, Operand.REGISTER))] = xchg
+    for kind in IMMEDIATES + (Operand.REGISTER,):
+        table[(Instructions.CMPXCHG.index(), (Operand.VALUE, Operand.REGISTER, kind))] = _cmpxchg(kind)
+
+    # instruction -> (operation, store the result, set the flags result)
+    operations = {
+        Instructions.MOV: (lambda dest, value: value, True, False),
+        Instructions.ADD: (lambda dest, value: dest + value, True, True),
+        Instructions.SUB: (lambda dest, value: dest - value, True, True),
+        Instructions.CMP: (lambda dest, value: dest - value, False, True),
+    }
+    for kind in IMMEDIATES + (Operand.REGISTER, Operand.VALUE):
+        for tInst, (operation, store, flags) in operations.items():
+            table[(tInst.index(), (Operand.REGISTER, kind))] = _binary(operation, kind, store, flags)
+        table[(Instructions.ASSERT.index(), (Operand.REGISTER, kind))] = _assert(kind)
+        for kind2 in IMMEDIATES + (Operand.REGISTER, Operand.VALUE):
+            table[(Instructions.MOVADD.index(), (Operand.REGISTER, kind, kind2))] = _movadd(kind, kind2)
+    return table
+
+# (opcode, operand kinds) -> batch handler, like Dispatch.DISPATCH_TABLE everything else does nothing
+BATCH_DISPATCH_TABLE :Dict[Tuple[int, Tuple[Operand, ...]], BatchHandler] = _build_tables() if np is not None else {}
+
+class BatchEmulator:
+    def __init__(self, assembler_obj :AssemblerV2, lanes :int) -> None:
+        """Run the same assembled program on many independent machines (lanes) in lockstep
+
+        Registers, flags result, data and stack segments of all the lanes are numpy arrays of shape (lanes, ...).
+        Each step groups the running lanes by PC and executes every instruction once for its whole group,
+        so lanes that diverge are masked instead of stepped one by one.
+
+        Args:
+            assembler_obj (AssemblerV2): your assembler, its code segment is shared by every lane
+            lanes (int): number of machines
+        """
+        if np is None:
+            raise ImportError("BatchEmulator needs numpy, install it with pip install numpy")
+        self.lanes :int = lanes
+        self.memory = assembler_obj.memory
+        self.symbol_map = assembler_obj.symbol_map
+        word = np.dtype(self.memory.data.typecode)
+        self.regs = np.zeros((lanes, len(Register)), dtype=np.uint32)
+        # result of the last flag setting instruction of every lane, the lazy flags of Flags
+        self.result = np.zeros(lanes, dtype=np.uint32)
+        self.data = np.tile(np.frombuffer(self.memory.data.memory, dtype=word), (lanes, 1))
+        self.stack = np.zeros((lanes, self.memory.stack.size), dtype=word)
+        self.halted = np.zeros(lanes, dtype=bool)
+        # lanes stopped by a failed ASSERT or a stack fault, and the PC where it happened
+        self.failed = np.zeros(lanes, dtype=bool)
+        self.fail_pc = np.zeros(lanes, dtype=np.uint32)
+        # code address -> (decoded instruction, batch handler)
+        self.decode_cache :Dict[int, Tuple[DecodedInstruction, BatchHandler]] = {}
+        self.memory.code.write_hooks.append(self.invalidate)
+
+    def decode(self, address :int) -> Tuple[DecodedInstruction, BatchHandler]:
+        entry = self.decode_cache.get(address)
+        if entry is None:
+            decoded :DecodedInstruction = decode_instruction(self.memory.code, address)
+            entry = (decoded, BATCH_DISPATCH_TABLE.get((decoded.instruction.index(), decoded.operand_types), nop))
+            self.decode_cache[address] = entry
+        return entry
+
+    def invalidate(self, index :int, size :int):
+        # the code image is shared, any write drops the whole cache
+        self.decode_cache.clear()
+
+    def set_register(self, register :Register, values):
+        """Set a register of every lane, values is a scalar or one value per lane
+        """
+        self.regs[:, register.value] = values
+
+    def set_symbol(self, name :str, values):
+        """Set the value of a data symbol in every lane, values is a scalar or one value per lane
+        """
+        self.data[:, self.symbol_map.get_symbol(name)] = values
+
+    def get_register(self, register :Register):
+        return self.regs[:, register.value]
+
+    def get_symbol(self, name :str):
+        return self.data[:, self.symbol_map.get_symbol(name)]
+
+    def fail(self, lanes, pcs):
+        self.failed[lanes] = True
+        self.fail_pc[lanes] = pcs
+        self.halted[lanes] = True
+
+    def stack_lanes(self, lanes, offset :int):
+        """Get the lanes whose stack slot ST+offset exists, and that slot, the other lanes fail
+        """
+        top = self.regs[lanes, ST].astype(np.int64) + offset
+        bad = (top < 0) | (top >= self.stack.shape[1])
+        if bad.any():
+            self.fail(lanes[bad], self.regs[lanes[bad], PC])
+            lanes, top = lanes[~bad], top[~bad]
+        return lanes, top
+
+    def step(self) -> bool:
+        """Execute one instruction on every running lane
+
+        Returns:
+            False once every lane is halted
+        """
+        running = np.flatnonzero(~self.halted)
+        if running.size == 0:
+            return False
+        pcs = self.regs[running, AR]
+        if (pcs == pcs[0]).all():
+            groups = ((int(pcs[0]), running),)
+        else:
+            # lanes diverged, run each instruction for the lanes sitting on it
+            groups = ((int(pc), running[pcs == pc]) for pc in np.unique(pcs))
+        for pc, lanes in groups:
+            decoded, handler = self.decode(pc)
+            handler(self, decoded, lanes)
+        return True
+
+    def cycle(self, max_steps :int | None = None) -> int:
+        """Run until every lane halts, or for max_steps lockstep steps
+
+        Returns:
+            The number of steps executed
+        """
+        steps :int = 0
+        while (max_steps is None or steps < max_steps) and self.step():
+            steps += 1
+        if log.enabled:
+            log.debug("%d steps, %d lanes failed", steps, int(self.failed.sum()))
+        return steps
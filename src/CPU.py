@@ -4,13 +4,15 @@ from Dbg import dbgassert,dbg
 class Register(Enum):
     PC, AR, ST, SB, FT, FB, DS, DE, CT, CB = range(0,10)
     x0,x1,x2 = range(10, 13)
+    # core id, the number of the core running the program (MultiCore.py), 0 on a single core
+    CID = 13
     
     def index(self):
-        return list(Register).index(self)
+        return self.value
     
     @staticmethod
     def from_index(index):
-        return list(Register)[index]
+        return _registers[index]
     
     @staticmethod
     def from_name(name):
@@ -20,13 +22,13 @@ class Register(Enum):
 class Symbol(Enum):
     LABEL, BYTE, SHORT, INTEGER, DOUBLE, STRING = range(0,6)
 
+# index -> register, the enum values are the indexes themselves
+_registers :tuple = tuple(Register)
+
 class Operand(IntFlag):
     @staticmethod
     def from_value(value :int):
-        for tType in Operand:
-            if tType.value == value:
-                return tType
-        return Operand.NONE
+        return _operands.get(value, Operand.NONE)
     
     NONE = 0
     REGISTER = 1 << 0  # 1
@@ -35,7 +37,10 @@ class Operand(IntFlag):
     ADDRESS  = 1 << 3  # 8
     SYMBOL   = 1 << 4  # 16
     ALL = REGISTER | INTEGER | VALUE | ADDRESS | SYMBOL
-    
+
+# only the single operand kinds can be encoded, NONE and ALL are not iterated
+_operands :dict = {tType.value: tType for tType in Operand}
+
 class Instruction:
     def __init__(self, nargs :int = 0, operand_types :List[Operand] = []):
         """Create a new instruction
@@ -53,10 +58,17 @@ class Instructions(Enum):
     
     @staticmethod
     def from_index(index :int) -> Instruction:
-        for tType in Instructions:
-            if index == 0: return tType
-            else: index -= 1
-            
+        if 0 <= index < len(_instructions):
+            return _instructions[index]
+        return None
+    
+    @staticmethod
+    def from_name(name :str) -> Instruction:
+        return Instructions[name]
+    
+    def index(self) -> int:
+        return _opcodes[self]
+    
     NONE = Instruction()
     HALT = Instruction()
     JMP = Instruction(1, [Operand.SYMBOL])
@@ -68,18 +80,57 @@ class Instructions(Enum):
     SUB = Instruction(2, [Operand.ALL, Operand.ALL])
     CALL = Instruction(1, [Operand.SYMBOL])
     ASSERT = Instruction(2, [Operand.ALL, Operand.ALL])
-    
+    # internal, written by the optimizer for MOV r, x followed by ADD r, y : r = x + y
+    MOVADD = Instruction(3, [Operand.REGISTER, Operand.ALL, Operand.ALL])
+    # conditional jumps on the flags of the last ADD, SUB, CMP, MOVADD, XADD or CMPXCHG
+    JZ = Instruction(1, [Operand.SYMBOL])
+    JNZ = Instruction(1, [Operand.SYMBOL])
+    JS = Instruction(1, [Operand.SYMBOL])
+    JNS = Instruction(1, [Operand.SYMBOL])
+    JP = Instruction(1, [Operand.SYMBOL])
+    JNP = Instruction(1, [Operand.SYMBOL])
+    # aliases, same opcode : after CMP a, b the result is zero when a == b
+    JE = JZ
+    JNE = JNZ
+    # atomic read-modify-write of a data word, see Dispatch.py
+    XADD = Instruction(2, [Operand.VALUE, Operand.REGISTER])
+    XCHG = Instruction(2, [Operand.VALUE, Operand.REGISTER])
+    CMPXCHG = Instruction(3, [Operand.VALUE, Operand.REGISTER, Operand.REGISTER | Operand.INTEGER])
+    FENCE = Instruction()
+
+# opcode <-> instruction tables, the opcode is the position inside the enum
+_instructions :tuple = tuple(Instructions)
+_opcodes :dict = {tInst: i for i, tInst in enumerate(_instructions)}
+
 class Flag(Enum):
     S, ZF, PF, SF = range(0, 4)
-    
+
+# low byte -> PF, set when the byte has an even number of set bits
+PARITY :tuple = tuple(1 - bin(i).count("1") % 2 for i in range(256))
+
 class Flags:
+    """Lazy flags : ADD, SUB, CMP, MOVADD, XADD and CMPXCHG only store their 32 bits result, ZF, PF and SF are
+    computed from it when they are read. S is stored like before
+    """
+    __slots__ = ("flags", "result")
+
     def __init__(self):
         self.flags :List[int] = [0 for i in range(0, len(Flag))]
+        # result of the last flag setting instruction
+        self.result :int = 0
     
     def __getitem__(self, flag :Flag) -> int:
+        if flag == Flag.ZF:
+            return int(self.result == 0)
+        if flag == Flag.SF:
+            return self.result >> 31
+        if flag == Flag.PF:
+            return PARITY[self.result & 0xFF]
         return self.flags[flag.value]
 
     def __setitem__(self, flag :Flag, value :int) -> int:
+        if flag != Flag.S:
+            raise ValueError(f"{flag.name} is computed from the last result and can not be set")
         self.flags[flag.value] = value % (2**1)
 
 class Registers:
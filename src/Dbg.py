@@ -1,7 +1,105 @@
 import datetime
 import inspect
+from enum import IntEnum
+from typing import Dict
 is_debug = True
 
+class Level(IntEnum):
+    DEBUG, INFO, WARNING, ERROR = range(0, 4)
+
+class Logger:
+    """Leveled logger of a subsystem (assembler, emulator, memory...)
+
+    Messages are %-formatted only when they are printed. Hot code checks `logger.enabled`
+    (debug output is on) before building anything, so a disabled logger costs one attribute read.
+    """
+    __slots__ = ("name", "level", "enabled")
+
+    def __init__(self, name :str, level :Level) -> None:
+        self.name = name
+        self.set_level(level)
+
+    def set_level(self, level :Level):
+        self.level :Level = level
+        self.enabled :bool = level <= Level.DEBUG
+
+    def is_enabled(self, level :Level) -> bool:
+        return level >= self.level
+
+    def log(self, level :Level, message :str, *args):
+        if level >= self.level:
+            if args:
+                message = message % args
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"[{timestamp}] [{self.name}] [{level.name}] {message}")
+
+    def debug(self, message :str, *args):
+        if self.enabled:
+            self.log(Level.DEBUG, message, *args)
+
+    def info(self, message :str, *args):
+        self.log(Level.INFO, message, *args)
+
+    def warning(self, message :str, *args):
+        self.log(Level.WARNING, message, *args)
+
+    def error(self, message :str, *args):
+        self.log(Level.ERROR, message, *args)
+
+# subsystem name -> logger
+loggers :Dict[str, Logger] = {}
+# subsystem name -> level given by set_level(level, name), kept by the global levels
+levels :Dict[str, Level] = {}
+# level given by set_level(level), None follows is_debug
+global_level :Level | None = None
+
+def _default_level() -> Level:
+    if global_level is not None:
+        return global_level
+    return Level.DEBUG if is_debug else Level.WARNING
+
+def get_logger(name :str) -> Logger:
+    """Get the logger of a subsystem, it is created with its own level if one was set, the global one otherwise
+    """
+    if name not in loggers:
+        loggers[name] = Logger(name, levels.get(name, _default_level()))
+    return loggers[name]
+
+def _apply_default():
+    default :Level = _default_level()
+    for name, logger in loggers.items():
+        if name not in levels:
+            logger.set_level(default)
+
+def set_level(level :Level, name :str | None = None):
+    """Set the level of one subsystem, or the global level of every subsystem without its own level if name is None.
+    The global level also applies to the loggers created later
+    """
+    global global_level
+    if name is not None:
+        levels[name] = level
+        get_logger(name).set_level(level)
+    else:
+        global_level = level
+        _apply_default()
+
+def reset_level(name :str | None = None):
+    """Drop the level of one subsystem (or of every subsystem if name is None), it follows the global level again
+    """
+    if name is not None:
+        levels.pop(name, None)
+    else:
+        levels.clear()
+    _apply_default()
+
+def set_debug(flag :bool):
+    """Turn the debug output of dbg and of every logger without its own level on or off, this replaces the global level
+    """
+    global is_debug, global_level
+    is_debug = flag
+    global_level = None
+    _apply_default()
+
 def dbg(*args, **kwargs):
     """ Debug Output, print only happens if is_debug is set to true
     """
@@ -18,24 +116,47 @@ def dbg(*args, **kwargs):
             print(f"[{timestamp}] [{class_name}.{caller_func}]", *args, **kwargs)
         else:
             print(f"[{timestamp}] [{caller_func}]", *args, **kwargs)
-            
+
 def dbgassert(condition, message="Assertion failed"):
     if not condition:
         current_frame = inspect.currentframe()
         caller_frame = current_frame.f_back
-        
+
         caller_function = caller_frame.f_code.co_name
-        
+
         class_name = None
-        
+
         caller_locals = caller_frame.f_locals
-        
+
         if 'self' in caller_locals:
             class_name = caller_locals['self'].__class__.__name__
-        
+
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
+
         if class_name:
             print(f"[{timestamp}] [{class_name}.{caller_function}] {message}")
         else:
-            print(f"[{timestamp}] [{caller_function}] {message}")
\ No newline at end of file
+            print(f"[{timestamp}] [{caller_function}] {message}")
+
+def DbgUnitTests():
+    global is_debug, global_level
+    saved = (is_debug, global_level, dict(levels), {name: logger.level for name, logger in loggers.items()})
+    try:
+        set_level(Level.ERROR)
+        assert get_logger("dbg-test-late").level == Level.ERROR, ("ERROR in set_level, a later logger lost the global level")
+        set_level(Level.DEBUG, "dbg-test-own")
+        set_debug(False)
+        assert get_logger("dbg-test-own").level == Level.DEBUG, ("ERROR in set_debug, a subsystem level was overwritten")
+        assert get_logger("dbg-test-late").level == Level.WARNING, ("ERROR in set_debug")
+        set_level(Level.INFO)
+        assert get_logger("dbg-test-own").level == Level.DEBUG, ("ERROR in set_level, a subsystem level was overwritten")
+        reset_level("dbg-test-own")
+        assert get_logger("dbg-test-own").level == Level.INFO, ("ERROR in reset_level")
+    finally:
+        is_debug, global_level = saved[0], saved[1]
+        levels.clear()
+        levels.update(saved[2])
+        for name in ("dbg-test-late", "dbg-test-own"):
+            loggers.pop(name, None)
+        for name, level in saved[3].items():
+            loggers[name].set_level(level)
@@ -0,0 +1,333 @@
+from typing import List, Dict, Tuple, Callable
+from CPU import Register, Symbol
+from Memory import Segment, ArraySegment
+from Emulator import EmulatorV1, DecodedInstruction
+import bisect, operator
+
+# Breakpoints do not cost anything between two stops. A breakpoint address gets a trap in the decode cache of
+# the emulator: a copy of the decoded instruction whose handler raises BreakpointHit, the interpreter loop runs
+# unchanged. A conditional breakpoint checks its condition in the trap and runs the real handler when it is false.
+#
+# Watchpoints are a write hook on the data or stack segment, only installed while the segment has a watch. The
+# hook checks the page of the write against the watched pages before looking at the watches, and stops the run
+# after the instruction by setting is_halted (the debugger clears it again).
+
+# words per watched page
+PAGE_SIZE :int = 64
+
+OPERATORS :Dict[str, Callable[[int, int], bool]] = {
+    "==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+}
+
+class BreakpointHit(Exception):
+    def __init__(self, breakpoint :"Breakpoint") -> None:
+        super().__init__(f"breakpoint at {breakpoint.address}")
+        self.breakpoint = breakpoint
+
+class Condition:
+    """register <operator> integer, checked when a breakpoint is reached
+    """
+    __slots__ = ("reg", "op", "value", "text")
+
+    def __init__(self, text :str) -> None:
+        words :List[str] = text.split()
+        if len(words) != 3 or words[0] not in Register.__members__ or words[1] not in OPERATORS:
+            raise ValueError(f"bad condition {text!r}, expected register operator integer (x0 == 5)")
+        self.reg :int = Register[words[0]].value
+        self.op = OPERATORS[words[1]]
+        self.value :int = int(words[2], 0)
+        self.text = text
+
+    def __call__(self, regs :List[int]) -> bool:
+        return self.op(regs[self.reg], self.value)
+
+class Breakpoint:
+    __slots__ = ("address", "condition", "hits")
+
+    def __init__(self, address :int, condition :Condition | None = None) -> None:
+        self.address = address
+        self.condition = condition
+        self.hits :int = 0
+
+class Watchpoint:
+    """Stop after any write to [index, index+size) of a segment
+    """
+    __slots__ = ("segment", "index", "size", "name")
+
+    def __init__(self, segment :Segment, index :int, size :int, name :str) -> None:
+        self.segment = segment
+        self.index = index
+        self.size = size
+        self.name = name
+
+class TrapInstruction(DecodedInstruction):
+    """A decoded instruction replaced by a breakpoint, it keeps the real one
+    """
+    __slots__ = ("original", "breakpoint")
+
+def _trap(emu, decoded):
+    breakpoint :Breakpoint = decoded.breakpoint
+    if breakpoint.condition is None or breakpoint.condition(emu.regs.regs):
+        breakpoint.hits += 1
+        raise BreakpointHit(breakpoint)
+    decoded.original.handler(emu, decoded.original)
+
+class WatchHook:
+    """Write hook of a segment with watchpoints
+    """
+    def __init__(self, debugger :"Debugger", segment :ArraySegment) -> None:
+        self.debugger = debugger
+        self.segment = segment
+        self.watches :List[Watchpoint] = []
+        self.pages :set = set()
+
+    def update(self):
+        self.pages = {page for watch in self.watches
+                      for page in range(watch.index // PAGE_SIZE, (watch.index + watch.size - 1) // PAGE_SIZE + 1)}
+
+    def __call__(self, index :int, size :int):
+        if index // PAGE_SIZE not in self.pages and (size == 1 or not any(
+                page in self.pages for page in range(index // PAGE_SIZE, (index + size - 1) // PAGE_SIZE + 1))):
+            return
+        for watch in self.watches:
+            if index < watch.index + watch.size and index + size > watch.index:
+                # the hook runs before the write, keep the old value and stop after the instruction
+                start :int = max(index, watch.index)
+                self.debugger.watch_hits.append((watch, start, self.segment[start]))
+                self.debugger.emu.is_halted = True
+
+class Debugger:
+    def __init__(self, emu :EmulatorV1) -> None:
+        """Breakpoints and watchpoints over an emulator, the program runs with the interpreter between stops
+
+        Args:
+            emu (EmulatorV1): the debugged emulator
+        """
+        self.emu = emu
+        self.breakpoints :Dict[int, Breakpoint] = {}
+        self.watch_hooks :Dict[Segment, WatchHook] = {}
+        # (watchpoint, index, old value) of the writes of the last executed instruction
+        self.watch_hits :List[Tuple[Watchpoint, int, int]] = []
+        # address of the breakpoint of the last stop, the next cont steps over it
+        self.stopped_at :int | None = None
+        labels = sorted((entry.location, entry.name) for entry in emu.symbol_map.symbols if entry.type == Symbol.LABEL)
+        self.label_locations :List[int] = [location for location, name in labels]
+        self.label_names :List[str] = [name for location, name in labels]
+        emu.decode_hook = self._install
+
+    def _install(self, address :int, decoded :DecodedInstruction) -> DecodedInstruction:
+        """Decode hook of the emulator, replace the instruction by a trap if there is a breakpoint at its address
+        """
+        breakpoint = self.breakpoints.get(address)
+        if breakpoint is None:
+            return decoded
+        trap :TrapInstruction = TrapInstruction(decoded.instruction, decoded.operand_types, decoded.operands)
+        trap.handler = _trap
+        trap.original = decoded
+        trap.breakpoint = breakpoint
+        return trap
+
+    def _redecode(self, address :int):
+        # the next decode of the address sees the new breakpoints, the translated blocks holding it are dropped
+        self.emu.invalidate(address, 1)
+        if self.emu.translator is not None:
+            self.emu.translator.invalidate(address, 1)
+
+    def resolve(self, location :str) -> int:
+        """Code address of a label, label+offset or integer
+        """
+        name, plus, offset = location.partition("+")
+        if self.emu.symbol_map.has_symbol(name):
+            entry = self.emu.symbol_map.get_entry(name)
+            if entry.type != Symbol.LABEL:
+                raise ValueError(f"{name} is not a label")
+            return entry.location + (int(offset, 0) if plus else 0)
+        return int(location, 0)
+
+    def add_breakpoint(self, location :int | str, condition :str | None = None) -> Breakpoint:
+        """Stop before the instruction at a code address or label, if the condition (x0 == 5) holds
+        """
+        address :int = self.resolve(location) if isinstance(location, str) else location
+        breakpoint :Breakpoint = Breakpoint(address, Condition(condition) if condition else None)
+        self.breakpoints[address] = breakpoint
+        self._redecode(address)
+        return breakpoint
+
+    def remove_breakpoint(self, location :int | str):
+        address :int = self.resolve(location) if isinstance(location, str) else location
+        if address not in self.breakpoints:
+            raise IndexError(f"no breakpoint at {address}")
+        del self.breakpoints[address]
+        self._redecode(address)
+
+    def add_watchpoint(self, segment :Segment, index :int, size :int = 1, name :str | None = None) -> Watchpoint:
+        """Stop after the instructions writing [index, index+size) of the data or stack segment
+        """
+        if segment == Segment.CODE:
+            raise ValueError("only the data and stack segments can be watched")
+        watch :Watchpoint = Watchpoint(segment, index, size, name or f"{segment.name.lower()}[{index}]")
+        hook = self.watch_hooks.get(segment)
+        if hook is None:
+            hook = self.watch_hooks[segment] = WatchHook(self, self.emu.memory[segment])
+            self.emu.memory[segment].write_hooks.append(hook)
+        hook.watches.append(watch)
+        hook.update()
+        return watch
+
+    def watch_symbol(self, name :str) -> Watchpoint:
+        entry = self.emu.symbol_map.get_entry(name)
+        if entry.type == Symbol.LABEL:
+            raise ValueError(f"{name} is a label, not data")
+        return self.add_watchpoint(Segment.DATA, entry.location, max(entry.size, 1), name)
+
+    def remove_watchpoint(self, watch :Watchpoint):
+        hook :WatchHook = self.watch_hooks[watch.segment]
+        hook.watches.remove(watch)
+        hook.update()
+        if not hook.watches:
+            # no watch left, the segment writes do not call anything again
+            self.emu.memory[watch.segment].write_hooks.remove(hook)
+            del self.watch_hooks[watch.segment]
+
+    def _real(self, address :int) -> DecodedInstruction:
+        decoded = self.emu.decode(address)
+        return decoded.original if isinstance(decoded, TrapInstruction) else decoded
+
+    def _stopped_by_watch(self) -> bool:
+        if not self.watch_hits:
+            return False
+        self.emu.is_halted = False
+        return True
+
+    def step(self) -> str | None:
+        """Execute one instruction, even if there is a breakpoint on it
+
+        Returns:
+            why the cpu stopped (watchpoint, halt), None if it did not
+        """
+        self.watch_hits = []
+        self.stopped_at = None
+        decoded = self._real(self.emu.regs[Register.AR])
+        decoded.handler(self.emu, decoded)
+        if self._stopped_by_watch():
+            return "watchpoint"
+        return "halted" if self.emu.is_halted else None
+
+    def cont(self, budget :int | None = None) -> str:
+        """Run until a breakpoint, a watchpoint, a halt or the end of the budget
+
+        Returns:
+            why the cpu stopped : "breakpoint", "watchpoint", "halted" or "budget"
+        """
+        if self.emu.is_halted:
+            return "halted"
+        self.watch_hits = []
+        executed :int = 0
+        # step over the breakpoint that stopped the cpu, a breakpoint on the pc that did not stop it yet fires
+        address :int = self.emu.regs[Register.AR]
+        if address == self.stopped_at and address in self.breakpoints:
+            reason = self.step()
+            if reason is not None:
+                return reason
+            executed = 1
+        self.stopped_at = None
+        while budget is None or executed < budget:
+            try:
+                executed += self.emu.interpret(1_000_000 if budget is None else budget - executed)
+            except BreakpointHit as e:
+                self.stopped_at = e.breakpoint.address
+                return "breakpoint"
+            if self._stopped_by_watch():
+                return "watchpoint"
+            if self.emu.is_halted:
+                return "halted"
+        return "budget"
+
+    def location(self, address :int) -> str:
+        """label+offset and source line of a code address
+        """
+        i :int = bisect.bisect_right(self.label_locations, address) - 1
+        where :str = str(address)
+        if i >= 0:
+            offset :int = address - self.label_locations[i]
+            where += f" ({self.label_names[i]}+{offset})" if offset else f" ({self.label_names[i]})"
+        line = self.emu.line_map.get(address)
+        return where + (f" line {line}" if line else "")
+
+    def dump_registers(self) -> str:
+        return "  ".join(f"{Register.from_index(i).name}={value}" for i, value in enumerate(self.emu.regs))
+
+    def describe_stop(self, reason :str) -> str:
+        lines :List[str] = [f"{reason} at {self.location(self.emu.regs[Register.PC])}"]
+        for watch, index, old in self.watch_hits:
+            lines.append(f"  {watch.name} : {index} {old} -> {self.emu.memory[watch.segment][index]}")
+        return "\n".join(lines)
+
+    def cli(self):
+        """Interactive debugger, "help" lists the commands
+        """
+        print(HELP)
+        print(f"stopped at {self.location(self.emu.regs[Register.PC])}")
+        while True:
+            try:
+                words :List[str] = input("(dbg) ").split()
+            except EOFError:
+                break
+            if not words:
+                continue
+            command, args = words[0], words[1:]
+            try:
+                if command in ("q", "quit"):
+                    break
+                elif command in ("h", "help"):
+                    print(HELP)
+                elif command in ("b", "break"):
+                    condition :str | None = " ".join(args[2:]) if len(args) > 2 and args[1] == "if" else None
+                    breakpoint :Breakpoint = self.add_breakpoint(args[0], condition)
+                    print(f"breakpoint at {self.location(breakpoint.address)}" + (f" if {condition}" if condition else ""))
+                elif command in ("d", "delete"):
+                    self.remove_breakpoint(args[0])
+                elif command in ("w", "watch"):
+                    if args[0] == "stack":
+                        watch :Watchpoint = self.add_watchpoint(Segment.STACK, int(args[1], 0), int(args[2], 0) if len(args) > 2 else 1)
+                    else:
+                        watch :Watchpoint = self.watch_symbol(args[0].strip("[]"))
+                    print(f"watching {watch.name} ({watch.segment.name.lower()} {watch.index}, {watch.size} words)")
+                elif command in ("l", "list"):
+                    for breakpoint in self.breakpoints.values():
+                        condition = f" if {breakpoint.condition.text}" if breakpoint.condition else ""
+                        print(f"break {self.location(breakpoint.address)}{condition}, {breakpoint.hits} hits")
+                    for hook in self.watch_hooks.values():
+                        for watch in hook.watches:
+                            print(f"watch {watch.name} ({watch.segment.name.lower()} {watch.index}, {watch.size} words)")
+                elif command in ("s", "step"):
+                    for i in range(int(args[0], 0) if args else 1):
+                        reason = self.step()
+                        if reason is not None:
+                            print(self.describe_stop(reason))
+                            break
+                    else:
+                        print(f"at {self.location(self.emu.regs[Register.PC])}")
+                elif command in ("c", "continue"):
+                    print(self.describe_stop(self.cont(int(args[0], 0) if args else None)))
+                elif command in ("r", "regs"):
+                    print(self.dump_registers())
+                elif command in ("x", "dump"):
+                    segment :Segment = Segment[args[0].upper()]
+                    index :int = int(args[1], 0) if len(args) > 1 else 0
+                    size :int = int(args[2], 0) if len(args) > 2 else 16
+                    print(self.emu.memory.hexdump(self.emu.memory[segment].memory, 16, index, size))
+                else:
+                    print(f"unknown command {command}, type help")
+            except (ValueError, IndexError, KeyError) as e:
+                print(f"error : {e}")
+            except AssertionError as e:
+                print(f"assert failed at {self.location(self.emu.regs[Register.PC])} : {e}")
+
+HELP :str = """commands :
+  b(reak) <label|address>[+offset] [if <register> <op> <integer>]   stop before an instruction
+  d(elete) <label|address>                                          remove a breakpoint
+  w(atch) <symbol> | stack <index> [size]                           stop after a write
+  l(ist)                                                            breakpoints and watchpoints
+  s(tep) [n]        c(ontinue) [budget]        r(egs)        x <code|data|stack> [index] [size]
+  q(uit)"""
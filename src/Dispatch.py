@@ -0,0 +1,336 @@
+from typing import Dict, Tuple, Callable
+from CPU import Register, Operand, Instructions, PARITY
+
+# Every handler receives the emulator and a DecodedInstruction, executes it and moves PC/AR itself.
+# ADD, SUB, CMP, MOVADD, XADD and CMPXCHG store their result in emu.flags.result, the conditional jumps compute
+# their flag from it.
+# The tables below are built once at import, the emulator looks the handler up when it decodes an
+# instruction so executing it is a single call, without matching the opcode or the operand kinds.
+
+PC :int = Register.PC.value
+AR :int = Register.AR.value
+ST :int = Register.ST.value
+MASK :int = 2**32 - 1
+
+# operand kinds that are read as an immediate, the operand itself is the value
+IMMEDIATES :Tuple[Operand, ...] = (Operand.INTEGER, Operand.ADDRESS)
+
+Handler = Callable[["EmulatorV1", "DecodedInstruction"], None]
+
+def _advance(regs, decoded):
+    # PC can be a destination operand, so move from its current value and not from the decoded address
+    regs[PC] = regs[AR] = (regs[PC] + decoded.size) & MASK
+
+def halt(emu, decoded):
+    emu.is_halted = True
+
+def nop(emu, decoded):
+    _advance(emu.regs.regs, decoded)
+
+def jmp(emu, decoded):
+    regs = emu.regs.regs
+    regs[PC] = regs[AR] = decoded.operands[0]
+
+def call(emu, decoded):
+    regs = emu.regs.regs
+    # begin a new stack frame, save the return address (aka simulate PUSH instruction)
+    emu.memory.stack[regs[ST]] = (regs[PC] + decoded.size) & MASK
+    regs[ST] = (regs[ST] + 1) & MASK
+    regs[PC] = regs[AR] = decoded.operands[0]
+
+def mov_reg_imm(emu, decoded):
+    regs = emu.regs.regs
+    reg, value = decoded.operands
+    regs[reg] = value & MASK
+    _advance(regs, decoded)
+
+def mov_reg_reg(emu, decoded):
+    regs = emu.regs.regs
+    reg, src = decoded.operands
+    regs[reg] = regs[src]
+    _advance(regs, decoded)
+
+def mov_reg_value(emu, decoded):
+    regs = emu.regs.regs
+    reg, location = decoded.operands
+    regs[reg] = emu.memory.data[location] & MASK
+    _advance(regs, decoded)
+
+def add_reg_imm(emu, decoded):
+    regs = emu.regs.regs
+    reg, value = decoded.operands
+    emu.flags.result = regs[reg] = (regs[reg] + value) & MASK
+    _advance(regs, decoded)
+
+def add_reg_reg(emu, decoded):
+    regs = emu.regs.regs
+    reg, src = decoded.operands
+    emu.flags.result = regs[reg] = (regs[reg] + regs[src]) & MASK
+    _advance(regs, decoded)
+
+def add_reg_value(emu, decoded):
+    regs = emu.regs.regs
+    reg, location = decoded.operands
+    emu.flags.result = regs[reg] = (regs[reg] + emu.memory.data[location]) & MASK
+    _advance(regs, decoded)
+
+def sub_reg_imm(emu, decoded):
+    regs = emu.regs.regs
+    reg, value = decoded.operands
+    emu.flags.result = regs[reg] = (regs[reg] - value) & MASK
+    _advance(regs, decoded)
+
+def sub_reg_reg(emu, decoded):
+    regs = emu.regs.regs
+    reg, src = decoded.operands
+    emu.flags.result = regs[reg] = (regs[reg] - regs[src]) & MASK
+    _advance(regs, decoded)
+
+def sub_reg_value(emu, decoded):
+    regs = emu.regs.regs
+    reg, location = decoded.operands
+    emu.flags.result = regs[reg] = (regs[reg] - emu.memory.data[location]) & MASK
+    _advance(regs, decoded)
+
+def push_imm(emu, decoded):
+    regs = emu.regs.regs
+    emu.memory.stack[regs[ST]] = decoded.operands[0]
+    regs[ST] = (regs[ST] + 1) & MASK
+    _advance(regs, decoded)
+
+def push_reg(emu, decoded):
+    regs = emu.regs.regs
+    emu.memory.stack[regs[ST]] = regs[decoded.operands[0]]
+    regs[ST] = (regs[ST] + 1) & MASK
+    _advance(regs, decoded)
+
+def push_value(emu, decoded):
+    regs = emu.regs.regs
+    emu.memory.stack[regs[ST]] = emu.memory.data[decoded.operands[0]]
+    regs[ST] = (regs[ST] + 1) & MASK
+    _advance(regs, decoded)
+
+def pop_reg(emu, decoded):
+    regs = emu.regs.regs
+    stack = emu.memory.stack
+    top :int = regs[ST] - 1
+    regs[decoded.operands[0]] = stack[top] & MASK
+    stack[top] = 0
+    regs[ST] = top & MASK
+    _advance(regs, decoded)
+
+def cmp_reg_imm(emu, decoded):
+    reg, value = decoded.operands
+    emu.flags.result = (emu.regs.regs[reg] - value) & MASK
+    _advance(emu.regs.regs, decoded)
+
+def cmp_reg_reg(emu, decoded):
+    regs = emu.regs.regs
+    reg, src = decoded.operands
+    emu.flags.result = (regs[reg] - regs[src]) & MASK
+    _advance(regs, decoded)
+
+def cmp_reg_value(emu, decoded):
+    reg, location = decoded.operands
+    emu.flags.result = (emu.regs.regs[reg] - emu.memory.data[location]) & MASK
+    _advance(emu.regs.regs, decoded)
+
+def _lock(emu, location :int):
+    locks = emu.memory.locks
+    return locks[location % len(locks)]
+
+# The atomic instructions work on a data word, under the lock of the word when the memory is shared by several
+# cores. They go through the segment so the write hooks (snapshots, watchpoints) see them.
+def xadd(emu, decoded):
+    # [v] += r, r gets the old value of [v], the flags are set by the sum
+    regs = emu.regs.regs
+    location, reg = decoded.operands
+    data = emu.memory.data
+    with _lock(emu, location):
+        old :int = data[location]
+        data[location] = old + regs[reg]
+    emu.flags.result = (old + regs[reg]) & MASK
+    regs[reg] = old & MASK
+    _advance(regs, decoded)
+
+def xchg(emu, decoded):
+    regs = emu.regs.regs
+    location, reg = decoded.operands
+    data = emu.memory.data
+    with _lock(emu, location):
+        old :int = data[location]
+        data[location] = regs[reg]
+    regs[reg] = old & MASK
+    _advance(regs, decoded)
+
+def _cmpxchg(kind :Operand) -> Handler:
+    """Build the handler of CMPXCHG [v], r, x : if [v] == r then [v] = x, else r = [v]. ZF is set when the
+    exchange happened, the flags are the ones of CMP [v], r
+    """
+    immediate :bool = kind in IMMEDIATES
+    def cmpxchg(emu, decoded):
+        regs = emu.regs.regs
+        location, reg, source = decoded.operands
+        data = emu.memory.data
+        value :int = source if immediate else regs[source]
+        with _lock(emu, location):
+            old :int = data[location]
+            if old == regs[reg]:
+                data[location] = value
+        emu.flags.result = (old - regs[reg]) & MASK
+        regs[reg] = old & MASK
+        _advance(regs, decoded)
+    return cmpxchg
+
+def fence(emu, decoded):
+    # the handlers of a core write the shared memory right away, taking a lock is enough to order them with the
+    # other processes
+    with emu.memory.locks[0]:
+        pass
+    _advance(emu.regs.regs, decoded)
+
+# the conditional jumps, ZF is result == 0, SF is its bit 31 and PF the parity of its low byte
+def jz(emu, decoded):
+    regs = emu.regs.regs
+    if emu.flags.result == 0:
+        regs[PC] = regs[AR] = decoded.operands[0]
+    else:
+        _advance(regs, decoded)
+
+def jnz(emu, decoded):
+    regs = emu.regs.regs
+    if emu.flags.result != 0:
+        regs[PC] = regs[AR] = decoded.operands[0]
+    else:
+        _advance(regs, decoded)
+
+def js(emu, decoded):
+    regs = emu.regs.regs
+    if emu.flags.result >> 31:
+        regs[PC] = regs[AR] = decoded.operands[0]
+    else:
+        _advance(regs, decoded)
+
+def jns(emu, decoded):
+    regs = emu.regs.regs
+    if not emu.flags.result >> 31:
+        regs[PC] = regs[AR] = decoded.operands[0]
+    else:
+        _advance(regs, decoded)
+
+def jp(emu, decoded):
+    regs = emu.regs.regs
+    if PARITY[emu.flags.result & 0xFF]:
+        regs[PC] = regs[AR] = decoded.operands[0]
+    else:
+        _advance(regs, decoded)
+
+def jnp(emu, decoded):
+    regs = emu.regs.regs
+    if not PARITY[emu.flags.result & 0xFF]:
+        regs[PC] = regs[AR] = decoded.operands[0]
+    else:
+        _advance(regs, decoded)
+
+def assert_reg_imm(emu, decoded):
+    regs = emu.regs.regs
+    reg, value = decoded.operands
+    assert regs[reg] == value, (f"{Register.from_index(reg).name} is not equal to {value}")
+    _advance(regs, decoded)
+
+def assert_reg_reg(emu, decoded):
+    regs = emu.regs.regs
+    reg, src = decoded.operands
+    assert regs[reg] == regs[src], (f"{Register.from_index(reg).name} is not equal to {Register.from_index(src).name} which is {regs[src]}")
+    _advance(regs, decoded)
+
+def assert_reg_value(emu, decoded):
+    regs = emu.regs.regs
+    reg, location = decoded.operands
+    value :int = emu.memory.data[location]
+    assert regs[reg] == value, (f"{Register.from_index(reg).name} is not equal to the symbol at {location} which is {value}")
+    _advance(regs, decoded)
+
+def _reader(kind :Operand) -> Callable:
+    """Get the function reading the value of an operand of the given kind
+    """
+    if kind == Operand.REGISTER:
+        return lambda emu, regs, operand: regs[operand]
+    if kind == Operand.VALUE:
+        return lambda emu, regs, operand: emu.memory.data[operand]
+    return lambda emu, regs, operand: operand
+
+def _movadd(kind1 :Operand, kind2 :Operand) -> Handler:
+    """Build the handler of the MOVADD superinstruction for its two source kinds
+    """
+    read1, read2 = _reader(kind1), _reader(kind2)
+    def movadd(emu, decoded):
+        regs = emu.regs.regs
+        reg, source1, source2 = decoded.operands
+        emu.flags.result = regs[reg] = (read1(emu, regs, source1) + read2(emu, regs, source2)) & MASK
+        _advance(regs, decoded)
+    return movadd
+
+# conditional jump -> handler
+BRANCHES :Dict[Instructions, Handler] = {
+    Instructions.JZ: jz, Instructions.JNZ: jnz, Instructions.JS: js,
+    Instructions.JNS: jns, Instructions.JP: jp, Instructions.JNP: jnp,
+}
+
+def _build_tables() -> Dict[Tuple[int, Tuple[Operand, ...]], Handler]:
+    table :Dict[Tuple[int, Tuple[Operand, ...]], Handler] = {}
+    kinds = tuple(Operand)
+
+    # by default every well formed instruction does nothing but move to the next one,
+    # the specialized handlers are written over these
+    for tInst in Instructions:
+        if tInst.value.nargs == 1:
+            for kind in kinds:
+                table[(tInst.index(), (kind,))] = nop
+        elif tInst.value.nargs == 2:
+            for kind1 in kinds:
+                for kind2 in kinds:
+                    table[(tInst.index(), (kind1, kind2))] = nop
+
+    table[(Instructions.NONE.index(), ())] = halt
+    table[(Instructions.HALT.index(), ())] = halt
+    table[(Instructions.JMP.index(), (Operand.SYMBOL,))] = jmp
+    table[(Instructions.CALL.index(), (Operand.SYMBOL,))] = call
+    table[(Instructions.POP.index(), (Operand.REGISTER,))] = pop_reg
+    for tInst, branch in BRANCHES.items():
+        table[(tInst.index(), (Operand.SYMBOL,))] = branch
+    table[(Instructions.XADD.index(), (Operand.VALUE, Operand.REGISTER))] = xadd
+    table[(Instructions.XCHG.index(), (Operand.VALUE, Operand.REGISTER))] = xchg
+    for kind in IMMEDIATES + (Operand.REGISTER,):
+        table[(Instructions.CMPXCHG.index(), (Operand.VALUE, Operand.REGISTER, kind))] = _cmpxchg(kind)
+    table[(Instructions.FENCE.index(), ())] = fence
+
+    for kind in kinds:
+        table[(Instructions.PUSH.index(), (kind,))] = push_reg if kind == Operand.REGISTER else push_value if kind == Operand.VALUE else push_imm
+
+    binary = {
+        Instructions.MOV: (mov_reg_imm, mov_reg_reg, mov_reg_value),
+        Instructions.ADD: (add_reg_imm, add_reg_reg, add_reg_value),
+        Instructions.SUB: (sub_reg_imm, sub_reg_reg, sub_reg_value),
+        Instructions.CMP: (cmp_reg_imm, cmp_reg_reg, cmp_reg_value),
+        Instructions.ASSERT: (assert_reg_imm, assert_reg_reg, assert_reg_value),
+    }
+    for tInst, (imm, reg, value) in binary.items():
+        for kind in IMMEDIATES:
+            table[(tInst.index(), (Operand.REGISTER, kind))] = imm
+        table[(tInst.index(), (Operand.REGISTER, Operand.REGISTER))] = reg
+        table[(tInst.index(), (Operand.REGISTER, Operand.VALUE))] = value
+
+    sources = IMMEDIATES + (Operand.REGISTER, Operand.VALUE)
+    for kind1 in sources:
+        for kind2 in sources:
+            table[(Instructions.MOVADD.index(), (Operand.REGISTER, kind1, kind2))] = _movadd(kind1, kind2)
+    return table
+
+# (opcode, operand kinds) -> handler
+DISPATCH_TABLE :Dict[Tuple[int, Tuple[Operand, ...]], Handler] = _build_tables()
+
+def get_handler(opcode :int, operand_types :Tuple[Operand, ...]) -> Handler:
+    """Get the specialized handler of an instruction, malformed instructions do nothing
+    """
+    return DISPATCH_TABLE.get((opcode, operand_types), nop)
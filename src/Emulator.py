@@ -1,181 +1,221 @@
 from AssemblerV2 import AssemblerV2
+from Image import Image, load_image, IMAGE_MAGIC
 from CPU import Register, Operand, Flags, Registers, Instruction, Instructions
-from Memory import Memory, Segment
-from Dbg import dbg
+from Memory import Memory, Segment, CodeSegment
+from Dbg import dbg, get_logger
+import Dbg
 from enum import Enum
+from typing import List, Dict, Tuple, Callable
+from Dispatch import Handler, get_handler
+from Translator import Translator
+from Profiler import Profiler
+from Snapshot import Snapshots, Snapshot
+# the biggest instruction we can meet, used to find the cached instructions overlapping a write
+MAX_INSTRUCTION_SIZE :int = max(tInst.value.size for tInst in Instructions)
+
+log = get_logger("emulator")
+
+class DecodedInstruction:
+    """An instruction decoded once from the code segment
+    """
+    __slots__ = ("instruction", "handler", "size", "operand_types", "operands")
+
+    def __init__(self, instruction :Instructions, operand_types :Tuple[Operand, ...], operands :List[int]):
+        self.instruction = instruction
+        self.handler :Handler = get_handler(instruction.index(), operand_types)
+        self.size :int = instruction.value.size
+        self.operand_types :Tuple[Operand, ...] = operand_types
+        self.operands :List[int] = operands
+
+def decode_instruction(code :CodeSegment, address :int) -> DecodedInstruction:
+    """Decode the instruction at the given location of a code segment
+    """
+    instruction :Instructions = Instructions.from_index(code[address])
+    nargs :int = instruction.value.nargs
+    operand_types :Tuple[Operand, ...] = tuple(Operand.from_value(code[address + 1 + i]) for i in range(nargs))
+    # the assembler linked every symbol operand, they already are absolute locations
+    operands :List[int] = [code[address + 1 + nargs + i] for i in range(nargs)]
+    return DecodedInstruction(instruction, operand_types, operands)
+
 class EmulatorV1:
-    def __init__(self, assembler_obj :AssemblerV2) -> None:
+    def __init__(self, assembler_obj :AssemblerV2 | Image, translate :bool = False, profile :bool = False) -> None:
         """Create a new emulator object from an assembler
 
         Args:
-            assembler_obj (AssemblerV2): your assembler
+            assembler_obj (AssemblerV2 | Image): your assembler, or a loaded executable image
+            translate (bool, optional): run the basic blocks as compiled python functions instead of one handler per instruction
+            profile (bool, optional): count the executed instructions per address, opcode and call stack, see Profiler.py.
+                The translator is not used while profiling
         """
         self.regs :Registers = Registers()
         self.flags :Flags = Flags()
         self.memory :Memory = assembler_obj.memory
         self.symbol_map = assembler_obj.symbol_map
+        self.relocations = assembler_obj.relocations
         self.regs[Register.PC] = 0
         self.regs[Register.AR] = 0
         
         self.regs[Register.ST] = 0
         
         self.is_halted = False
+        # code address -> decoded instruction, filled the first time an address is executed
+        self.decode_cache :Dict[int, DecodedInstruction] = {}
+        self.memory.code.write_hooks.append(self.invalidate)
+        # called with (address, decoded) on every decode, returns the instruction to cache (the debugger puts its breakpoints there)
+        self.decode_hook :Callable[[int, DecodedInstruction], DecodedInstruction] | None = None
+        # code location -> source line, images have none
+        self.line_map :Dict[int, int] = getattr(assembler_obj, "line_map", {})
+        self.translator :Translator | None = Translator(self) if translate else None
+        self.profiler :Profiler | None = Profiler(self, self.line_map) if profile else None
+        # created by the first snapshot, until then the segments have no page tracking hook
+        self.snapshots :Snapshots | None = None
+    
+    @classmethod
+    def from_image(cls, path :str, translate :bool = False, profile :bool = False) -> "EmulatorV1":
+        """Create an emulator from an executable image written by AssemblerV2.save, nothing is assembled
+        """
+        return cls(load_image(path), translate, profile)
     
     def read_pc_offset(self, idx):
         return self.memory[Segment.CODE][self.regs[Register.PC] + idx]
     
-    def execute(self, instruction):
-        match instruction:
-            case Instructions.NONE:
-                self.is_halted = True
-            case Instructions.HALT:
-                self.is_halted = True
-                
-            case Instructions.JMP:
-                label_idx = self.memory[Segment.CODE][self.regs[Register.PC] + 2]
-                label_name = self.symbol_map.get_symbol_name_from_index(label_idx)
-                label_location = self.symbol_map.get_symbol(label_name)
-                dbg(f"jumping to {label_location}")
-                self.regs[Register.PC] = label_location
-                self.regs[Register.AR] = self.regs[Register.PC]
-                return
+    def decode(self, address :int) -> DecodedInstruction:
+        """Decode the instruction at the given code address, or get it from the decode cache
 
-            case Instructions.MOV:
-                op_type1 :Operand = Operand.from_value(self.read_pc_offset(1))
-                op_type2 :Operand = Operand.from_value(self.read_pc_offset(2))
-                dbg(op_type2.name)
-                op1 :int = self.read_pc_offset(3)
-                op2 :int = self.read_pc_offset(4)
-                if op_type1 == Operand.REGISTER:
-                    reg :Register = Register.from_index(op1)
-                    match op_type2:
-                        case Operand.ADDRESS | Operand.INTEGER:
-                            self.regs[reg] = op2
-                        case Operand.REGISTER:
-                            self.regs[reg] = self.regs[Register.from_index(op2)]
-                        case Operand.VALUE:
-                            location = self.symbol_map.get_symbol(self.symbol_map.get_symbol_name_from_index(op2))
-                            value = self.memory[Segment.DATA][location]
-                            self.regs[reg] = value
-                        
-            case Instructions.PUSH:
-                op_type1 :Operand = Operand.from_value(self.read_pc_offset(1))
-                op1 :int = self.read_pc_offset(2)
-                match op_type1:
-                    case Operand.INTEGER | Operand.ADDRESS | Operand.SYMBOL:
-                        self.memory.write(Segment.STACK, self.regs[Register.ST], op1)
-                    case Operand.VALUE:
-                        location = self.symbol_map.get_symbol(self.symbol_map.get_symbol_name_from_index(op2))
-                        value = self.memory[Segment.DATA][location]
-                        self.memory.write(Segment.STACK, self.regs[Register.ST], value)
-                    case Operand.REGISTER:
-                        self.memory.write(Segment.STACK, self.regs[Register.ST], self.regs[Register.from_index(op1)])
-                        
-                self.regs[Register.ST] += 1
-                
-            case Instructions.POP:
-                op_type1 :Operand = Operand.from_value(self.read_pc_offset(1))
-                reg :Register = Register.from_index(self.read_pc_offset(2))
-                if op_type1 == Operand.REGISTER:
-                    self.regs[reg] = self.memory[Segment.STACK][self.regs[Register.ST] - 1]
-                    self.memory.write(Segment.STACK, self.regs[Register.ST] - 1, 0)
-                    self.regs[Register.ST] -= 1
-                    
-            case Instructions.ADD:
-                op_type1 :Operand = Operand.from_value(self.read_pc_offset(1))
-                op_type2 :Operand = Operand.from_value(self.read_pc_offset(2))
-                op1 :int = self.read_pc_offset(3)
-                op2 :int = self.read_pc_offset(4)
-                if op_type1 == Operand.REGISTER:
-                    reg :Register = Register.from_index(op1)
-                    match op_type2:
-                        case Operand.ADDRESS | Operand.INTEGER:
-                            self.regs[reg] += op2
-                        case Operand.REGISTER:
-                            self.regs[reg] += self.regs[Register.from_index(op2)]
-                        case Operand.VALUE:
-                            location = self.symbol_map.get_symbol(self.symbol_map.get_symbol_name_from_index(op2))
-                            value = self.memory[Segment.DATA][location]
-                            self.regs[reg] += value
-            
-            case Instructions.SUB:
-                op_type1 :Operand = Operand.from_value(self.read_pc_offset(1))
-                op_type2 :Operand = Operand.from_value(self.read_pc_offset(2))
-                op1 :int = self.read_pc_offset(3)
-                op2 :int = self.read_pc_offset(4)
-                if op_type1 == Operand.REGISTER:
-                    reg :Register = Register.from_index(op1)
-                    match op_type2:
-                        case Operand.ADDRESS | Operand.INTEGER:
-                            self.regs[reg] -= op2
-                        case Operand.REGISTER:
-                            self.regs[reg] -= self.regs[Register.from_index(op2)]
-                        case Operand.VALUE:
-                            location = self.symbol_map.get_symbol(self.symbol_map.get_symbol_name_from_index(op2))
-                            value = self.memory[Segment.DATA][location]
-                            self.regs[reg] -= value
-                        
-            case Instructions.CALL:
-                op_type1 :Operand = Operand.from_value(self.read_pc_offset(1))
-                op1 = self.read_pc_offset(2)
-                if op_type1 == Operand.SYMBOL:
-                    location = self.symbol_map.get_symbol(self.symbol_map.get_symbol_name_from_index(op1))
-                    # begin a new stack frame
-                    self.memory.write(Segment.STACK, self.regs[Register.ST], self.regs[Register.PC] + Instructions.CALL.value.size) # save return address
-                    self.regs[Register.ST] += 1 # increase ST (aka simulate PUSH instruction)
-                    self.regs[Register.PC] = location
-                    self.regs[Register.AR] = self.regs[Register.PC] # = POP AR
-                return # skip the addition
-
-            case Instructions.ASSERT:
-                op_type1 :Operand = Operand.from_value(self.read_pc_offset(1))
-                op_type2 :Operand = Operand.from_value(self.read_pc_offset(2))
-                dbg(op_type2.name)
-                op1 :int = self.read_pc_offset(3)
-                op2 :int = self.read_pc_offset(4)
-                if op_type1 == Operand.REGISTER:
-                    reg :Register = Register.from_index(op1)
-                    match op_type2:
-                        case Operand.ADDRESS | Operand.INTEGER:
-                            assert self.regs[reg] == op2, (f"{reg.name} is not equal to {op2}")
-                        case Operand.REGISTER:
-                            assert self.regs[reg] == self.regs[Register.from_index(op2)], (f"{reg.name} is not equal to {Register.from_index(op2).name} which is {self.regs[Register.from_index(op2)]}")
-                        case Operand.VALUE:
-                            location = self.symbol_map.get_symbol(self.symbol_map.get_symbol_name_from_index(op2))
-                            value = self.memory[Segment.DATA][location]
-                            assert self.regs[reg] == value, (f"{reg.name} is not equal to symbol {self.symbol_map.get_symbol_name_from_index(op2)} value {value}")
-                
-        if not self.is_halted:
-            self.regs[Register.PC] += (instruction.value.size)
-            self.regs[Register.AR] = self.regs[Register.PC]
+        Args:
+            address (int): location of the opcode inside the code segment
+        """
+        decoded = self.decode_cache.get(address)
+        if decoded is not None:
+            return decoded
+        decoded = decode_instruction(self.memory.code, address)
+        if self.decode_hook is not None:
+            decoded = self.decode_hook(address, decoded)
+        self.decode_cache[address] = decoded
+        return decoded
+    
+    def invalidate(self, index :int, size :int):
+        """Drop every cached instruction overlapping the written range [index, index+size)
+        """
+        for address in range(index - MAX_INSTRUCTION_SIZE + 1, index + size):
+            decoded = self.decode_cache.get(address)
+            if decoded is not None and address + decoded.size > index:
+                del self.decode_cache[address]
+    
+    def execute(self, decoded :DecodedInstruction):
+        decoded.handler(self, decoded)
+    
+    def step(self):
+        address :int = self.regs[Register.AR]
+        if log.enabled:
+            log.debug("Executing instruction %d at address %d", self.memory.code[address], address)
+        self.execute(self.decode(address))
     
     def cycle(self):
+        # the profiler and the translator run their own loops, the debug trace only replaces the interpreter one
+        if self.profiler is not None:
+            self.profiler.run(None)
+            return
+        if self.translator is not None:
+            self.run_translated(None)
+            return
+        # the trace is checked once here, the loop below never looks at the logger
+        if log.enabled:
+            while not self.is_halted:
+                self.step()
+            return
+        regs = self.regs.regs
+        decode_cache = self.decode_cache
         while not self.is_halted:
-            inst :int = self.memory[Segment.CODE][self.regs[Register.AR]]
-            dbg(f"Executing instruction {inst} at address {self.regs[Register.AR]}")
-            inst :Enum[Instruction] = Instructions.from_index(inst)
-            self.execute(inst)
+            address :int = regs[Register.AR.value]
+            decoded = decode_cache.get(address)
+            if decoded is None:
+                decoded = self.decode(address)
+            decoded.handler(self, decoded)
             
-    def debug(self):
-        while input("stop ? ") != "stop":
-            if self.is_halted:
-                break
-            inst :int = self.memory[Segment.CODE][self.regs[Register.AR]]
-            dbg(f"Executing instruction {inst} at address {self.regs[Register.AR]}")
-            inst :Enum[Instruction] = Instructions.from_index(inst)
-            self.execute(inst)
+    def run(self, budget :int) -> int:
+        """Execute at most budget instructions, stops earlier if the cpu halts
+
+        Returns:
+            The number of executed instructions
+        """
+        if self.profiler is not None:
+            return self.profiler.run(budget)
+        if self.translator is not None:
+            return self.run_translated(budget)
+        return self.interpret(budget)
+    
+    def interpret(self, budget :int) -> int:
+        """Execute at most budget instructions with the handlers only, even if there is a translator
+        """
+        regs = self.regs.regs
+        decode_cache = self.decode_cache
+        executed :int = 0
+        while executed < budget and not self.is_halted:
+            address :int = regs[Register.AR.value]
+            decoded = decode_cache.get(address)
+            if decoded is None:
+                decoded = self.decode(address)
+            decoded.handler(self, decoded)
+            executed += 1
+        return executed
+    
+    def run_translated(self, budget :int | None) -> int:
+        """Execute translated blocks, falling back to the handlers where there is no block
+        and when a block would go past the budget
+
+        Returns:
+            The number of executed instructions
+        """
+        regs = self.regs.regs
+        blocks = self.translator.blocks
+        translate = self.translator.translate
+        decode_cache = self.decode_cache
+        AR :int = Register.AR.value
+        executed :int = 0
+        while not self.is_halted and (budget is None or executed < budget):
+            address :int = regs[AR]
+            block = blocks.get(address)
+            if block is None and address not in blocks:
+                block = translate(address)
+            if block is not None:
+                if budget is not None and executed + block.count > budget:
+                    # the budget ends inside the block, translating the rest of it from every address would be wasted
+                    return executed + self.interpret(budget - executed)
+                block.function(self)
+                executed += block.count
+                continue
+            decoded = decode_cache.get(address)
+            if decoded is None:
+                decoded = self.decode(address)
+            decoded.handler(self, decoded)
+            executed += 1
+        return executed
             
+    def snapshot(self) -> Snapshot:
+        """Take a copy on write snapshot of the registers, the flags and the memory, see Snapshot.py
+        """
+        if self.snapshots is None:
+            self.snapshots = Snapshots(self)
+        return self.snapshots.take()
+    
+    def restore(self, snapshot :Snapshot):
+        """Put the emulator back in the state of a snapshot taken with snapshot()
+        """
+        if self.snapshots is None:
+            raise ValueError("the snapshot was not taken on this emulator")
+        self.snapshots.restore(snapshot)
+            
+    def debug(self):
+        """Interactive debugger with breakpoints and watchpoints, see Debugger.py
+        """
+        # Debugger builds on this module
+        from Debugger import Debugger
+        Debugger(self).cli()
         print("================[DUMP]=========================")
-        for i,value in enumerate(self.regs):
+        for i,value in enumerate(self.regs.regs):
             reg :Register = Register.from_index(i)
             print(f"{reg.name} {value}")
-            
-        print("================[MEMORY DUMP]==================")
-        print(self.memory.hexdump(self.memory.code.memory, 16, 0, 0x30))
-        print(self.memory.hexdump(self.memory.data.memory, 16, 0, 10))
-        print(self.memory.hexdump(self.memory.stack.memory, 16, 0, 10))
-        print("Halt = Exiting")
-        exit()
         
         
         
@@ -184,14 +224,29 @@ import sys
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='OpenArchitecture Assembler', description="Assembler of an open architecture")
     parser.add_argument('filein', help="your microcode file which contains instructions")
+    parser.add_argument('--profile', metavar="FILE", help="run the program without the debugger, print the profile and write its collapsed stacks (flamegraph) to FILE")
     args = parser.parse_args(sys.argv[1:])
-    print("================[ASSEMBLER]====================")
-    assm :AssemblerV2 = AssemblerV2(args.filein)
-    emu :EmulatorV1 = EmulatorV1(assm)
+    if args.profile:
+        # the report is the output, the instruction trace would bury it
+        Dbg.set_debug(False)
+    with open(args.filein, "rb") as file:
+        is_image :bool = file.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC
+    if is_image:
+        emu :EmulatorV1 = EmulatorV1.from_image(args.filein, profile=bool(args.profile))
+    else:
+        print("================[ASSEMBLER]====================")
+        assm :AssemblerV2 = AssemblerV2(args.filein)
+        emu :EmulatorV1 = EmulatorV1(assm, profile=bool(args.profile))
     print("================[MEMORY DUMP]==================")
     print(emu.memory.hexdump(emu.memory.code.memory, 16, 0, 0x30))
     print(emu.memory.hexdump(emu.memory.data.memory, 16, 0, 10))
     print("================[Symbol Table]=================")
     emu.symbol_map.quick_dump()
     print("================[CPU START]====================")
-    emu.debug()
\ No newline at end of file
+    if args.profile:
+        emu.cycle()
+        print("================[PROFILE]======================")
+        print(emu.profiler.report(), end="")
+        emu.profiler.save_flamegraph(args.profile)
+    else:
+        emu.debug()
\ No newline at end of file
@@ -0,0 +1,224 @@
+from typing import List
+from Emulator import EmulatorV1
+from Dbg import get_logger
+import asyncio, heapq, itertools
+
+# Runs many emulators in one asyncio event loop. A session only takes scheduler time while a run() is pending,
+# idle sessions are a few objects and nothing else. The scheduler is a stride scheduler : every runnable session
+# has a pass value, the lowest one runs one quantum then moves forward by 1 / priority, so a priority 2 session
+# gets twice the turns of a priority 1 session and nobody starves. The event loop gets control back after every
+# quantum.
+
+log = get_logger("host")
+
+# instructions of a turn
+QUANTUM :int = 10_000
+
+class Session:
+    """An emulator hosted by a Host, create it with Host.add
+    """
+    def __init__(self, host :"Host", emu :EmulatorV1, priority :int, name :str) -> None:
+        self.host = host
+        self.emu = emu
+        self.priority = priority
+        self.name = name
+        # position of the session in the scheduler, in turns weighted by the priority
+        self.pass_value :float = 0.0
+        # instructions left to the pending run, None runs until the cpu halts
+        self.budget :int | None = None
+        # future of the pending run, resolved with the number of executed instructions
+        self.pending :asyncio.Future | None = None
+        # order of the scheduler entry of the pending run, older entries of the session are skipped
+        self.turn :int | None = None
+        self.executed :int = 0
+        self.instructions :int = 0
+
+    @property
+    def running(self) -> bool:
+        return self.pending is not None
+
+    async def run(self, budget :int | None = None) -> int:
+        return await self.host.run(self, budget)
+
+    async def step(self, count :int = 1) -> int:
+        return await self.host.run(self, count)
+
+    async def halt(self) -> int:
+        return await self.host.halt(self)
+
+    def __repr__(self) -> str:
+        return f"Session({self.name}, priority={self.priority}, instructions={self.instructions})"
+
+class Host:
+    def __init__(self, quantum :int = QUANTUM) -> None:
+        """Interleave emulators in the running asyncio event loop
+
+        Args:
+            quantum (int, optional): instructions a session runs before the next one gets its turn
+        """
+        self.quantum = quantum
+        self.sessions :List[Session] = []
+        # (pass value, order, session) of the sessions with a pending run
+        self.runnable :List = []
+        self.order = itertools.count()
+        # pass value of the last turn, new runs start from it and not from 0
+        self.virtual_time :float = 0.0
+        self.wakeup :asyncio.Event | None = None
+        self.task :asyncio.Task | None = None
+
+    def add(self, emu :EmulatorV1, priority :int = 1, name :str | None = None) -> Session:
+        """Host an emulator, it does not run until Session.run is awaited
+
+        Args:
+            priority (int, optional): share of the cpu, a priority 2 session gets twice the turns of a priority 1 one
+        """
+        if priority < 1:
+            raise ValueError("the priority must be at least 1")
+        session :Session = Session(self, emu, priority, name or f"session{len(self.sessions)}")
+        self.sessions.append(session)
+        return session
+
+    def remove(self, session :Session):
+        """Stop hosting a session, a pending run ends with what it executed
+        """
+        self._stop(session)
+        self.sessions.remove(session)
+
+    def _start(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._schedule())
+
+    async def run(self, session :Session, budget :int | None = None) -> int:
+        """Run a session until its cpu halts or it executed budget instructions
+
+        Returns:
+            The number of executed instructions
+        """
+        if session.pending is not None:
+            raise ValueError(f"{session.name} is already running")
+        if (budget is not None and budget <= 0) or session.emu.is_halted:
+            return 0
+        self._start()
+        pending :asyncio.Future = asyncio.get_running_loop().create_future()
+        session.pending = pending
+        session.budget = budget
+        session.executed = 0
+        # a session that was idle must not get the turns it did not use
+        session.pass_value = max(session.pass_value, self.virtual_time)
+        self._push(session)
+        self.wakeup.set()
+        try:
+            return await pending
+        except asyncio.CancelledError:
+            # the caller gave up the run, the session is parked until the next one
+            if session.pending is pending:
+                session.pending = None
+            raise
+
+    def _push(self, session :Session):
+        session.turn = next(self.order)
+        heapq.heappush(self.runnable, (session.pass_value, session.turn, session))
+
+    async def halt(self, session :Session) -> int:
+        """Halt the cpu of a session, a pending run ends with what it executed
+
+        Returns:
+            The number of instructions executed by the run that was pending, once its caller has it
+        """
+        pending :asyncio.Future | None = session.pending
+        self._stop(session)
+        if pending is not None:
+            # the awaiting run gets its result before the halt returns
+            await asyncio.sleep(0)
+        return session.executed
+
+    def _stop(self, session :Session):
+        session.emu.is_halted = True
+        self._finish(session)
+
+    def _finish(self, session :Session, error :BaseException | None = None):
+        if session.pending is None:
+            return
+        if not session.pending.done():
+            if error is not None:
+                session.pending.set_exception(error)
+            else:
+                session.pending.set_result(session.executed)
+        session.pending = None
+
+    async def _schedule(self):
+        while True:
+            if not self.runnable:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            pass_value, order, session = heapq.heappop(self.runnable)
+            if session.pending is None or order != session.turn:
+                # halted, removed or cancelled while waiting for its turn
+                continue
+            if session.pending.done():
+                # the awaiting task was cancelled before it could park the session
+                session.pending = None
+                continue
+            self.virtual_time = pass_value
+            budget :int = self.quantum if session.budget is None else min(self.quantum, session.budget - session.executed)
+            try:
+                executed :int = session.emu.run(budget)
+            except Exception as e:
+                # failed ASSERT or a fault, the session run gets it
+                log.debug("%s raised %s", session.name, e)
+                self._finish(session, e)
+            else:
+                session.executed += executed
+                session.instructions += executed
+                if session.emu.is_halted or (session.budget is not None and session.executed >= session.budget):
+                    self._finish(session)
+                else:
+                    session.pass_value = pass_value + 1 / session.priority
+                    self._push(session)
+            # let the other tasks of the loop run between two turns
+            await asyncio.sleep(0)
+
+    async def close(self):
+        """Stop the scheduler, the pending runs end with what they executed
+        """
+        for session in self.sessions:
+            self._finish(session)
+        self.runnable.clear()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+import argparse
+import sys
+import time
+if __name__ == "__main__":
+    from AssemblerV2 import AssemblerV2
+    import Dbg
+    Dbg.set_debug(False)
+    parser = argparse.ArgumentParser(prog='OpenArchitecture Host', description="Run many copies of a program in one event loop")
+    parser.add_argument('filein', help="your microcode file which contains instructions")
+    parser.add_argument('-n', '--sessions', type=int, default=100, help="number of emulators")
+    parser.add_argument('--budget', type=int, default=100_000, help="instructions each emulator runs at most")
+    parser.add_argument('--quantum', type=int, default=QUANTUM, help="instructions of a turn")
+    args = parser.parse_args(sys.argv[1:])
+
+    async def main():
+        host :Host = Host(args.quantum)
+        with open(args.filein, "r") as file:
+            source :str = file.read()
+        sessions :List[Session] = [host.add(EmulatorV1(AssemblerV2(source)), priority=1 + i % 2) for i in range(args.sessions)]
+        start :float = time.perf_counter()
+        results = await asyncio.gather(*(session.run(args.budget) for session in sessions), return_exceptions=True)
+        elapsed :float = time.perf_counter() - start
+        await host.close()
+        total :int = sum(session.instructions for session in sessions)
+        failed :int = sum(isinstance(result, BaseException) for result in results)
+        print(f"{len(sessions)} sessions, {total} instructions in {elapsed:.2f}s ({total / elapsed:,.0f}/s), {failed} failed")
+
+    asyncio.run(main())
@@ -0,0 +1,176 @@
+from typing import List, Dict
+from CPU import Symbol, Operand
+from Memory import Memory, Stack, DataSegment, CodeSegment, ArraySegment, word_typecode, file_mapping, anonymous_mapping, map_file_over
+from SymbolMap import SymbolMap, Relocation
+from Dbg import get_logger
+from array import array
+import struct, json, sys, mmap
+
+# OpenArchitecture executable image, every field and every word is little endian
+#
+#   header       HEADER, see the field list below
+#   code         the code_used first words of the code segment
+#   data         the data_used first words of the data segment
+#   symbols      symbol_count * (SYMBOL record + name)
+#   relocations  relocation_count * RELOCATION records
+#   metadata     json object
+#
+# The code and data sections start on a SECTION_ALIGNMENT boundary and hold the raw words of the segments, the
+# loader maps their pages over the start of the segments and nothing is parsed. The header keeps the logical size of
+# every segment, the sections only hold the used words so the image of a paged program (segments covering the whole
+# address space) is as small as the program.
+
+log = get_logger("image")
+
+IMAGE_MAGIC :bytes = b"OAIM"
+# images of another version are refused, the images written during development included
+IMAGE_VERSION :int = 4
+
+# magic, version, word size, stack size, data size, code size, code used, data used,
+# code offset, data offset, symbols offset, symbol count, relocations offset, relocation count, metadata offset, metadata size
+HEADER = struct.Struct("<4sHH13Q")
+MAGIC = struct.Struct("<4sH")
+# type, flags, name length, location, size
+SYMBOL = struct.Struct("<BBHQI")
+# location of the symbols that do not have one yet, the extern symbols of an object
+NO_LOCATION :int = 2**64 - 1
+# offset, symbol id, operand kind
+RELOCATION = struct.Struct("<IIB3x")
+
+# symbol flags : defined by another module, usable by other modules
+SYMBOL_EXTERN :int = 1 << 0
+SYMBOL_GLOBAL :int = 1 << 1
+
+# start of the code and data sections, a page so they can be mapped
+SECTION_ALIGNMENT :int = 4096
+
+def _align(offset :int, alignment :int = 8) -> int:
+    return (offset + alignment - 1) & ~(alignment - 1)
+
+def _little_endian(segment :ArraySegment, used :int) -> memoryview:
+    words = segment.view[:used]
+    if sys.byteorder == "big":
+        words = array(segment.typecode, words)
+        words.byteswap()
+    return memoryview(words).cast("B")
+
+def _load_section(size :int, word_size :int, fileno :int, view :memoryview, offset :int, used :int) -> memoryview:
+    """An anonymous mapping of size words, the used words of the section at offset mapped over its start
+    """
+    mapping = anonymous_mapping(size * word_size)
+    if sys.byteorder == "little" and SECTION_ALIGNMENT % mmap.PAGESIZE == 0 and map_file_over(mapping, fileno, used * word_size, offset):
+        return memoryview(mapping)
+    # the file can not be mapped here, the words are copied
+    words :array = array(word_typecode(word_size))
+    words.frombytes(view[offset:offset + used * word_size])
+    if sys.byteorder == "big":
+        words.byteswap()
+    memoryview(mapping).cast(words.typecode)[:used] = words
+    return memoryview(mapping)
+
+class Image:
+    """An executable loaded from disk, it can be given to EmulatorV1 in place of an assembler
+    """
+    def __init__(self, memory :Memory, symbol_map :SymbolMap, relocations :Dict[int, Relocation], metadata :Dict) -> None:
+        self.memory = memory
+        self.symbol_map = symbol_map
+        self.relocations = relocations
+        self.metadata = metadata
+
+def write_image(path :str, memory :Memory, symbol_map :SymbolMap, relocations :Dict[int, Relocation], metadata :Dict | None = None, flags :Dict[str, int] | None = None):
+    """Write an executable image
+
+    Args:
+        path (str): output file
+        memory (Memory): the assembled memory, stack content is not saved
+        symbol_map (SymbolMap): the symbols
+        relocations (Dict[int, Relocation]): the relocation table of the code segment
+        metadata (Dict, optional): anything json serializable
+        flags (Dict[str, int], optional): symbol name -> SYMBOL_* flags
+    """
+    flags = flags or {}
+    symbols :bytes = b"".join(
+        SYMBOL.pack(entry.type.value, flags.get(entry.name, 0), len(name), NO_LOCATION if entry.location < 0 else entry.location, entry.size) + name
+        for entry, name in ((entry, entry.name.encode()) for entry in symbol_map.symbols))
+    relocation_table :bytes = b"".join(RELOCATION.pack(r.offset, r.symbol, r.kind.value) for r in relocations.values())
+    meta :bytes = json.dumps(metadata or {}).encode()
+
+    code_used :int = memory.code.used_size()
+    data_used :int = memory.data.used_size()
+    code_offset :int = _align(HEADER.size, SECTION_ALIGNMENT)
+    data_offset :int = _align(code_offset + code_used * memory.word_size, SECTION_ALIGNMENT)
+    # the last page of the data section is mapped whole, it ends with zeros and not with the symbols
+    symbols_offset :int = _align(data_offset + data_used * memory.word_size, SECTION_ALIGNMENT)
+    relocations_offset :int = _align(symbols_offset + len(symbols))
+    metadata_offset :int = relocations_offset + len(relocation_table)
+
+    header :bytes = HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, memory.word_size,
+                                memory.stack.size, memory.data.size, memory.code.size,
+                                code_used, data_used,
+                                code_offset, data_offset, symbols_offset, len(symbol_map.symbols),
+                                relocations_offset, len(relocations), metadata_offset, len(meta))
+    # only the used words are written, the loader gives back the rest of the segments as zeros
+    code :memoryview = _little_endian(memory.code, code_used)
+    data :memoryview = _little_endian(memory.data, data_used)
+    with open(path, "wb") as file:
+        for offset, section in ((0, header), (code_offset, code), (data_offset, data),
+                                (symbols_offset, symbols), (relocations_offset, relocation_table), (metadata_offset, meta)):
+            file.seek(offset)
+            file.write(section)
+        file.truncate()
+
+def load_image(path :str) -> Image:
+    """Map an executable image. The code and data segments are anonymous mappings of their logical size with the pages
+    of their section of the file mapped copy on write over their start, the untouched pages cost nothing
+
+    Raises:
+        ValueError: the file is not an image or has another version
+    """
+    with open(path, "rb") as file:
+        mapping = file_mapping(file.fileno(), 0)
+        if len(mapping) < MAGIC.size:
+            raise ValueError(f"{path} is not an OpenArchitecture image")
+        magic, version = MAGIC.unpack_from(mapping, 0)
+        if magic != IMAGE_MAGIC:
+            raise ValueError(f"{path} is not an OpenArchitecture image")
+        if version != IMAGE_VERSION:
+            raise ValueError(f"{path} has image version {version}, only version {IMAGE_VERSION} is supported")
+        if len(mapping) < HEADER.size:
+            raise ValueError(f"{path} is not an OpenArchitecture image")
+        (magic, version, word_size, stack_size, data_size, code_size, code_used, data_used,
+         code_offset, data_offset, symbols_offset, symbol_count,
+         relocations_offset, relocation_count, metadata_offset, metadata_size) = HEADER.unpack_from(mapping, 0)
+
+        view :memoryview = memoryview(mapping)
+        code :CodeSegment = CodeSegment.from_buffer(_load_section(code_size, word_size, file.fileno(), view, code_offset, code_used), word_size)
+        data :DataSegment = DataSegment.from_buffer(_load_section(data_size, word_size, file.fileno(), view, data_offset, data_used), word_size)
+    # the allocator only needs to know what is already in use
+    for segment, used in ((code, code_used), (data, data_used)):
+        if used:
+            segment.alloc(used)
+    # the stack is not in the image, a paged one only costs the pages the program uses
+    memory :Memory = Memory.from_segments(Stack.paged(stack_size, word_size), data, code)
+
+    symbol_map :SymbolMap = SymbolMap(memory)
+    symbol_flags :Dict[str, int] = {}
+    offset :int = symbols_offset
+    for i in range(symbol_count):
+        typ, flags, length, location, size = SYMBOL.unpack_from(mapping, offset)
+        if location == NO_LOCATION:
+            location = -1
+        offset += SYMBOL.size
+        name :str = bytes(view[offset:offset + length]).decode()
+        offset += length
+        symbol_map._declare(Symbol(typ), name, location, size)
+        if flags:
+            symbol_flags[name] = flags
+
+    relocations :Dict[int, Relocation] = {}
+    for position, symbol, kind in RELOCATION.iter_unpack(view[relocations_offset:relocations_offset + relocation_count * RELOCATION.size]):
+        relocations[position] = Relocation(position, symbol, Operand(kind))
+
+    metadata :Dict = json.loads(bytes(view[metadata_offset:metadata_offset + metadata_size]) or b"{}")
+    if symbol_flags:
+        metadata["symbol_flags"] = symbol_flags
+    log.debug("loaded %s : %d symbols, %d relocations", path, symbol_count, relocation_count)
+    return Image(memory, symbol_map, relocations, metadata)
@@ -0,0 +1,146 @@
+from enum import Enum
+from typing import List, Dict
+from CPU import Register, Instructions, Symbol
+import sys
+
+class TokenKind(Enum):
+    MNEMONIC, REGISTER, INTEGER, VALUE, NAME, LABEL, DIRECTIVE, STRING = range(0, 8)
+
+class Token:
+    """A typed token of a source line
+
+    value depends on the kind : the opcode of a MNEMONIC, the index of a REGISTER, the number of an INTEGER,
+    the Symbol type of a DIRECTIVE, the interned symbol name (without [] or :) of a VALUE, NAME or LABEL, the
+    unescaped text of a STRING ("..." literal) or None if its closing quote is missing.
+    """
+    __slots__ = ("kind", "text", "value", "line", "col")
+
+    def __init__(self, kind :TokenKind, text :str, value, line :int, col :int) -> None:
+        self.kind = kind
+        self.text = text
+        self.value = value
+        # line and column of the first character, both start at 1
+        self.line = line
+        self.col = col
+
+    @property
+    def end(self) -> int:
+        """Column right after the last character
+        """
+        return self.col + len(self.text)
+
+    def __repr__(self) -> str:
+        return f"Token({self.kind.name}, {self.text!r}, {self.value!r}, {self.line}:{self.col})"
+
+# lookup tables built once, the lexer never walks the enums
+# the members include the aliases (JE is JZ)
+MNEMONICS :Dict[str, int] = {name: tInst.index() for name, tInst in Instructions.__members__.items()}
+REGISTERS :Dict[str, int] = {tReg.name: tReg.index() for tReg in Register}
+DIRECTIVES :Dict[str, Symbol] = {"db": Symbol.BYTE, "ds": Symbol.SHORT, "di": Symbol.INTEGER, "dd": Symbol.DOUBLE, "dc": Symbol.STRING}
+
+def _integer(word :str) -> int | None:
+    if word.isdigit():
+        return int(word)
+    if word[:2] in ("0x", "0X"):
+        try:
+            return int(word[2:], 16)
+        except ValueError:
+            return None
+    return None
+
+# escape sequences of the string literals, \xHH gives the character of code HH
+ESCAPES :Dict[str, str] = {"n": "\n", "t": "\t", "r": "\r", "0": "\0", "\\": "\\", '"': '"'}
+
+def _string_end(line :str, quote :int) -> int:
+    """Get the index right after the closing quote of the literal opened at quote, -1 if it is not closed
+    """
+    i :int = quote + 1
+    while i < len(line):
+        if line[i] == "\\":
+            i += 2
+        elif line[i] == '"':
+            return i + 1
+        else:
+            i += 1
+    return -1
+
+def _unescape(text :str) -> str:
+    if "\\" not in text:
+        return text
+    chars :List[str] = []
+    i :int = 0
+    while i < len(text):
+        char :str = text[i]
+        if char == "\\" and i + 1 < len(text):
+            escape :str = text[i + 1]
+            digits :str = text[i + 2:i + 4]
+            if escape == "x" and len(digits) == 2 and _integer("0x" + digits) is not None:
+                chars.append(chr(_integer("0x" + digits)))
+                i += 4
+                continue
+            # an unknown escape is the character itself
+            chars.append(ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        chars.append(char)
+        i += 1
+    return "".join(chars)
+
+def mask_strings(line :str) -> str:
+    """Blank the inside of the string literals of a line, separators and comment marks in them are not seen
+    """
+    quote :int = line.find('"')
+    while quote >= 0:
+        end :int = _string_end(line, quote)
+        if end < 0:
+            return line[:quote + 1] + " " * (len(line) - quote - 1)
+        line = line[:quote + 1] + " " * (end - quote - 2) + line[end - 1:]
+        quote = line.find('"', end)
+    return line
+
+def lex_line(line :str, number :int = 0, column :int = 1) -> List[Token]:
+    """Split a line into typed tokens in a single pass
+
+    Args:
+        line (str): the line, without comments
+        number (int, optional): source line number, reported by the tokens
+        column (int, optional): source column of the first character of line
+    """
+    quote :int = line.find('"')
+    if quote >= 0:
+        # a string literal is a single token whatever it holds, the text around it is lexed as usual
+        tokens :List[Token] = lex_line(line[:quote], number, column)
+        end :int = _string_end(line, quote)
+        if end < 0:
+            tokens.append(Token(TokenKind.STRING, line[quote:], None, number, column + quote))
+            return tokens
+        tokens.append(Token(TokenKind.STRING, line[quote:end], _unescape(line[quote + 1:end - 1]), number, column + quote))
+        return tokens + lex_line(line[end:], number, column + end)
+    tokens :List[Token] = []
+    previous :TokenKind | None = None
+    # commas are separators like spaces, they never make a token
+    text :str = line.replace(",", " ")
+    position :int = 0
+    for word in text.split():
+        position = text.find(word, position)
+        col :int = column + position
+        position += len(word)
+        if previous is None and word in MNEMONICS:
+            token = Token(TokenKind.MNEMONIC, word, MNEMONICS[word], number, col)
+        elif word in REGISTERS:
+            token = Token(TokenKind.REGISTER, word, REGISTERS[word], number, col)
+        elif word[-1] == ":":
+            token = Token(TokenKind.LABEL, word, sys.intern(word[:-1]), number, col)
+        elif previous is TokenKind.LABEL and word in DIRECTIVES:
+            token = Token(TokenKind.DIRECTIVE, word, DIRECTIVES[word], number, col)
+        elif word[0] == "[" and word[-1] == "]":
+            token = Token(TokenKind.VALUE, word, sys.intern(word[1:-1]), number, col)
+        else:
+            value = _integer(word)
+            if value is not None:
+                token = Token(TokenKind.INTEGER, word, value, number, col)
+            else:
+                token = Token(TokenKind.NAME, word, sys.intern(word), number, col)
+        tokens.append(token)
+        previous = token.kind
+    return tokens
@@ -0,0 +1,224 @@
+from typing import List, Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from CPU import Symbol
+from Memory import Memory, Segment
+from SymbolMap import SymbolMap, Relocation
+from Image import Image, load_image, write_image, SYMBOL_EXTERN, SYMBOL_GLOBAL, IMAGE_VERSION
+from AssemblerV2 import AssemblerV2, ASSEMBLER_VERSION
+from Dbg import get_logger
+import os, pathlib, hashlib
+
+# Multi module builds. Every source is assembled on its own into an object, an executable image (Image.py) whose
+# symbols carry the SYMBOL_EXTERN and SYMBOL_GLOBAL flags :
+#
+#   extern print        ; a label of another module
+#   extern total di     ; a data symbol of another module
+#   global main, count  ; symbols of this module the others can use
+#
+# The objects are assembled by a process pool and kept in an object folder, an object is only assembled again when
+# its source, the assembler options, the assembler or the image format changed. The linker then places the code and
+# the data of every module one after the other, the first module first (the program starts at code location 0),
+# resolves the extern symbols to the global ones and rewrites every symbol operand from the relocation tables. The
+# symbols that are not global stay private to their module, they are renamed module:name in the program when their
+# name is already taken.
+
+log = get_logger("linker")
+
+# object file extension
+OBJECT_SUFFIX :str = ".oai"
+
+class LinkError(Exception):
+    """Every problem found while linking, duplicate and undefined symbols are all reported at once
+    """
+    def __init__(self, errors :List[str]) -> None:
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+    def __reduce__(self):
+        # raised by the workers, pickled with its list of errors and not its message
+        return LinkError, (self.errors,)
+
+def source_hash(source :bytes, optimize :bool = False) -> str:
+    # the same source assembles differently with the optimizer, another assembler or another image format
+    header :bytes = f"{IMAGE_VERSION}\n{ASSEMBLER_VERSION}\n{'-O' if optimize else ''}\n".encode()
+    return hashlib.sha256(header + source).hexdigest()
+
+def assemble_object(path :str, object_path :str, optimize :bool = False) -> bool:
+    """Assemble a module into an object file, unless the object is up to date. This is what the workers run
+
+    Raises:
+        LinkError: the assembler reported errors, no object is written
+    Returns:
+        True if the module was assembled, False if its object was reused
+    """
+    with open(path, "rb") as file:
+        digest :str = source_hash(file.read(), optimize)
+    if os.path.isfile(object_path):
+        try:
+            if load_image(object_path).metadata.get("hash") == digest:
+                return False
+        except ValueError:
+            log.warning("object %s is unreadable, assembling it again", object_path)
+    assembler :AssemblerV2 = AssemblerV2(path, optimize=optimize)
+    if assembler.errors:
+        raise LinkError(assembler.errors)
+    # write then rename, a failed build never leaves a half written object
+    temporary :str = f"{object_path}.{os.getpid()}.tmp"
+    assembler.save(temporary, {"hash": digest})
+    os.replace(temporary, object_path)
+    return True
+
+def link(objects :List[Tuple[str, Image]]) -> Image:
+    """Link objects into a single program
+
+    Args:
+        objects (List[Tuple[str, Image]]): (module name, object) in placement order
+    Raises:
+        LinkError: duplicate global symbols, undefined or mistyped extern symbols, or modules with different word sizes
+    Returns:
+        The program, give it to EmulatorV1 or write it with write_image
+    """
+    errors :List[str] = []
+    word_size :int = objects[0][1].memory.word_size
+    for name, image in objects[1:]:
+        if image.memory.word_size != word_size:
+            errors.append(f"{name} uses {image.memory.word_size} bytes words, {objects[0][0]} uses {word_size}")
+    if errors:
+        raise LinkError(errors)
+    # the segments of the program are as large as the largest module ones, or large enough for every module
+    sizes :List[int] = [max(max(image.memory[segment].size for name, image in objects),
+                            sum(image.memory[segment].used_size() for name, image in objects))
+                        for segment in (Segment.STACK, Segment.DATA, Segment.CODE)]
+    memory :Memory = Memory(*sizes, word_size)
+
+    # where the segments of every module go
+    bases :List[Tuple[int, int]] = []
+    for name, image in objects:
+        placed :List[int] = []
+        for segment in (Segment.CODE, Segment.DATA):
+            used :int = image.memory[segment].used_size()
+            if used == 0:
+                placed.append(0)
+                continue
+            placed.append(memory._alloc(segment, used))
+            memory.write_array(segment, placed[-1], image.memory[segment][0:used])
+        bases.append((placed[0], placed[1]))
+
+    # global symbol -> (module, entry) of its definition
+    globals_ :Dict[str, Tuple[str, object]] = {}
+    for name, image in objects:
+        flags :Dict[str, int] = image.metadata.get("symbol_flags", {})
+        for entry in image.symbol_map.symbols:
+            if flags.get(entry.name, 0) & SYMBOL_GLOBAL:
+                if entry.name in globals_:
+                    errors.append(f"duplicate symbol {entry.name} defined by {globals_[entry.name][0]} and {name}")
+                    continue
+                globals_[entry.name] = (name, entry)
+
+    symbol_map :SymbolMap = SymbolMap(memory)
+    # per module, symbol id in the object -> symbol id in the program
+    ids :List[Dict[int, int]] = [{} for name, image in objects]
+    for module, ((name, image), (code_base, data_base)) in enumerate(zip(objects, bases)):
+        flags :Dict[str, int] = image.metadata.get("symbol_flags", {})
+        for i, entry in enumerate(image.symbol_map.symbols):
+            if flags.get(entry.name, 0) & SYMBOL_EXTERN:
+                continue
+            program_name :str = entry.name
+            if not flags.get(entry.name, 0) & SYMBOL_GLOBAL and (entry.name in globals_ or symbol_map.has_symbol(entry.name)):
+                program_name = f"{name}:{entry.name}"
+            base :int = code_base if entry.type == Symbol.LABEL else data_base
+            symbol_map._declare(entry.type, program_name, entry.location + base, entry.size)
+            ids[module][i] = symbol_map.get_symbol_index(program_name)
+
+    # the extern symbols use the ids of the definitions
+    for module, (name, image) in enumerate(objects):
+        flags :Dict[str, int] = image.metadata.get("symbol_flags", {})
+        for i, entry in enumerate(image.symbol_map.symbols):
+            if not flags.get(entry.name, 0) & SYMBOL_EXTERN:
+                continue
+            definition = globals_.get(entry.name)
+            if definition is None:
+                errors.append(f"undefined reference to {entry.name} in {name}")
+                continue
+            if (entry.type == Symbol.LABEL) != (definition[1].type == Symbol.LABEL):
+                kinds :Tuple[str, str] = ("label", "data symbol") if entry.type == Symbol.LABEL else ("data symbol", "label")
+                errors.append(f"{entry.name} is used as a {kinds[0]} by {name} but is a {kinds[1]} of {definition[0]}")
+                continue
+            ids[module][i] = symbol_map.get_symbol_index(entry.name)
+    if errors:
+        raise LinkError(errors)
+
+    relocations :Dict[int, Relocation] = {}
+    code = memory.code
+    for module, ((name, image), (code_base, data_base)) in enumerate(zip(objects, bases)):
+        for offset, relocation in image.relocations.items():
+            symbol :int = ids[module][relocation.symbol]
+            relocations[offset + code_base] = Relocation(offset + code_base, symbol, relocation.kind)
+            code[offset + code_base] = symbol_map.symbols[symbol].location
+    log.debug("linked %d modules, %d symbols, %d relocations", len(objects), len(symbol_map.symbols), len(relocations))
+    return Image(memory, symbol_map, relocations, {"modules": [name for name, image in objects]})
+
+def module_name(path :str) -> str:
+    return pathlib.Path(path).stem
+
+def build(paths :List[str], object_dir :str, jobs :int | None = None, optimize :bool = False) -> Tuple[Image, List[str]]:
+    """Assemble the modules that changed in parallel, then link every module
+
+    Args:
+        paths (List[str]): the sources, the first one holds the entry point
+        object_dir (str): folder of the object files, name.oai for the module name.s
+        jobs (int, optional): worker processes, defaults to the number of cores
+    Raises:
+        ValueError: two sources have the same module name
+        LinkError: a module failed to assemble, or the modules do not link
+    Returns:
+        The program, and the names of the modules that were assembled again
+    """
+    names :List[str] = [module_name(path) for path in paths]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"module names must be unique, {', '.join(duplicates)} is used twice")
+    os.makedirs(object_dir, exist_ok=True)
+    object_paths :List[str] = [os.path.join(object_dir, name + OBJECT_SUFFIX) for name in names]
+    rebuilt :List[str] = []
+    errors :List[str] = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(assemble_object, path, object_path, optimize) for path, object_path in zip(paths, object_paths)]
+        for name, future in zip(names, futures):
+            try:
+                if future.result():
+                    rebuilt.append(name)
+            except SystemExit:
+                # the assembler prints the error and exits, the worker gives the exit back to us
+                errors.append(f"{name} failed to assemble")
+            except LinkError as e:
+                # the errors the assembler reported and went on
+                errors.append(f"{name} failed to assemble : {e}")
+    if errors:
+        raise LinkError(errors)
+    log.debug("%d of %d modules assembled", len(rebuilt), len(paths))
+    return link([(name, load_image(path)) for name, path in zip(names, object_paths)]), rebuilt
+
+import argparse
+import sys
+if __name__ == "__main__":
+    import Dbg
+    Dbg.set_debug(False)
+    parser = argparse.ArgumentParser(prog='OpenArchitecture Linker', description="Assemble modules in parallel and link them into one program")
+    parser.add_argument('sources', nargs='+', help="the modules, the first one holds the entry point")
+    parser.add_argument('-o', '--output', required=True, help="write the executable image to this file")
+    parser.add_argument('--objects', default="build", help="folder of the object files, unchanged modules are not assembled again")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes, defaults to the number of cores")
+    parser.add_argument('-O', '--optimize', action='store_true', help="run the peephole optimizer on every module")
+    args = parser.parse_args(sys.argv[1:])
+    try:
+        program, rebuilt = build(args.sources, args.objects, args.jobs, args.optimize)
+    except LinkError as e:
+        for error in e.errors:
+            print(f"error : {error}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"error : {e}")
+        sys.exit(1)
+    write_image(args.output, program.memory, program.symbol_map, program.relocations, program.metadata)
+    print(f"{len(args.sources)} modules, {len(rebuilt)} assembled : {', '.join(rebuilt) or 'none'}")
@@ -1,149 +1,275 @@
-from typing import List, Dict
+from typing import List, Dict, Callable
+from array import array
 from enum import Enum
 from Dbg import dbg, dbgassert
+from MemoryV2 import MemorySegment, MemoryBlockState, AllocPolicy
+import mmap, sys, contextlib, ctypes
 
 class Segment(Enum):
     STACK,DATA,CODE = range(0,3)
 
-# A stack is just a special memory that can hold frames and local variables
-class Stack:
-    def __init__(self, size :int):
+def word_typecode(word_size :int) -> str:
+    """Get the array typecode storing unsigned words of word_size bytes
+    """
+    for typecode in "BHILQ":
+        if array(typecode).itemsize == word_size:
+            return typecode
+    raise ValueError(f"Unsupported word size {word_size}")
+
+# words of every segment of a paged memory, the whole range the 32 bits registers can address
+ADDRESS_SPACE :int = 2**32
+
+# the kernel gives pages to a mapping on their first write, without reserving them it refuses mappings bigger than the ram
+MAP_NORESERVE :int = getattr(mmap, "MAP_NORESERVE", 0x4000 if sys.platform.startswith("linux") else 0)
+
+def anonymous_mapping(size :int) -> mmap.mmap:
+    """Map size bytes of zeroed memory, the pages are only allocated when they are first written
+    """
+    if sys.platform == "win32":
+        return mmap.mmap(-1, size)
+    return mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | MAP_NORESERVE)
+
+def file_mapping(fileno :int, size :int, offset :int = 0, shared :bool = False) -> mmap.mmap:
+    """Map size bytes of an open file from offset (a multiple of mmap.ALLOCATIONGRANULARITY), 0 maps up to its end.
+    A private mapping is copy on write, its changes never reach the file
+    """
+    if sys.platform == "win32":
+        return mmap.mmap(fileno, size, offset=offset, access=mmap.ACCESS_WRITE if shared else mmap.ACCESS_COPY)
+    flags :int = mmap.MAP_SHARED if shared else mmap.MAP_PRIVATE | MAP_NORESERVE
+    return mmap.mmap(fileno, size, flags=flags, prot=mmap.PROT_READ | mmap.PROT_WRITE, offset=offset)
+
+# python mmap objects can not map a file over part of another mapping, the mmap of the C library can
+MAP_FIXED :int = getattr(mmap, "MAP_FIXED", 0x10)
+try:
+    _libc = None if sys.platform == "win32" else ctypes.CDLL(None, use_errno=True)
+    _libc.mmap.restype = ctypes.c_void_p
+    _libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long)
+except (OSError, AttributeError):
+    _libc = None
+
+def map_file_over(mapping :mmap.mmap, fileno :int, size :int, offset :int) -> bool:
+    """Map size bytes of an open file from offset (a multiple of mmap.PAGESIZE) over the start of a mapping. Like a
+    private file_mapping the pages are read when first accessed and are copy on write, the rest of the mapping is unchanged
+
+    Raises:
+        ValueError: size is larger than the mapping
+    Returns:
+        False where a file can not be mapped over a mapping (windows) or offset is not on a page, copy the bytes instead
+    """
+    if size > len(mapping):
+        raise ValueError(f"can not map {size} bytes over a mapping of {len(mapping)} bytes")
+    if _libc is None or offset % mmap.PAGESIZE:
+        return False
+    if size == 0:
+        return True
+    # the mapping covers whole pages, the bytes of the file past size are mapped too
+    size = -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+    anchor = ctypes.c_char.from_buffer(mapping)
+    address :int = ctypes.addressof(anchor)
+    del anchor
+    if _libc.mmap(address, size, mmap.PROT_READ | mmap.PROT_WRITE, mmap.MAP_PRIVATE | MAP_FIXED | MAP_NORESERVE, fileno, offset) != address:
+        raise OSError(ctypes.get_errno(), "failed to map the file over the mapping")
+    return True
+
+class ArraySegment(MemorySegment):
+    """A segment stored in a contiguous typed buffer of unsigned words, allocation is done by the MemorySegment blocks
+    """
+    def __init__(self, size :int, word_size :int = 4):
         self.size = size
-        self.memory : List[int] = [0 for i in range(0, size)]
+        self.word_size = word_size
+        self.typecode :str = word_typecode(word_size)
+        # values are wrapped to the word size like registers are wrapped to 32 bits
+        self.mask :int = (1 << (8 * word_size)) - 1
+        self.memory :array = array(self.typecode, bytes(size * word_size))
+        self.view :memoryview = memoryview(self.memory)
+        # called with (index, size) before every write, the old words can still be read
+        self.write_hooks :List[Callable[[int, int], None]] = []
+        self.init_blocks()
     
-    def __getitem__(self, index :int | slice):
-        if isinstance(index, slice):
-            if (index.step and index.step > 1):
-                raise IndexError()
-            if (index.start >= 0 and index.stop < self.size):
-                return self.memory[index]
-            else:
-                raise IndexError()
-        elif isinstance(index, int):
-            if (index >= 0 and index < self.size):
-                return self.memory[index]
-            else:
-                raise IndexError()
-        else:
-            raise IndexError()
+    @classmethod
+    def from_buffer(cls, buffer, word_size :int = 4) -> "ArraySegment":
+        """Create a segment working directly on a writable buffer (mmap, shared memory...), nothing is copied
+
+        Args:
+            buffer: any writable buffer, its length must be a multiple of word_size
+            word_size (int, optional): size of a word in bytes. Defaults to 4.
+        """
+        segment :ArraySegment = cls.__new__(cls)
+        segment.word_size = word_size
+        segment.typecode = word_typecode(word_size)
+        segment.mask = (1 << (8 * word_size)) - 1
+        segment.memory = memoryview(buffer).cast("B").cast(segment.typecode)
+        segment.view = segment.memory
+        segment.size = len(segment.memory)
+        segment.write_hooks = []
+        segment.init_blocks()
+        return segment
     
-    def __setitem__(self, index :int, value :int):
-        if (index >= 0 and index < self.size):
-            self.memory[index] = value
-        else:
+    @classmethod
+    def paged(cls, size :int, word_size :int = 4) -> "ArraySegment":
+        """Create a segment over an anonymous mapping, an untouched page costs nothing so size can be the whole address space
+        """
+        return cls.from_buffer(anonymous_mapping(size * word_size), word_size)
+
+    @classmethod
+    def map_file(cls, path :str, offset :int = 0, size :int | None = None, word_size :int = 4, shared :bool = False) -> "ArraySegment":
+        """Create a segment over a region of a file, the pages are read when they are first accessed
+
+        Args:
+            path (str): the file
+            offset (int, optional): start of the region in bytes
+            size (int, optional): words of the region, up to the end of the file by default
+            shared (bool, optional): write the changes back to the file, by default they stay private to the segment
+        """
+        with open(path, "r+b" if shared else "rb") as file:
+            file.seek(0, 2)
+            length :int = file.tell() - offset
+            if size is not None:
+                length = size * word_size
+            # a mapping starts on an allocation granularity boundary, the segment starts inside it
+            start :int = offset - offset % mmap.ALLOCATIONGRANULARITY
+            mapping = file_mapping(file.fileno(), length + offset - start, start, shared)
+        return cls.from_buffer(memoryview(mapping)[offset - start:offset - start + length - length % word_size], word_size)
+
+    def __getstate__(self) -> dict:
+        # views and hooks belong to a running process, they are rebuilt when unpickling
+        state :dict = self.__dict__.copy()
+        del state["view"]
+        state["write_hooks"] = []
+        return state
+    
+    def __setstate__(self, state :dict):
+        self.__dict__.update(state)
+        self.view = memoryview(self.memory)
+    
+    def _check_slice(self, index :slice) -> slice:
+        if (index.step and index.step > 1):
             raise IndexError()
-            
-        
-class DataSegment:
-    def __init__(self, size :int):
-        self.size = size
-        self.memory :List[int] = [0 for i in range(0, size)]
-        
+        start :int = 0 if index.start is None else index.start
+        stop :int = self.size if index.stop is None else index.stop
+        if (start >= 0 and stop <= self.size):
+            return slice(start, stop)
+        raise IndexError()
+    
     def __getitem__(self, index :int | slice):
-        if isinstance(index, slice):
-            if (index.step and index.step > 1):
-                raise IndexError()
-            if (index.start >= 0 and index.stop < self.size):
-                return self.memory[index]
-            else:
-                raise IndexError()
-        elif isinstance(index, int):
-            if (index >= 0 and index < self.size):
-                return self.memory[index]
-            else:
-                raise IndexError()
-        else:
+        # slices are memoryviews over the segment, nothing is copied
+        if index.__class__ is slice:
+            return self.view[self._check_slice(index)]
+        if index < 0:
             raise IndexError()
+        return self.memory[index]
     
-    def __setitem__(self, index :int, value :int):
-        if (index >= 0 and index < self.size):
-            self.memory[index] = value
-        else:
+    def __setitem__(self, index :int | slice, value :int):
+        if index.__class__ is slice:
+            index = self._check_slice(index)
+            self.write_array(index.start, value)
+            return
+        if index < 0:
             raise IndexError()
-
-class CodeSegment:
-    def __init__(self, size :int):
-        self.size = size
-        self.memory :List[int] = [0 for i in range(0, size)]
+        if self.write_hooks:
+            for hook in self.write_hooks:
+                hook(index, 1)
+        self.memory[index] = value & self.mask
     
-    def __getitem__(self, index :int | slice):
-        if isinstance(index, slice):
-            if (index.step and index.step > 1):
-                raise IndexError()
-            if (index.start >= 0 and index.stop < self.size):
-                return self.memory[index]
-            else:
-                raise IndexError()
-        elif isinstance(index, int):
-            if (index >= 0 and index < self.size):
-                return self.memory[index]
-            else:
-                raise IndexError()
-        else:
-            raise IndexError()
+    def read_array(self, index :int, size :int) -> memoryview:
+        return self[index:index + size]
     
-    def __setitem__(self, index :int, value :int):
-        if (index >= 0 and index < self.size):
-            self.memory[index] = value
-        else:
+    def write_array(self, index :int, values :List[int] | array | memoryview):
+        """Write values from index in one slice assignment, buffers of the same word size are not copied
+        """
+        size :int = len(values)
+        if index < 0 or index + size > self.size:
             raise IndexError()
+        if isinstance(values, array):
+            same_words :bool = values.typecode == self.typecode
+        elif isinstance(values, memoryview):
+            same_words :bool = values.format == self.typecode
+        else:
+            same_words :bool = False
+        if not same_words:
+            values = array(self.typecode, [value & self.mask for value in values])
+        if self.write_hooks:
+            for hook in self.write_hooks:
+                hook(index, size)
+        self.view[index:index + size] = values
+
+    def move(self, index :int, newindex :int, size :int):
+        self.write_array(newindex, self.memory[index:index + size])
+
+# A stack is just a special memory that can hold frames and local variables
+class Stack(ArraySegment):
+    pass
+        
+class DataSegment(ArraySegment):
+    pass
+
+class CodeSegment(ArraySegment):
+    pass
+
+# lock of the atomic instructions of a memory used by a single cpu
+NO_LOCK = contextlib.nullcontext()
 
 class Memory:
-    def __init__(self, stack_size :int = 256, data_size :int = 1024, code_size :int = 4096) -> None:        
-        self.stack = Stack(stack_size)
-        self.data = DataSegment(data_size)
-        self.code = CodeSegment(code_size)
-        self.stack_selector = 0
-        self.data_selector = 0
-        self.code_selector = 0
+    def __init__(self, stack_size :int = 256, data_size :int = 1024, code_size :int = 4096, word_size :int = 4, paged :bool = False) -> None:
+        """Create the three segments
+
+        Args:
+            paged (bool, optional): build the segments over anonymous mappings, the pages are allocated on their first
+                write so the sizes can be as big as ADDRESS_SPACE while a small program only pays for what it touches
+        """
+        self.word_size = word_size
+        if paged:
+            self.stack = Stack.paged(stack_size, word_size)
+            self.data = DataSegment.paged(data_size, word_size)
+            self.code = CodeSegment.paged(code_size, word_size)
+        else:
+            self.stack = Stack(stack_size, word_size)
+            self.data = DataSegment(data_size, word_size)
+            self.code = CodeSegment(code_size, word_size)
+        self.segments :tuple = (self.stack, self.data, self.code)
+        # the atomic instructions hold locks[location % len(locks)] around their read-modify-write of a data word,
+        # a memory shared by several processes gets real locks (MultiCore.py)
+        self.locks :tuple = (NO_LOCK,)
+    
+    @classmethod
+    def from_segments(cls, stack :Stack, data :DataSegment, code :CodeSegment) -> "Memory":
+        """Create a memory from already built segments, they must share the same word size
+        """
+        memory :Memory = cls.__new__(cls)
+        memory.word_size = code.word_size
+        memory.stack = stack
+        memory.data = data
+        memory.code = code
+        memory.segments = (stack, data, code)
+        memory.locks = (NO_LOCK,)
+        return memory
     
     def __getitem__(self, segment :Segment) -> Stack | DataSegment | CodeSegment:
-        match segment:
-            case Segment.STACK:
-                return self.stack
-            case Segment.DATA:
-                return self.data
-            case Segment.CODE:
-                return self.code
-        raise IndexError()
+        return self.segments[segment.value]
     
     def __setitem__(self, segment :Segment, value :List[int]) -> None:
-        match segment:
-            case Segment.STACK:
-                self.stack.__setitem__(value[0], value[1])
-            case Segment.DATA:
-                self.data.__setitem__(value[0], value[1])
-            case Segment.CODE:
-                self.code.__setitem__(value[0], value[1])
+        self.segments[segment.value][value[0]] = value[1]
                     
     def write(self, segment :Segment, index :int, value :int):
-        self.__setitem__(segment, [index, value])
+        self.segments[segment.value][index] = value
     
-    def write_array(self, segment :Segment, index :int, values :List[int]):
-        idx = index
-        for value in values:
-            self.write(segment, idx, value)
-            idx+=1
+    def write_array(self, segment :Segment, index :int, values :List[int] | array | memoryview):
+        self.segments[segment.value].write_array(index, values)
         
     def read(self, segment :Segment, index: int) -> int:
-        return self.__getitem__(segment)[index]
+        return self.segments[segment.value][index]
     
-    def read_array(self, segment :Segment, index :int, size :int) -> List[int]:
-        return self.__getitem__(segment)[index:index+size]
+    def read_array(self, segment :Segment, index :int, size :int) -> memoryview:
+        """Read size words from index, the result is a view over the segment and not a copy
+        """
+        return self.segments[segment.value].read_array(index, size)
             
-    # i can't keep allocating memory like this i need to change it and know all the writen bytess
-    # returns a location in the given segment that has enough size
-    def _alloc(self, segment :Segment, size :int):
-        block = [0 for i in range(0, size)] # search block by blocks
-        selector = self.stack_selector if segment == Segment.STACK else self.data_selector if segment == Segment.DATA else self.code_selector
-        current_segment = self.stack if segment == Segment.STACK else self.data if segment == Segment.DATA else self.code
-        while not self.read_array(segment, selector, size) == block:
-            dbg(f" Reading block at index {selector}, searching for {block}, got {self.read_array(segment, selector, size)}")
-            selector += 1
-            if selector + size > current_segment.size:
-                dbg("Buffer overflow be careful ", selector)
-                break
-        return selector
+    # returns a location in the given segment that has enough size, the block is taken until it is freed
+    def _alloc(self, segment :Segment, size :int, policy :AllocPolicy | None = None) -> int:
+        return self.segments[segment.value].alloc(size, MemoryBlockState.COMMITED, policy)
+    
+    def _free(self, segment :Segment, index :int):
+        self.segments[segment.value].free(index)
     
     def _reserve(self, segment :Segment, size :int) -> int:
         """Allocate and reserve a memory block for later usage
@@ -154,11 +280,18 @@ class Memory:
         Returns:
             The reserved location
         """
-        block = self._alloc(segment, size)
+        block = self.segments[segment.value].alloc(size, MemoryBlockState.RESERVED)
         self.write_array(segment, block, [0xCC for i in range(size)]) # OxCC means the block is reserved
         return block
     
+    def defragment(self, segment :Segment) -> Dict[int, int]:
+        """Compact the used blocks of a segment
 
+        Returns:
+            old location -> new location of every block that moved
+        """
+        return self.segments[segment.value].defragment()
+    
     def hexdump(self, memory, width=16, index=0, max_size=None):
         def chunker(seq, size):
             return (seq[pos:pos + size] for pos in range(0, len(seq), size))
@@ -178,5 +311,8 @@ class Memory:
     
 def UnitTestMemory():
     mem :Memory = Memory()
-    mem.write_array(Segment.DATA, 0, [10, 30, 45, 78])
-    print(mem._alloc(Segment.DATA, 5))
\ No newline at end of file
+    location = mem._alloc(Segment.DATA, 4)
+    mem.write_array(Segment.DATA, location, [10, 30, 45, 78])
+    assert mem._alloc(Segment.DATA, 5) == 4, ("ERROR in _alloc")
+    mem._free(Segment.DATA, location)
+    assert mem.defragment(Segment.DATA) == {4: 0}, ("ERROR in defragment")
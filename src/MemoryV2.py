@@ -1,6 +1,8 @@
 from typing import List, Dict
 from enum import Enum
-from Dbg import dbg, dbgassert
+from bisect import bisect_left, bisect_right
+from Dbg import dbg, dbgassert, get_logger
+log = get_logger("memory")
 
 class Segment(Enum):
     STACK,DATA,CODE=range(0,3)
@@ -8,36 +10,57 @@ class Segment(Enum):
 class MemoryBlockState(Enum):
     FREE,COMMITED,RESERVED,PRIVATE = range(0,4)
 
+class AllocPolicy(Enum):
+    FIRST_FIT, BEST_FIT = range(0,2)
+
 class MemoryBlock:
     def __init__(self, index :int, size :int, state : MemoryBlockState):
         self.index = index
         self.size = size
         self.state = state
-        
+
     def __repr__(self) -> str:
         return f"MemoryBlock({self.index}, {self.size}, {self.state.name})"
-        
+
     def Relocate(self, newindex :int):
         self.index = newindex
-    
+
     def Resize(self, newsize :int):
         self.size = newsize
-        
+
     def __eq__(self, value: object) -> bool:
-        match type(value):
-            case MemoryBlock:
-                return self.index == value.index and self.size == value.size and self.state.value == value.state.value
-        
+        if isinstance(value, MemoryBlock):
+            return self.index == value.index and self.size == value.size and self.state.value == value.state.value
+
         raise ArithmeticError()
-    
-        
-    
+
+
+
 class MemorySegment:
     def __init__(self, size :int) -> None:
         self.size = size
         self.memory :List[int] = [0 for i in range(0, size)]
-        self.memory_blocks :List[MemoryBlock] = [MemoryBlock(0, size, MemoryBlockState.FREE)]
-    
+        self.init_blocks()
+
+    def init_blocks(self, policy :AllocPolicy = AllocPolicy.FIRST_FIT):
+        """Reset the allocator, the whole segment becomes a single free block
+        """
+        # sorted by index, the blocks always cover the whole segment and two free blocks are never neighbours
+        self.memory_blocks :List[MemoryBlock] = [MemoryBlock(0, self.size, MemoryBlockState.FREE)]
+        # the free blocks only, sorted by index, this is what alloc walks
+        self.free_blocks :List[MemoryBlock] = [self.memory_blocks[0]]
+        self.policy :AllocPolicy = policy
+
+    def _find_block(self, index :int) -> int:
+        """Get the position in memory_blocks of the block that contains index
+        """
+        return bisect_right(self.memory_blocks, index, key=lambda block: block.index) - 1
+
+    def _find_free_block(self, block :MemoryBlock) -> int:
+        """Get the position of a free block in free_blocks
+        """
+        return bisect_left(self.free_blocks, block.index, key=lambda block: block.index)
+
     def get_blocks(self, index, size) -> List[MemoryBlock]:
         """Get the blocks that occupy the range from index to index+size
 
@@ -46,23 +69,20 @@ class MemorySegment:
             size (int): size of your data
         """
         blocks = []
-        for block in self.memory_blocks:
-            dbg(f"{index};{index+size} == {block.index};{block.index+block.size}")
-            if index >= block.index and index+size <= block.index + block.size:
-                blocks.append(block) # push the last block
-                return blocks # return all
-            elif index >= block.index and index+size > block.index + block.size: # get the next block
-                index+=block.size # rebase the index and size
-                size-=block.size
-                blocks.append(block) # we're inside this block, but there's another one next to us
-                        
+        position :int = max(self._find_block(index), 0)
+        while position < len(self.memory_blocks):
+            block :MemoryBlock = self.memory_blocks[position]
+            if block.index >= index + size:
+                break
+            blocks.append(block)
+            position += 1
         return blocks
 
     def __getitem__(self, index :int | slice):
         if isinstance(index, slice):
             if (index.step and index.step > 1):
                 raise IndexError()
-            if (index.start >= 0 and index.stop < self.size):
+            if (index.start >= 0 and index.stop <= self.size):
                 return self.memory[index]
             else:
                 raise IndexError()
@@ -73,12 +93,12 @@ class MemorySegment:
                 raise IndexError()
         else:
             raise IndexError()
-    
+
     def __setitem__(self, index :int, value :int | slice):
         if isinstance(index, slice):
             if (index.step and index.step > 1):
                 raise IndexError()
-            if (index.start >= 0 and index.stop < self.size):
+            if (index.start >= 0 and index.stop <= self.size):
                 self.memory[index] = value
             else:
                 raise IndexError()
@@ -89,21 +109,130 @@ class MemorySegment:
                 raise IndexError()
         else:
             raise IndexError()
-    
+
     def write(self, index, value):
-        blocks = self.get_blocks(index, size)            
-    
+        self[index] = value
+
+    def move(self, index :int, newindex :int, size :int):
+        """Copy size words from index to newindex, used when blocks are relocated
+        """
+        self.memory[newindex:newindex + size] = self.memory[index:index + size]
+
+    def _split(self, position :int, index :int, size :int, state :MemoryBlockState) -> MemoryBlock:
+        """Carve [index, index+size) out of the free block at position and give it the state
+        """
+        block :MemoryBlock = self.memory_blocks[position]
+        end :int = block.index + block.size
+        carved :MemoryBlock = MemoryBlock(index, size, state)
+        parts :List[MemoryBlock] = []
+        free_parts :List[MemoryBlock] = []
+        if index > block.index:
+            free_parts.append(MemoryBlock(block.index, index - block.index, MemoryBlockState.FREE))
+            parts.append(free_parts[-1])
+        parts.append(carved)
+        if index + size < end:
+            free_parts.append(MemoryBlock(index + size, end - index - size, MemoryBlockState.FREE))
+            parts.append(free_parts[-1])
+        self.memory_blocks[position:position + 1] = parts
+        free_position :int = self._find_free_block(block)
+        self.free_blocks[free_position:free_position + 1] = free_parts
+        return carved
+
+    def alloc(self, size :int, state :MemoryBlockState = MemoryBlockState.COMMITED, policy :AllocPolicy | None = None) -> int:
+        """Find a free block of at least size words and take it
+
+        Args:
+            size (int): size of the block
+            state (MemoryBlockState, optional): state of the taken block. Defaults to COMMITED.
+            policy (AllocPolicy, optional): how the free block is chosen. Defaults to the segment policy.
+        Returns:
+            The location of the block
+        """
+        policy = self.policy if policy is None else policy
+        chosen :MemoryBlock | None = None
+        for block in self.free_blocks:
+            if block.size < size:
+                continue
+            if policy == AllocPolicy.FIRST_FIT:
+                chosen = block
+                break
+            if chosen is None or block.size < chosen.size:
+                chosen = block
+                if block.size == size:
+                    break
+        if chosen is None:
+            raise MemoryError(f"No free block of size {size} left in a segment of size {self.size}")
+        return self._split(self._find_block(chosen.index), chosen.index, size, state).index
+
+    def free(self, index :int):
+        """Give back the block starting at index, it is merged with its free neighbours
+
+        Raises:
+            ValueError: no block in use starts at index
+        """
+        position :int = self._find_block(index)
+        if position < 0 or self.memory_blocks[position].index != index or self.memory_blocks[position].state == MemoryBlockState.FREE:
+            raise ValueError(f"failed to free memory, no block in use starts at {index}")
+        block :MemoryBlock = self.memory_blocks[position]
+        block.state = MemoryBlockState.FREE
+        # coalesce with the next block then with the previous one
+        if position + 1 < len(self.memory_blocks) and self.memory_blocks[position + 1].state == MemoryBlockState.FREE:
+            following :MemoryBlock = self.memory_blocks[position + 1]
+            del self.free_blocks[self._find_free_block(following)]
+            block.Resize(block.size + following.size)
+            del self.memory_blocks[position + 1]
+        if position > 0 and self.memory_blocks[position - 1].state == MemoryBlockState.FREE:
+            previous :MemoryBlock = self.memory_blocks[position - 1]
+            previous.Resize(previous.size + block.size)
+            del self.memory_blocks[position]
+        else:
+            self.free_blocks.insert(self._find_free_block(block), block)
+
     # defragment memory segments
-    def defragment(self):
-        pass
-    
-    def _reserve(self, index :int, size :int):
-        blocks :List[MemoryBlock] = self.get_blocks(index, size)
-        for block in blocks:
+    def defragment(self) -> Dict[int, int]:
+        """Slide every used block to the start of the segment, leaving a single free block at the end
+
+        Returns:
+            old location -> new location of every block that moved
+        """
+        moved :Dict[int, int] = {}
+        blocks :List[MemoryBlock] = []
+        cursor :int = 0
+        for block in self.memory_blocks:
+            if block.state == MemoryBlockState.FREE:
+                continue
+            if block.index != cursor:
+                self.move(block.index, cursor, block.size)
+                moved[block.index] = cursor
+                block.Relocate(cursor)
+            blocks.append(block)
+            cursor += block.size
+        self.free_blocks = []
+        if cursor < self.size:
+            blocks.append(MemoryBlock(cursor, self.size - cursor, MemoryBlockState.FREE))
+            self.free_blocks.append(blocks[-1])
+        self.memory_blocks = blocks
+        return moved
+
+    def used_size(self) -> int:
+        """End of the last block in use, everything after it is free
+        """
+        for block in reversed(self.memory_blocks):
             if block.state != MemoryBlockState.FREE:
-                print("failed to reserve memory , block is not free")
-                return
-    
+                return block.index + block.size
+        return 0
+
+    def _reserve(self, index :int, size :int) -> bool:
+        """Reserve the range [index, index+size), it must be inside a single free block
+        """
+        position :int = self._find_block(index)
+        block :MemoryBlock = self.memory_blocks[position] if position >= 0 else None
+        if block is None or block.state != MemoryBlockState.FREE or index + size > block.index + block.size:
+            log.debug("failed to reserve [%d, %d), the range is not inside a free block", index, index + size)
+            return False
+        self._split(position, index, size, MemoryBlockState.RESERVED)
+        return True
+
     def hexdump(self, memory, width=16, index=0, max_size=None):
         def chunker(seq, size):
             return (seq[pos:pos + size] for pos in range(0, len(seq), size))
@@ -126,8 +255,25 @@ def MemoryV2UnitTests():
     seg.memory_blocks = [MemoryBlock(0, 8, MemoryBlockState.FREE), MemoryBlock(8, 8, MemoryBlockState.FREE), MemoryBlock(16, 8, MemoryBlockState.FREE), MemoryBlock(24, 8, MemoryBlockState.FREE)]
     blocks = seg.get_blocks(0, 24)
     assert  blocks == [MemoryBlock(0, 8, MemoryBlockState.FREE), MemoryBlock(8, 8, MemoryBlockState.FREE), MemoryBlock(16, 8, MemoryBlockState.FREE)], ("ERROR in get_blocks")
-    
 
-    
+    seg = MemorySegment(32)
+    a, b, c = seg.alloc(4), seg.alloc(8), seg.alloc(4)
+    assert (a, b, c) == (0, 4, 12), ("ERROR in alloc")
+    seg.free(b)
+    assert seg.alloc(2, policy=AllocPolicy.BEST_FIT) == 4, ("ERROR in best fit")
+    seg.free(a)
+    seg.free(4)
+    assert seg.memory_blocks[0] == MemoryBlock(0, 12, MemoryBlockState.FREE), ("ERROR in free coalescing")
+    seg[12] = 42
+    assert seg.defragment() == {12: 0} and seg[0] == 42, ("ERROR in defragment")
+    assert seg.memory_blocks == [MemoryBlock(0, 4, MemoryBlockState.COMMITED), MemoryBlock(4, 28, MemoryBlockState.FREE)], ("ERROR in defragment")
+    assert seg._reserve(8, 4) and not seg._reserve(10, 4), ("ERROR in _reserve")
+    try:
+        seg.free(20)
+        assert False, ("ERROR in free, a free block was freed again")
+    except ValueError:
+        pass
+
+
 if __name__ == "__main__":
-    MemoryV2UnitTests() 
\ No newline at end of file
+    MemoryV2UnitTests()
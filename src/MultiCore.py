@@ -0,0 +1,367 @@
+from typing import List, Dict, Tuple
+from array import array
+from enum import Enum
+from multiprocessing import shared_memory
+from AssemblerV2 import AssemblerV2
+from CPU import Register, Symbol, Operand
+from Image import Image
+from Memory import Memory, Stack, DataSegment, CodeSegment, NO_LOCK
+from SymbolMap import SymbolMap, Relocation
+from Emulator import EmulatorV1
+from Dbg import get_logger
+import multiprocessing, time, gc
+
+# Several cores running one program against one memory. Every core is an EmulatorV1 with its own registers, flags
+# and stack, the data and code segments are the same words for all of them. The CID register holds the number of
+# the core, the program uses it to split the work. Everything lives in one buffer :
+#
+#   states   STATE_WORDS words of 8 bytes per core : status, executed instructions, stop request, flags result, registers
+#   stacks   stack_size words per core
+#   data     the data segment
+#   code     the code segment
+#
+# In parallel mode the buffer is a multiprocessing.shared_memory block and every core runs in its own process,
+# each process builds its segments over the block so the cores scale over the host cpus. Reads and writes of a word
+# are single stores, the atomic instructions (XADD, XCHG, CMPXCHG) hold one of LOCK_STRIPES locks, picked by the
+# word location, around their read-modify-write. FENCE takes a lock, which orders the memory accesses of the core
+# with the other processes.
+#
+# In deterministic mode the buffer is a bytearray and the cores run in the calling thread, one quantum each in
+# turn. The same program and quantum always interleave the same way, quantum=1 switches core after every instruction.
+
+log = get_logger("multicore")
+
+# instructions a core runs between two publications of its state and two checks of its stop request
+QUANTUM :int = 1000
+
+# locks of the atomic instructions, two cores only wait for each other when their words share a stripe
+LOCK_STRIPES :int = 16
+
+class CoreStatus(Enum):
+    IDLE, RUNNING, HALTED, BUDGET, STOPPED, FAULTED = range(0, 6)
+
+# state record of a core
+STATUS, EXECUTED, STOP, RESULT, REGISTERS = range(0, 5)
+STATE_WORDS :int = REGISTERS + len(Register)
+
+def _align(size :int) -> int:
+    return (size + 7) & ~7
+
+class Layout:
+    """Offsets in bytes of the parts of the shared buffer
+    """
+    def __init__(self, cores :int, stack_size :int, data_size :int, code_size :int, word_size :int) -> None:
+        self.cores = cores
+        self.stack_size = stack_size
+        self.word_size = word_size
+        self.states :int = 0
+        self.stacks :int = _align(cores * STATE_WORDS * 8)
+        self.data :int = _align(self.stacks + cores * stack_size * word_size)
+        self.code :int = _align(self.data + data_size * word_size)
+        self.end :int = _align(self.code + code_size * word_size)
+        self.data_size = data_size
+        self.code_size = code_size
+
+    def states_view(self, buffer) -> memoryview:
+        return memoryview(buffer)[self.states:self.states + self.cores * STATE_WORDS * 8].cast("Q")
+
+    def stack(self, buffer, core :int) -> Stack:
+        start :int = self.stacks + core * self.stack_size * self.word_size
+        return Stack.from_buffer(memoryview(buffer)[start:start + self.stack_size * self.word_size], self.word_size)
+
+    def segments(self, buffer) -> Tuple[DataSegment, CodeSegment]:
+        view :memoryview = memoryview(buffer)
+        data :DataSegment = DataSegment.from_buffer(view[self.data:self.data + self.data_size * self.word_size], self.word_size)
+        code :CodeSegment = CodeSegment.from_buffer(view[self.code:self.code + self.code_size * self.word_size], self.word_size)
+        return data, code
+
+class Program:
+    """What EmulatorV1 reads from an assembler, over the memory of one core
+    """
+    def __init__(self, memory :Memory, symbol_map, relocations, line_map :Dict[int, int]) -> None:
+        self.memory = memory
+        self.symbol_map = symbol_map
+        self.relocations = relocations
+        self.line_map = line_map
+
+class CoreState:
+    """State of a core as last published, read with MultiCore.inspect
+    """
+    def __init__(self, core :int, status :CoreStatus, executed :int, result :int, regs :List[int], error :str | None) -> None:
+        self.core = core
+        self.status = status
+        self.executed = executed
+        # the lazy flags result
+        self.result = result
+        self.regs = regs
+        # message of the exception that stopped a faulted core
+        self.error = error
+
+    def __getitem__(self, register :Register) -> int:
+        return self.regs[register.value]
+
+    def __repr__(self) -> str:
+        return f"CoreState({self.core}, {self.status.name}, executed={self.executed}, PC={self.regs[Register.PC.value]})"
+
+def _program(assembler_obj :AssemblerV2 | Image) -> Tuple:
+    """What a core needs from an assembler or an image, without its memory : the symbols, the relocations and the line map.
+    This is sent to every core process, the symbol map of the assembler holds the whole memory
+    """
+    symbols :List[Tuple[str, Symbol, int, int]] = [(entry.name, entry.type, entry.location, entry.size) for entry in assembler_obj.symbol_map.symbols]
+    relocations :List[Tuple[int, int, int]] = [(r.offset, r.symbol, r.kind.value) for r in assembler_obj.relocations.values()]
+    return symbols, relocations, dict(getattr(assembler_obj, "line_map", {}))
+
+def _core(layout :Layout, buffer, core :int, program :Tuple, data :DataSegment, code :CodeSegment, locks :tuple, translate :bool) -> EmulatorV1:
+    memory :Memory = Memory.from_segments(layout.stack(buffer, core), data, code)
+    memory.locks = locks
+    symbols, relocations, line_map = program
+    # the symbols of the core read the shared segments
+    symbol_map :SymbolMap = SymbolMap(memory)
+    for name, typ, location, size in symbols:
+        symbol_map._declare(typ, name, location, size)
+    relocation_table :Dict[int, Relocation] = {offset: Relocation(offset, symbol, Operand(kind)) for offset, symbol, kind in relocations}
+    emu :EmulatorV1 = EmulatorV1(Program(memory, symbol_map, relocation_table, line_map), translate=translate)
+    emu.regs[Register.CID] = core
+    return emu
+
+def _publish(states :memoryview, core :int, emu :EmulatorV1, status :CoreStatus, executed :int):
+    base :int = core * STATE_WORDS
+    states[base + REGISTERS:base + STATE_WORDS] = array("Q", emu.regs.regs)
+    states[base + RESULT] = emu.flags.result
+    states[base + EXECUTED] = executed
+    states[base + STATUS] = status.value
+
+def _run_quantum(states :memoryview, core :int, emu :EmulatorV1, budget :int | None, quantum :int) -> bool:
+    """Run one quantum of a core and publish its state
+
+    Returns:
+        False once the core is done
+    """
+    base :int = core * STATE_WORDS
+    executed :int = states[base + EXECUTED]
+    if states[base + STOP]:
+        _publish(states, core, emu, CoreStatus.STOPPED, executed)
+        return False
+    executed += emu.run(quantum if budget is None else min(quantum, budget - executed))
+    if emu.is_halted:
+        status :CoreStatus = CoreStatus.HALTED
+    elif budget is not None and executed >= budget:
+        status :CoreStatus = CoreStatus.BUDGET
+    else:
+        status :CoreStatus = CoreStatus.RUNNING
+    _publish(states, core, emu, status, executed)
+    return status == CoreStatus.RUNNING
+
+def _core_process(name :str, layout :Layout, core :int, program :Tuple, locks :tuple, translate :bool,
+                  budget :int | None, quantum :int, errors):
+    """Entry point of the process of a core
+    """
+    block = shared_memory.SharedMemory(name)
+    states :memoryview = layout.states_view(block.buf)
+    data, code = layout.segments(block.buf)
+    emu :EmulatorV1 | None = None
+    try:
+        emu = _core(layout, block.buf, core, program, data, code, locks, translate)
+        while _run_quantum(states, core, emu, budget, quantum):
+            pass
+    except BaseException as e:
+        if emu is not None:
+            _publish(states, core, emu, CoreStatus.FAULTED, states[core * STATE_WORDS + EXECUTED])
+        else:
+            states[core * STATE_WORDS + STATUS] = CoreStatus.FAULTED.value
+        errors.put((core, f"{type(e).__name__}: {e}"))
+    finally:
+        # the views must go before the block can be closed, the emulator and its hooks hold them in cycles
+        del states, data, code, emu
+        gc.collect()
+        block.close()
+
+class MultiCore:
+    def __init__(self, assembler_obj :AssemblerV2 | Image, cores :int = 2, quantum :int = QUANTUM, deterministic :bool = False,
+                 translate :bool = False, context :str | None = None) -> None:
+        """Run a program on several cores sharing its data and code segments
+
+        Args:
+            assembler_obj (AssemblerV2 | Image): your assembler or a loaded image, its memory is copied in the shared buffer
+            cores (int, optional): number of cores, every one gets a stack as big as the assembler one
+            quantum (int, optional): instructions between two state publications, and in deterministic mode between two core switches
+            deterministic (bool, optional): run the cores in turn in this thread instead of one process each
+            translate (bool, optional): run the cores with the translator
+            context (str, optional): multiprocessing start method, the platform default otherwise
+        """
+        if cores < 1:
+            raise ValueError("a machine needs at least one core")
+        memory :Memory = assembler_obj.memory
+        self.cores = cores
+        self.quantum = quantum
+        self.deterministic = deterministic
+        self.translate = translate
+        self.layout :Layout = Layout(cores, memory.stack.size, memory.data.size, memory.code.size, memory.word_size)
+        self.program :Tuple = _program(assembler_obj)
+        self.context = multiprocessing.get_context(context)
+        self.block :shared_memory.SharedMemory | None = None
+        if deterministic:
+            self.buffer = bytearray(self.layout.end)
+        else:
+            self.block = shared_memory.SharedMemory(create=True, size=self.layout.end)
+            self.buffer = self.block.buf
+        self.states :memoryview = self.layout.states_view(self.buffer)
+        self.data, self.code = self.layout.segments(self.buffer)
+        self.data.write_array(0, memory.data.memory)
+        self.code.write_array(0, memory.code.memory)
+        self.errors :Dict[int, str] = {}
+        self.processes :List[multiprocessing.process.BaseProcess] = []
+        self.budget :int | None = None
+        # the cores of the deterministic mode, created by start. Debuggers and snapshots can be attached to them
+        self.emulators :List[EmulatorV1] = []
+        self.running :List[int] = []
+
+    def start(self, budget :int | None = None):
+        """Start every core from the beginning of the program, the data segment is left as it is
+
+        Args:
+            budget (int, optional): instructions each core runs at most, by default until it halts
+        """
+        if self.processes or self.running:
+            raise ValueError("the cores are already running, join them first")
+        self.budget = budget
+        self.errors.clear()
+        self.states[:] = array("Q", [0]) * len(self.states)
+        for core in range(self.cores):
+            self.states[core * STATE_WORDS + STATUS] = CoreStatus.RUNNING.value
+        if self.deterministic:
+            self.emulators = [_core(self.layout, self.buffer, core, self.program, self.data, self.code, (NO_LOCK,), self.translate)
+                              for core in range(self.cores)]
+            self.running = list(range(self.cores))
+            return
+        self.errors_queue = self.context.SimpleQueue()
+        # kept alive until the cores are joined, a spawned process opens the locks after start() returned
+        self.locks :tuple = tuple(self.context.Lock() for i in range(LOCK_STRIPES))
+        for core in range(self.cores):
+            process = self.context.Process(target=_core_process, name=f"core{core}", daemon=True,
+                                           args=(self.block.name, self.layout, core, self.program, self.locks, self.translate,
+                                                 budget, self.quantum, self.errors_queue))
+            process.start()
+            self.processes.append(process)
+
+    def step(self) -> bool:
+        """Deterministic mode : run one quantum of every running core, in core order
+
+        Returns:
+            False once every core is done
+        """
+        for core in list(self.running):
+            try:
+                if not _run_quantum(self.states, core, self.emulators[core], self.budget, self.quantum):
+                    self.running.remove(core)
+            except Exception as e:
+                _publish(self.states, core, self.emulators[core], CoreStatus.FAULTED, self.states[core * STATE_WORDS + EXECUTED])
+                self.errors[core] = f"{type(e).__name__}: {e}"
+                self.running.remove(core)
+        return bool(self.running)
+
+    def _collect(self):
+        while not self.errors_queue.empty():
+            core, message = self.errors_queue.get()
+            self.errors[core] = message
+
+    def join(self, timeout :float | None = None) -> List[CoreState]:
+        """Wait for the cores to halt, run out of budget, fault or stop. In deterministic mode this runs them
+
+        Args:
+            timeout (float, optional): seconds to wait, the cores still running keep running
+        Returns:
+            The state of every core
+        """
+        deadline :float | None = None if timeout is None else time.perf_counter() + timeout
+        if self.deterministic:
+            while self.step():
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
+            return self.inspect_all()
+        for process in self.processes:
+            while process.is_alive():
+                # a core blocks on a full error queue until it is read
+                self._collect()
+                wait :float = 0.05 if deadline is None else min(0.05, deadline - time.perf_counter())
+                if wait <= 0:
+                    return self.inspect_all()
+                process.join(wait)
+        self._collect()
+        for core, process in enumerate(self.processes):
+            if process.exitcode and core not in self.errors:
+                # killed before it could say why
+                self.states[core * STATE_WORDS + STATUS] = CoreStatus.FAULTED.value
+                self.errors[core] = f"process exited with code {process.exitcode}"
+        self.processes = []
+        return self.inspect_all()
+
+    def run(self, budget :int | None = None, timeout :float | None = None) -> List[CoreState]:
+        """Start the cores and wait for them
+        """
+        self.start(budget)
+        return self.join(timeout)
+
+    def stop(self):
+        """Ask every core to stop at the end of its quantum
+        """
+        for core in range(self.cores):
+            self.states[core * STATE_WORDS + STOP] = 1
+
+    def inspect(self, core :int) -> CoreState:
+        """State of a core as published at the end of its last quantum
+        """
+        if not 0 <= core < self.cores:
+            raise IndexError(f"no core {core}")
+        base :int = core * STATE_WORDS
+        record :List[int] = self.states[base:base + STATE_WORDS].tolist()
+        return CoreState(core, CoreStatus(record[STATUS]), record[EXECUTED], record[RESULT], record[REGISTERS:], self.errors.get(core))
+
+    def inspect_all(self) -> List[CoreState]:
+        return [self.inspect(core) for core in range(self.cores)]
+
+    def close(self):
+        """Stop the cores and release the shared memory
+        """
+        if self.processes:
+            self.stop()
+            self.join()
+        self.emulators = []
+        self.running = []
+        # the segments are views over the buffer, they must be released before the block
+        self.states.release()
+        self.data = self.code = None
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def __enter__(self) -> "MultiCore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+import argparse
+import sys
+if __name__ == "__main__":
+    import Dbg
+    Dbg.set_debug(False)
+    parser = argparse.ArgumentParser(prog='OpenArchitecture MultiCore', description="Run a program on several cores sharing its memory")
+    parser.add_argument('filein', help="your microcode file which contains instructions")
+    parser.add_argument('-n', '--cores', type=int, default=multiprocessing.cpu_count(), help="number of cores, one process each")
+    parser.add_argument('--budget', type=int, default=None, help="instructions each core runs at most")
+    parser.add_argument('--quantum', type=int, default=QUANTUM, help="instructions between two state updates")
+    parser.add_argument('--deterministic', action='store_true', help="run the cores in turn in one thread")
+    parser.add_argument('--translate', action='store_true', help="run the cores with the translator")
+    args = parser.parse_args(sys.argv[1:])
+
+    with MultiCore(AssemblerV2(args.filein), args.cores, args.quantum, args.deterministic, args.translate) as machine:
+        start :float = time.perf_counter()
+        states :List[CoreState] = machine.run(args.budget)
+        elapsed :float = time.perf_counter() - start
+        for state in states:
+            print(f"core {state.core} {state.status.name:<8} {state.executed:>12} instructions  PC {state[Register.PC]:<6}"
+                  + (f" {state.error}" if state.error else ""))
+        total :int = sum(state.executed for state in states)
+        print(f"{total} instructions in {elapsed:.2f}s ({total / elapsed:,.0f}/s)")
@@ -0,0 +1,133 @@
+from typing import List, Tuple
+from CPU import Register, Instructions
+from Lexer import Token, TokenKind, MNEMONICS
+
+# Peephole optimizer of AssemblerV2, it works on the lexed lines of a code block (a list of tokens per instruction)
+# before they are encoded. Every rule looks at two neighbour instructions and rewrites them, the pass is repeated
+# until nothing changes. Rewritten instructions keep the line of the first instruction they come from.
+#
+#   ADD r, a    ; ADD r, b         ->  ADD r, a+b        (SUB too, ADD r, 0 is dropped if the flags are dead)
+#   MOV r, a    ; ADD r, b         ->  MOV r, a+b        (a and b integers, SUB too, the flags are dead)
+#   MOV r, x    ; MOV r, y         ->  MOV r, y          (y does not read r)
+#   PUSH r      ; POP r            ->  nothing
+#   PUSH x      ; POP r            ->  MOV r, x
+#   MOV r, x    ; ADD r, y         ->  MOVADD r, x, y    (superinstruction, y does not read r)
+#   JMP/HALT    ; anything         ->  JMP/HALT          (a block only has one entry, its first line)
+#
+# ADD, SUB, CMP and MOVADD set the flags read by the conditional jumps. A rule dropping one of them only applies
+# when the flags are dead : set again by a later instruction of the block before any jump can read them.
+# PC and AR are never touched, neither is ST around PUSH and POP. Symbol names are not moved from an instruction
+# to another, the optimizer does not know if they are labels or data and MOV does nothing with a label.
+
+MASK :int = 2**32 - 1
+
+MOV :int = MNEMONICS["MOV"]
+ADD :int = MNEMONICS["ADD"]
+SUB :int = MNEMONICS["SUB"]
+PUSH :int = MNEMONICS["PUSH"]
+POP :int = MNEMONICS["POP"]
+JMP :int = MNEMONICS["JMP"]
+HALT :int = MNEMONICS["HALT"]
+MOVADD :int = MNEMONICS["MOVADD"]
+CMP :int = MNEMONICS["CMP"]
+CALL :int = MNEMONICS["CALL"]
+
+# instructions setting the flags (with a register destination), and the ones that can read them
+FLAG_SETTERS :Tuple[int, ...] = (ADD, SUB, CMP, MOVADD)
+FLAG_READERS :Tuple[int, ...] = (JMP, CALL) + tuple(MNEMONICS[name] for name in ("JZ", "JNZ", "JS", "JNS", "JP", "JNP"))
+
+PROTECTED :Tuple[int, ...] = (Register.PC.value, Register.AR.value)
+STACK_PROTECTED :Tuple[int, ...] = PROTECTED + (Register.ST.value,)
+
+def _mnemonic(opcode :int, line :Token) -> Token:
+    name :str = Instructions.from_index(opcode).name
+    return Token(TokenKind.MNEMONIC, name, opcode, line.line, line.col)
+
+def _integer(value :int, where :Token) -> Token:
+    value &= MASK
+    return Token(TokenKind.INTEGER, str(value), value, where.line, where.col)
+
+def _is_reg(token :Token, protected :Tuple[int, ...] = PROTECTED) -> bool:
+    return token.kind == TokenKind.REGISTER and token.value not in protected
+
+# operands the rules can move from an instruction to another
+MOVABLE :Tuple[TokenKind, ...] = (TokenKind.REGISTER, TokenKind.INTEGER, TokenKind.VALUE)
+
+def _reads(token :Token, reg :int) -> bool:
+    return token.kind == TokenKind.REGISTER and token.value == reg
+
+def _signed(tokens :List[Token]) -> int:
+    """Immediate of an ADD or SUB, as the value added to the register
+    """
+    return tokens[2].value if tokens[0].value == ADD else -tokens[2].value
+
+def _flags_dead(lines :List[List[Token]], start :int) -> bool:
+    """Tell if the flags set before lines[start] are set again before anything can read them
+    """
+    for tokens in lines[start:]:
+        if tokens[0].kind != TokenKind.MNEMONIC or tokens[0].value in FLAG_READERS:
+            return False
+        if tokens[0].value == HALT or (tokens[0].value in FLAG_SETTERS and len(tokens) > 1 and tokens[1].kind == TokenKind.REGISTER):
+            return True
+    # the next block can read them
+    return False
+
+def _rewrite(a :List[Token], b :List[Token], flags_dead :bool) -> List[List[Token]] | None:
+    """Rewrite two neighbour instructions
+
+    Args:
+        flags_dead (bool): the flags set by b are never read
+    Returns:
+        the instructions replacing them, or None if no rule applies
+    """
+    opa, opb = a[0].value, b[0].value
+    if opa in (ADD, SUB) and opb in (ADD, SUB) and len(a) == 3 and len(b) == 3 \
+            and _is_reg(a[1]) and b[1].kind == TokenKind.REGISTER and a[1].value == b[1].value \
+            and a[2].kind == TokenKind.INTEGER and b[2].kind == TokenKind.INTEGER:
+        value :int = (_signed(a) + _signed(b)) & MASK
+        if value == 0 and flags_dead:
+            return []
+        return [[_mnemonic(ADD, a[0]), a[1], _integer(value, a[2])]]
+
+    if opa == MOV and len(a) == 3 and len(b) == 3 and _is_reg(a[1]) and b[1].kind == TokenKind.REGISTER and a[1].value == b[1].value:
+        reg :int = a[1].value
+        if opb in (ADD, SUB) and a[2].kind == TokenKind.INTEGER and b[2].kind == TokenKind.INTEGER and flags_dead:
+            return [[a[0], a[1], _integer(a[2].value + _signed(b), a[2])]]
+        if opb == MOV and b[2].kind in MOVABLE and not _reads(b[2], reg):
+            return [b]
+        if opb == ADD and a[2].kind in MOVABLE and b[2].kind in MOVABLE and not _reads(b[2], reg):
+            return [[_mnemonic(MOVADD, a[0]), a[1], a[2], b[2]]]
+
+    if opa == PUSH and opb == POP and len(a) == 2 and len(b) == 2 and _is_reg(b[1], STACK_PROTECTED) \
+            and a[1].kind in MOVABLE and not (a[1].kind == TokenKind.REGISTER and a[1].value in STACK_PROTECTED):
+        if _reads(a[1], b[1].value):
+            return []
+        return [[_mnemonic(MOV, a[0]), b[1], a[1]]]
+    return None
+
+def optimize(lines :List[List[Token]]) -> List[List[Token]]:
+    """Run the peephole rules over the instructions of a block until none applies
+    """
+    lines = list(lines)
+    # nothing after an unconditional jump or a halt can run
+    for i, tokens in enumerate(lines):
+        if tokens[0].kind == TokenKind.MNEMONIC and tokens[0].value in (JMP, HALT):
+            del lines[i + 1:]
+            break
+    changed :bool = True
+    while changed:
+        changed = False
+        i :int = 0
+        while i + 1 < len(lines):
+            a, b = lines[i], lines[i + 1]
+            rewritten = None
+            if a[0].kind == TokenKind.MNEMONIC and b[0].kind == TokenKind.MNEMONIC:
+                rewritten = _rewrite(a, b, _flags_dead(lines, i + 2))
+            if rewritten is None:
+                i += 1
+                continue
+            lines[i:i + 2] = rewritten
+            changed = True
+            # the new instruction may combine with the previous one
+            i = max(i - 1, 0)
+    return lines
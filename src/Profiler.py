@@ -0,0 +1,193 @@
+from typing import List, Dict, Tuple
+from CPU import Register, Symbol
+from Dispatch import call
+import bisect
+
+# Guest profiler of EmulatorV1, enabled with EmulatorV1(assembler, profile=True). The profiled emulator runs the
+# loop below instead of its own one, so a disabled profiler costs nothing and the translator is not used while
+# profiling (blocks hide the instructions). An instruction costs one dict increment, plus a few list operations
+# on CALL and when a frame returns.
+#
+# The guest has no RET, a function returns by popping its return address. So a CALL opens a frame remembering
+# the stack slot of the return address, and the frame is closed as soon as ST goes back to that slot (the return
+# address was popped, into PC or anywhere else). Every stack of frames gets its own address -> count dict, the
+# per address, per opcode and per label costs are summed from them when a report is asked.
+
+ST :int = Register.ST.value
+AR :int = Register.AR.value
+
+# frame name of the code before the first label
+ENTRY :str = "<entry>"
+
+# a call stack, the addresses of the CALL instructions that opened its frames
+Stack = Tuple[int, ...]
+
+class Profiler:
+    def __init__(self, emu :"EmulatorV1", line_map :Dict[int, int] | None = None) -> None:
+        """Count the instructions executed by an emulator, per address and per call stack
+
+        Args:
+            emu (EmulatorV1): the profiled emulator
+            line_map (Dict[int, int], optional): code location -> source line (AssemblerV2.line_map), shown in the report
+        """
+        self.emu = emu
+        self.line_map :Dict[int, int] = line_map or {}
+        # call stack -> code address -> executed instructions
+        self.stacks :Dict[Stack, Dict[int, int]] = {(): {}}
+        self.stack :Stack = ()
+        # stack slot of the return address of every open frame, innermost last
+        self.slots :List[int] = []
+        labels = sorted((entry.location, entry.name) for entry in emu.symbol_map.symbols if entry.type == Symbol.LABEL)
+        self.label_locations :List[int] = [location for location, name in labels]
+        self.label_names :List[str] = [name for location, name in labels]
+
+    def reset(self):
+        """Forget every count, the open frames are kept
+        """
+        self.stacks = {self.stack: {}}
+
+    def run(self, budget :int | None) -> int:
+        """Execute instructions with the handlers and count them, until the cpu halts or budget instructions ran
+
+        Returns:
+            The number of executed instructions
+        """
+        emu = self.emu
+        regs = emu.regs.regs
+        decode_cache = emu.decode_cache
+        stacks = self.stacks
+        slots = self.slots
+        counts :Dict[int, int] = stacks.setdefault(self.stack, {})
+        # slot of the innermost frame, -1 never matches since ST is unsigned
+        top :int = slots[-1] if slots else -1
+        executed :int = 0
+        try:
+            while not emu.is_halted and (budget is None or executed < budget):
+                address :int = regs[AR]
+                decoded = decode_cache.get(address)
+                if decoded is None:
+                    decoded = emu.decode(address)
+                # counted before running, an instruction that raises was executed too
+                counts[address] = counts.get(address, 0) + 1
+                executed += 1
+                if decoded.handler is call:
+                    slot :int = regs[ST]
+                    decoded.handler(emu, decoded)
+                    slots.append(slot)
+                    top = slot
+                    self.stack += (address,)
+                    counts = stacks.setdefault(self.stack, {})
+                    continue
+                decoded.handler(emu, decoded)
+                if regs[ST] <= top:
+                    # the return address was popped, close every frame above the stack top
+                    while slots and regs[ST] <= slots[-1]:
+                        slots.pop()
+                        self.stack = self.stack[:-1]
+                    top = slots[-1] if slots else -1
+                    counts = stacks.setdefault(self.stack, {})
+        finally:
+            # an empty dict of a stack that never ran is not worth reporting
+            for stack in [stack for stack, stack_counts in stacks.items() if not stack_counts and stack != self.stack]:
+                del stacks[stack]
+        return executed
+
+    def label(self, address :int) -> str:
+        """Name of the label holding a code address
+        """
+        i :int = bisect.bisect_right(self.label_locations, address) - 1
+        return self.label_names[i] if i >= 0 else ENTRY
+
+    def label_offset(self, address :int) -> str:
+        """Label+offset of a code address
+        """
+        i :int = bisect.bisect_right(self.label_locations, address) - 1
+        if i < 0:
+            return f"{ENTRY}+{address}"
+        offset :int = address - self.label_locations[i]
+        return f"{self.label_names[i]}+{offset}" if offset else self.label_names[i]
+
+    @property
+    def total(self) -> int:
+        return sum(sum(counts.values()) for counts in self.stacks.values())
+
+    def pc_counts(self) -> Dict[int, int]:
+        """Executed instructions per code address
+        """
+        result :Dict[int, int] = {}
+        for counts in self.stacks.values():
+            for address, count in counts.items():
+                result[address] = result.get(address, 0) + count
+        return result
+
+    def opcode_counts(self) -> Dict[str, int]:
+        """Executed instructions per mnemonic, addresses are decoded again so rewritten code counts as its last version
+        """
+        result :Dict[str, int] = {}
+        for address, count in self.pc_counts().items():
+            name :str = self.emu.decode(address).instruction.name
+            result[name] = result.get(name, 0) + count
+        return result
+
+    def collapsed_counts(self) -> Dict[Tuple[str, ...], int]:
+        """Executed instructions per stack of label names, outermost first. A frame is named after the label of the
+        CALL that opened the next one, the last frame after the label of the executed instruction
+        """
+        result :Dict[Tuple[str, ...], int] = {}
+        for stack, counts in self.stacks.items():
+            callers :Tuple[str, ...] = tuple(self.label(address) for address in stack)
+            for address, count in counts.items():
+                frames :Tuple[str, ...] = callers + (self.label(address),)
+                result[frames] = result.get(frames, 0) + count
+        return result
+
+    def label_costs(self) -> List[Tuple[str, int, int]]:
+        """Cost of every label, most expensive first
+
+        Returns:
+            (label, self, total) : instructions executed inside the label, and inside it or anything it called
+        """
+        own :Dict[str, int] = {}
+        inclusive :Dict[str, int] = {}
+        for frames, count in self.collapsed_counts().items():
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            # a recursive label is only counted once per stack
+            for name in set(frames):
+                inclusive[name] = inclusive.get(name, 0) + count
+        rows = [(name, own.get(name, 0), total) for name, total in inclusive.items()]
+        return sorted(rows, key=lambda row: (-row[1], -row[2], row[0]))
+
+    def flamegraph(self) -> str:
+        """Collapsed stacks, one "frame;frame;frame count" line per stack, the input of flamegraph.pl and speedscope
+        """
+        lines :List[str] = [";".join(frames) + f" {count}" for frames, count in self.collapsed_counts().items()]
+        return "\n".join(sorted(lines)) + "\n"
+
+    def save_flamegraph(self, path :str):
+        with open(path, "w") as file:
+            file.write(self.flamegraph())
+
+    def report(self, top :int = 20) -> str:
+        """Text report : cost per label, per opcode and the hottest addresses
+
+        Args:
+            top (int, optional): number of addresses listed
+        """
+        total :int = self.total
+        def percent(count :int) -> str:
+            return f"{100 * count / total:6.2f}%" if total else "  0.00%"
+
+        lines :List[str] = [f"{total} instructions", "", f"{'label':<24} {'self':>10} {'':>7} {'total':>10} {'':>7}"]
+        for name, own, inclusive in self.label_costs():
+            lines.append(f"{name:<24} {own:>10} {percent(own)} {inclusive:>10} {percent(inclusive)}")
+
+        lines += ["", f"{'opcode':<24} {'count':>10}"]
+        for name, count in sorted(self.opcode_counts().items(), key=lambda item: (-item[1], item[0])):
+            lines.append(f"{name:<24} {count:>10} {percent(count)}")
+
+        lines += ["", f"{'address':>8} {'line':>6} {'location':<24} {'count':>10}"]
+        hottest = sorted(self.pc_counts().items(), key=lambda item: (-item[1], item[0]))[:top]
+        for address, count in hottest:
+            line = self.line_map.get(address)
+            lines.append(f"{address:>8} {line if line else '':>6} {self.label_offset(address):<24} {count:>10} {percent(count)}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,146 @@
+from typing import List, Dict, Tuple
+from Memory import ArraySegment
+
+# Copy on write snapshots of an emulator. Taking a snapshot copies the registers and the flags and starts a new
+# undo log per segment, no memory word is copied. The first write to a page after a snapshot saves the page
+# (a write hook runs before the words change), so a snapshot only holds the pages written until the next one.
+#
+#   snapshots   S0 ---------- S1 ---------- S2 ---------- now
+#   undo logs   pages written pages written pages written
+#               in [S0, S1)   in [S1, S2)   in [S2, now)
+#
+# The state of a page at Sk is in the first log from Sk on that saved it, or is still the current page.
+# Restoring Sk walks the logs from Sk to now, so it costs the pages written since Sk. Snapshots taken after Sk
+# are dropped, Sk itself stays valid and can be restored again.
+#
+# The allocation blocks of the segments are not part of a snapshot, running a program never allocates.
+
+# words per page, a page is copied as a whole the first time it is written after a snapshot
+PAGE_SIZE :int = 64
+
+class Snapshot:
+    """State of an emulator at some point, restore it with EmulatorV1.restore
+    """
+    __slots__ = ("regs", "flags", "result", "is_halted", "logs", "valid")
+
+    def __init__(self, regs :List[int], flags :List[int], result :int, is_halted :bool, logs :Tuple[Dict[int, bytes], ...]) -> None:
+        self.regs = regs
+        self.flags = flags
+        # the lazy flags result
+        self.result = result
+        self.is_halted = is_halted
+        # per segment, page -> its words at this snapshot, for the pages written before the next snapshot
+        self.logs = logs
+        # false once a restore to an older snapshot dropped it
+        self.valid :bool = True
+
+    @property
+    def size(self) -> int:
+        """Bytes of memory held by the snapshot pages
+        """
+        return sum(len(page) for log in self.logs for page in log.values())
+
+class PageTracker:
+    """Save the pages of a segment before their first write since the last snapshot
+    """
+    def __init__(self, segment :ArraySegment, page_size :int) -> None:
+        self.segment = segment
+        self.page_size = page_size
+        self.pages :int = (segment.size + page_size - 1) // page_size
+        # undo log of the newest snapshot
+        self.log :Dict[int, bytes] = {}
+        segment.write_hooks.append(self.save)
+
+    def save(self, index :int, size :int):
+        log = self.log
+        page_size :int = self.page_size
+        if size == 1:
+            # single words are most of the writes (stack), usually to a page already saved
+            page :int = index // page_size
+            if page not in log and page < self.pages:
+                log[page] = bytes(self.segment.view[page * page_size:(page + 1) * page_size])
+            return
+        # out of range writes raise right after the hooks, there is nothing to save
+        for page in range(index // page_size, min((index + size - 1) // page_size + 1, self.pages)):
+            if page not in log:
+                log[page] = bytes(self.segment.view[page * page_size:(page + 1) * page_size])
+
+    def restore(self, logs :List[Dict[int, bytes]]):
+        """Write back the oldest saved version of every page of the logs, oldest log first
+        """
+        # the restored pages are marked in a scratch log so the write hook does not save them again
+        restored :Dict[int, bytes] = {}
+        self.log = restored
+        for log in logs:
+            for page, words in log.items():
+                if page in restored:
+                    continue
+                restored[page] = words
+                self.segment.write_array(page * self.page_size, memoryview(words).cast(self.segment.typecode))
+        self.log = {}
+
+class Snapshots:
+    def __init__(self, emu :"EmulatorV1", page_size :int = PAGE_SIZE) -> None:
+        """Take and restore copy on write snapshots of an emulator, the registers, the flags and the three segments
+
+        Args:
+            emu (EmulatorV1): the emulator
+            page_size (int, optional): words per page, smaller pages make writes spread over memory cheaper to save
+        """
+        self.emu = emu
+        self.trackers :Tuple[PageTracker, ...] = tuple(PageTracker(segment, page_size) for segment in emu.memory.segments)
+        # live snapshots, oldest first
+        self.chain :List[Snapshot] = []
+
+    def take(self) -> Snapshot:
+        """Snapshot the emulator, nothing is copied from memory
+        """
+        logs :Tuple[Dict[int, bytes], ...] = tuple({} for tracker in self.trackers)
+        for tracker, log in zip(self.trackers, logs):
+            tracker.log = log
+        snapshot :Snapshot = Snapshot(list(self.emu.regs.regs), list(self.emu.flags.flags), self.emu.flags.result,
+                                      self.emu.is_halted, logs)
+        self.chain.append(snapshot)
+        return snapshot
+
+    def _position(self, snapshot :Snapshot) -> int:
+        if not snapshot.valid:
+            raise ValueError("the snapshot was dropped by a restore to an older one or forgotten")
+        for i in range(len(self.chain) - 1, -1, -1):
+            if self.chain[i] is snapshot:
+                return i
+        raise ValueError("the snapshot was not taken on this emulator")
+
+    def restore(self, snapshot :Snapshot):
+        """Put the emulator back in the state of a snapshot, the snapshots taken after it are dropped
+        """
+        position :int = self._position(snapshot)
+        for i, tracker in enumerate(self.trackers):
+            tracker.restore([newer.logs[i] for newer in self.chain[position:]])
+        for newer in self.chain[position + 1:]:
+            newer.valid = False
+        del self.chain[position + 1:]
+        # the memory is the snapshot one again, it starts a new log
+        snapshot.logs = tuple(tracker.log for tracker in self.trackers)
+        # in place, the run loops and the translated blocks hold the registers list
+        self.emu.regs.regs[:] = snapshot.regs
+        self.emu.flags.flags[:] = snapshot.flags
+        self.emu.flags.result = snapshot.result
+        self.emu.is_halted = snapshot.is_halted
+
+    def forget(self, snapshot :Snapshot):
+        """Drop a snapshot that will not be restored, its pages are kept by the previous one if they are needed
+        """
+        position :int = self._position(snapshot)
+        snapshot.valid = False
+        del self.chain[position]
+        if position == 0:
+            return
+        previous :Snapshot = self.chain[position - 1]
+        for log, pages in zip(previous.logs, snapshot.logs):
+            for page, words in pages.items():
+                log.setdefault(page, words)
+        if position == len(self.chain):
+            # the forgotten snapshot was the newest, its log was the one being written
+            for tracker, log in zip(self.trackers, previous.logs):
+                tracker.log = log
@@ -1,49 +1,156 @@
-from CPU import Symbol
+from CPU import Symbol, Operand
 from Memory import Memory, Segment
-from typing import Dict
-from Dbg import dbg, dbgassert
+from typing import Dict, List
+from Dbg import dbg, dbgassert, get_logger
+import sys
+
+log = get_logger("symbols")
+
+class SymbolEntry:
+    """A single symbol of the program
+    """
+    __slots__ = ("name", "type", "location", "size")
+
+    def __init__(self, name :str, typ :Symbol, location :int, size :int) -> None:
+        self.name = name
+        self.type = typ
+        # location inside the code segment for labels, inside the data segment for the rest
+        self.location = location
+        self.size = size
+
+    def __repr__(self) -> str:
+        return f"SymbolEntry({self.name}, {self.type.name}, {self.location}, {self.size})"
+
+class Relocation:
+    """An operand of the code segment that holds a symbol location, filled at link time
+    """
+    __slots__ = ("offset", "symbol", "kind")
+
+    def __init__(self, offset :int, symbol :int, kind :Operand) -> None:
+        # location of the operand inside the code segment (or inside its block before linking)
+        self.offset = offset
+        # id of the symbol inside the symbol map
+        self.symbol = symbol
+        self.kind = kind
+
+    def __repr__(self) -> str:
+        return f"Relocation({self.offset}, {self.symbol}, {self.kind.name})"
+
+class StringPool:
+    """The dc string literals of a program, interned and packed in one block of the data segment
+
+    A string is a word holding its length in bytes followed by its utf-8 bytes, word_size of them per word (the last
+    word is padded with zeros). Identical literals are stored once, their symbols share the location.
+    """
+    def __init__(self, word_size :int) -> None:
+        self.word_size = word_size
+        # the packed pool, appended to as literals are interned
+        self.buffer :bytearray = bytearray()
+        # utf-8 literal -> word offset of its length word inside the pool
+        self.offsets :Dict[bytes, int] = {}
+        # symbol name -> word offset of its string
+        self.symbols :Dict[str, int] = {}
+        # location of the pool inside the data segment, -1 until it is allocated
+        self.location :int = -1
+
+    @property
+    def size(self) -> int:
+        """Words of the pool
+        """
+        return len(self.buffer) // self.word_size
+
+    def intern(self, name :str, text :str) -> int:
+        """Add the string of a symbol to the pool, a literal already there is not stored again
+
+        Returns:
+            The words taken by the string, length word included
+        """
+        literal :bytes = text.encode("utf-8")
+        offset = self.offsets.get(literal)
+        if offset is None:
+            offset = self.size
+            self.offsets[literal] = offset
+            padding :int = -len(literal) % self.word_size
+            self.buffer += len(literal).to_bytes(self.word_size, sys.byteorder) + literal + bytes(padding)
+        self.symbols[name] = offset
+        return 1 + (len(literal) + self.word_size - 1) // self.word_size
+
 class SymbolMap():
     """Symbol Map to store information about program symbols
     """
     def __init__(self, mem :Memory) -> None:
         self.mem = mem
-        # store the location of each symbol inside memory
-        self.symbol_table :Dict[str, int] = {}
-        # store the type of each symbol
-        self.symbol_type :Dict[str, Symbol] = {}
-        
+        # symbol id -> symbol, ids are given in declaration order and never reused
+        self.symbols :List[SymbolEntry] = []
+        # symbol name -> symbol id
+        self.symbol_ids :Dict[str, int] = {}
+        self.strings :StringPool = StringPool(mem.word_size)
+
     def quick_dump(self):
-        for i, symbol in enumerate(self.symbol_table):
-            print(f"{i} {symbol} = {self.symbol_table[symbol]}")
-    
-    def get_symbol_index(self, name :str) -> int:
-        return list(self.symbol_table.keys()).index(name)
-    
-    def get_symbol_name_from_index(self, index :int) -> int:
-        try:
-            return list(self.symbol_table.keys())[index]
-        except IndexError:
-            print(f"Failed to get symbol by index {index}")
-            exit()
-    
-    def get_symbol(self, name :str):
-        if name not in self.symbol_table or name not in self.symbol_type:
-            dbg("Symbol not found ", name)
+        for i, entry in enumerate(self.symbols):
+            print(f"{i} {entry.name} = {entry.location}")
+
+    def has_symbol(self, name :str) -> bool:
+        return name in self.symbol_ids
+
+    def get_entry(self, name :str) -> SymbolEntry:
+        if name not in self.symbol_ids:
+            log.debug("Symbol not found %s", name)
             raise IndexError()
-        typ :Symbol = self.symbol_type[name]
-        location :int = self.symbol_table[name]
-        match typ:
-            # labels are stored in code
-            # return the start of the label code
-            case Symbol.LABEL:
-                return location
-            # all of these are stored in data segment
-            case Symbol.INTEGER | Symbol.SHORT | Symbol.DOUBLE | Symbol.BYTE | Symbol.STRING:
-                return location
-    
-    def update_symbol(self, name :str, newvalue : int):
-        self.symbol_table[name] = newvalue
-    
+        return self.symbols[self.symbol_ids[name]]
+
+    def get_symbol_type(self, name :str) -> Symbol:
+        return self.get_entry(name).type
+
+    def get_symbol_index(self, name :str) -> int:
+        if name not in self.symbol_ids:
+            raise ValueError(f"{name} is not in the symbol map")
+        return self.symbol_ids[name]
+
+    def get_symbol_name_from_index(self, index :int) -> str:
+        if 0 <= index < len(self.symbols):
+            return self.symbols[index].name
+        print(f"Failed to get symbol by index {index}")
+        exit()
+
+    def get_symbol(self, name :str) -> int:
+        # labels return the start of the label code, everything else lives in the data segment
+        return self.get_entry(name).location
+
+    def update_symbol(self, name :str, newvalue : int, size :int | None = None):
+        entry :SymbolEntry = self.get_entry(name)
+        entry.location = newvalue
+        if size is not None:
+            entry.size = size
+
+    def relocate(self, moved :Dict[int, int]):
+        """Follow the data blocks moved by a defragmentation of the data segment
+
+        Args:
+            moved (Dict[int, int]): old location -> new location
+        """
+        pool :int = self.strings.location
+        for entry in self.symbols:
+            if entry.type == Symbol.STRING:
+                # the strings live inside the pool block, they move with it
+                if pool in moved:
+                    entry.location += moved[pool] - pool
+            elif entry.type != Symbol.LABEL and entry.location in moved:
+                entry.location = moved[entry.location]
+        if pool in moved:
+            self.strings.location = moved[pool]
+
+    def _declare(self, symtype :Symbol, name :str, location :int, size :int):
+        if name in self.symbol_ids:
+            # redeclaring a symbol keeps its id
+            entry = self.symbols[self.symbol_ids[name]]
+            entry.type = symtype
+            entry.location = location
+            entry.size = size
+        else:
+            self.symbol_ids[name] = len(self.symbols)
+            self.symbols.append(SymbolEntry(name, symtype, location, size))
+
     def add_symbol(self, symtype :Symbol, name :str, value :int | str):
         """Add a new symbol into the symbol table, if it's a label the value will be equal to the size of the block, that way we can correctly allocate size for it
 
@@ -55,20 +162,38 @@ class SymbolMap():
         match symtype:
             case Symbol.INTEGER | Symbol.SHORT | Symbol.BYTE:
                 location = self.mem._alloc(Segment.DATA, 1)
-                self.symbol_type[name] = symtype
-                self.symbol_table[name] = location
+                self._declare(symtype, name, location, 1)
                 self.mem[Segment.DATA][location] = value
             case Symbol.DOUBLE:
                 location = self.mem._alloc(Segment.DATA, 2)
-                self.symbol_type[name] = symtype
-                self.symbol_table[name] = location
+                self._declare(symtype, name, location, 2)
                 self.mem[Segment.DATA][location] = value
             case Symbol.STRING:
-                dbg("Not ready yet")
-            
+                # the location is known once the whole pool is allocated, see allocate_strings
+                self._declare(symtype, name, -1, self.strings.intern(name, value))
+
             # the caller will provide us with the location inside code segment
             case Symbol.LABEL:
-                self.symbol_type[name] = symtype
-                self.symbol_table[name] = value
-            
-                
\ No newline at end of file
+                self._declare(symtype, name, value, 0)
+
+    def allocate_strings(self):
+        """Allocate the string pool in one block of the data segment, write it and give the string symbols their location
+        """
+        pool :StringPool = self.strings
+        if pool.size == 0 or pool.location >= 0:
+            return
+        pool.location = self.mem._alloc(Segment.DATA, pool.size)
+        self.mem.write_array(Segment.DATA, pool.location, memoryview(pool.buffer).cast(self.mem.data.typecode))
+        for name, offset in pool.symbols.items():
+            entry :SymbolEntry = self.get_entry(name)
+            if entry.type == Symbol.STRING:
+                entry.location = pool.location + offset
+
+    def get_string(self, name :str) -> str:
+        """Read the string of a dc symbol back from the data segment
+        """
+        data = self.mem[Segment.DATA]
+        location :int = self.get_entry(name).location
+        length :int = data[location]
+        words :int = (length + self.mem.word_size - 1) // self.mem.word_size
+        return bytes(data[location + 1:location + 1 + words])[:length].decode("utf-8")
@@ -0,0 +1,292 @@
+from typing import List, Dict, Tuple, Callable
+from CPU import Register, Operand, Instructions, PARITY
+from Dispatch import (PC, AR, ST, MASK, Handler, DISPATCH_TABLE, halt, nop, jmp, call,
+                      mov_reg_imm, mov_reg_reg, mov_reg_value, add_reg_imm, add_reg_reg, add_reg_value,
+                      sub_reg_imm, sub_reg_reg, sub_reg_value, cmp_reg_imm, cmp_reg_reg, cmp_reg_value,
+                      push_imm, push_reg, push_value, pop_reg, jz, jnz, js, jns, jp, jnp,
+                      assert_reg_imm, assert_reg_reg, assert_reg_value)
+from Dbg import get_logger
+
+# A basic block is a straight run of instructions ending with a jump, CALL or HALT. The translator turns each one
+# into the source of a python function doing the work of the Dispatch.py handlers of its instructions, compiles it
+# once and caches it by start address. Inside a block PC and AR are only written when they are needed, everything
+# is done on the registers list directly.
+#
+# The flag setting instructions only store their result in emu.flags when it can be read : by a jump, after an
+# exception or after the block. A result replaced by the next flag setting instruction of the block is not stored.
+
+log = get_logger("translator")
+
+# longest block, a run without any jump is cut there
+MAX_BLOCK_INSTRUCTIONS :int = 64
+
+# handlers ending a block, the emitted code sets PC and AR itself
+TERMINATORS :Tuple[Handler, ...] = (halt, jmp, call, jz, jnz, js, jns, jp, jnp)
+
+def _name(reg :int) -> str:
+    return Register.from_index(reg).name
+
+# Every emitter gets the decoded instruction and its address and returns the python statements doing its work.
+# The registers list is r, the data and stack segments are data and stack. Reads go to the arrays behind them
+# (dm and sm) without the segment call, stack writes too unless the stack has write hooks.
+Emitter = Callable[["DecodedInstruction", int], List[str]]
+
+def _emit_halt(decoded, address) -> List[str]:
+    return [f"r[{PC}] = r[{AR}] = {address}", "emu.is_halted = True"]
+
+def _emit_nop(decoded, address) -> List[str]:
+    return []
+
+def _emit_jmp(decoded, address) -> List[str]:
+    return [f"r[{PC}] = r[{AR}] = {decoded.operands[0]}"]
+
+def _push(value :str) -> List[str]:
+    """Statements pushing the value of a python expression on the stack
+    """
+    return [f"if hooks: stack[r[{ST}]] = {value}",
+            f"else: sm[r[{ST}]] = {value} & smask",
+            f"r[{ST}] = (r[{ST}] + 1) & {MASK}"]
+
+def _emit_call(decoded, address) -> List[str]:
+    return _push(str((address + decoded.size) & MASK)) + [f"r[{PC}] = r[{AR}] = {decoded.operands[0]}"]
+
+def _emit_mov_imm(decoded, address) -> List[str]:
+    reg, value = decoded.operands
+    return [f"r[{reg}] = {value & MASK}"]
+
+def _emit_mov_reg(decoded, address) -> List[str]:
+    reg, src = decoded.operands
+    return [f"r[{reg}] = r[{src}]"]
+
+def _emit_mov_value(decoded, address) -> List[str]:
+    reg, location = decoded.operands
+    return [f"r[{reg}] = dm[{location}] & {MASK}"]
+
+def _result(reg :int | None, flags :bool, value :str) -> List[str]:
+    """Statements storing the result of a flag setting instruction in a register and in the flags
+    """
+    target :str = ("f.result = " if flags else "") + (f"r[{reg}] = " if reg is not None else "")
+    return [target + value] if target else []
+
+def _arithmetic(operator :str, store :bool = True) -> Tuple[Emitter, Emitter, Emitter]:
+    """Emitters of the imm, reg and value forms of an arithmetic REGISTER, x instruction. The result goes to the
+    register unless store is False (CMP), and to the flags when flags is True
+    """
+    def imm(decoded, address, flags :bool = True):
+        reg, value = decoded.operands
+        return _result(reg if store else None, flags, f"(r[{reg}] {operator} {value}) & {MASK}")
+    def reg(decoded, address, flags :bool = True):
+        reg, src = decoded.operands
+        return _result(reg if store else None, flags, f"(r[{reg}] {operator} r[{src}]) & {MASK}")
+    def value(decoded, address, flags :bool = True):
+        reg, location = decoded.operands
+        if not store and not flags:
+            # the read can still fault
+            return [f"dm[{location}]"]
+        return _result(reg if store else None, flags, f"(r[{reg}] {operator} dm[{location}]) & {MASK}")
+    return imm, reg, value
+
+_add = _arithmetic("+")
+_sub = _arithmetic("-")
+_cmp = _arithmetic("-", store=False)
+
+def _branch(condition :str) -> Emitter:
+    """Emitter of a conditional jump, condition is a python expression of the flags result f.result
+    """
+    def branch(decoded, address):
+        return [f"if {condition}: r[{PC}] = r[{AR}] = {decoded.operands[0]}",
+                f"else: r[{PC}] = r[{AR}] = {(address + decoded.size) & MASK}"]
+    return branch
+
+def _emit_push_imm(decoded, address) -> List[str]:
+    return _push(str(decoded.operands[0]))
+
+def _emit_push_reg(decoded, address) -> List[str]:
+    return _push(f"r[{decoded.operands[0]}]")
+
+def _emit_push_value(decoded, address) -> List[str]:
+    return _push(f"dm[{decoded.operands[0]}]")
+
+def _emit_pop_reg(decoded, address) -> List[str]:
+    # the segment refuses negative indexes, the array would wrap around
+    return [f"t = r[{ST}] - 1",
+            "if t < 0: raise IndexError()",
+            f"r[{decoded.operands[0]}] = sm[t] & {MASK}",
+            "if hooks: stack[t] = 0",
+            "else: sm[t] = 0",
+            f"r[{ST}] = t & {MASK}"]
+
+def _emit_assert_imm(decoded, address) -> List[str]:
+    reg, value = decoded.operands
+    return [f"assert r[{reg}] == {value}, {repr(f'{_name(reg)} is not equal to {value}')}"]
+
+def _emit_assert_reg(decoded, address) -> List[str]:
+    reg, src = decoded.operands
+    return [f"assert r[{reg}] == r[{src}], {repr(f'{_name(reg)} is not equal to {_name(src)} which is ')} + str(r[{src}])"]
+
+def _emit_assert_value(decoded, address) -> List[str]:
+    reg, location = decoded.operands
+    return [f"v = dm[{location}]",
+            f"assert r[{reg}] == v, {repr(f'{_name(reg)} is not equal to the symbol at {location} which is ')} + str(v)"]
+
+def _source(kind :Operand, operand :int) -> str:
+    if kind == Operand.REGISTER:
+        return f"r[{operand}]"
+    if kind == Operand.VALUE:
+        return f"dm[{operand}]"
+    return str(operand)
+
+def _emit_movadd(decoded, address, flags :bool = True) -> List[str]:
+    reg, source1, source2 = decoded.operands
+    kind1, kind2 = decoded.operand_types[1:]
+    return _result(reg, flags, f"({_source(kind1, source1)} + {_source(kind2, source2)}) & {MASK}")
+
+# handler -> emitter, instructions whose handler is not here are left to the interpreter
+EMITTERS :Dict[Handler, Emitter] = {
+    halt: _emit_halt, nop: _emit_nop, jmp: _emit_jmp, call: _emit_call,
+    mov_reg_imm: _emit_mov_imm, mov_reg_reg: _emit_mov_reg, mov_reg_value: _emit_mov_value,
+    add_reg_imm: _add[0], add_reg_reg: _add[1], add_reg_value: _add[2],
+    sub_reg_imm: _sub[0], sub_reg_reg: _sub[1], sub_reg_value: _sub[2],
+    cmp_reg_imm: _cmp[0], cmp_reg_reg: _cmp[1], cmp_reg_value: _cmp[2],
+    jz: _branch("f.result == 0"), jnz: _branch("f.result != 0"), js: _branch("f.result >> 31"),
+    jns: _branch("not f.result >> 31"), jp: _branch("PARITY[f.result & 0xFF]"), jnp: _branch("not PARITY[f.result & 0xFF]"),
+    push_imm: _emit_push_imm, push_reg: _emit_push_reg, push_value: _emit_push_value, pop_reg: _emit_pop_reg,
+    assert_reg_imm: _emit_assert_imm, assert_reg_reg: _emit_assert_reg, assert_reg_value: _emit_assert_value,
+}
+
+# handlers that can raise (stack or data access, failed assert), PC must point at them if they do
+FAULTING :List[Handler] = [call, mov_reg_value, add_reg_value, sub_reg_value, cmp_reg_value, push_imm, push_reg, push_value,
+                           pop_reg, assert_reg_imm, assert_reg_reg, assert_reg_value]
+
+# handlers setting the flags, their emitters take a third argument telling if the result must be stored
+FLAG_SETTERS :List[Handler] = [add_reg_imm, add_reg_reg, add_reg_value, sub_reg_imm, sub_reg_reg, sub_reg_value,
+                               cmp_reg_imm, cmp_reg_reg, cmp_reg_value]
+
+# the MOVADD handlers are built per operand kinds
+for (opcode, kinds), handler in DISPATCH_TABLE.items():
+    if opcode == Instructions.MOVADD.index() and handler is not nop:
+        EMITTERS[handler] = _emit_movadd
+        FLAG_SETTERS.append(handler)
+        if Operand.VALUE in kinds:
+            FAULTING.append(handler)
+
+class TranslatedBlock:
+    """A compiled basic block covering the code range [start, end)
+    """
+    __slots__ = ("start", "end", "count", "function", "source")
+
+    def __init__(self, start :int, end :int, count :int, function :Callable, source :str) -> None:
+        self.start = start
+        self.end = end
+        # number of instructions, the emulator counts them as executed when the block runs
+        self.count = count
+        self.function = function
+        self.source = source
+
+    def __repr__(self) -> str:
+        return f"TranslatedBlock({self.start}, {self.end}, {self.count})"
+
+class Translator:
+    def __init__(self, emu :"EmulatorV1") -> None:
+        """Translate the basic blocks of an emulator code segment into python functions
+
+        Args:
+            emu (EmulatorV1): the emulator, its decode cache is used to read the instructions
+        """
+        self.emu = emu
+        # start address -> block, None when the instruction there can not be translated
+        self.blocks :Dict[int, TranslatedBlock | None] = {}
+        emu.memory.code.write_hooks.append(self.invalidate)
+
+    def invalidate(self, index :int, size :int):
+        """Drop every block overlapping the written range [index, index+size)
+        """
+        for start, block in list(self.blocks.items()):
+            # an instruction that could not be translated may have been rewritten too
+            if block is None or (start < index + size and block.end > index):
+                del self.blocks[start]
+
+    def translate(self, address :int) -> TranslatedBlock | None:
+        """Translate the block starting at address and cache it
+
+        Returns:
+            the block, or None if the first instruction can not be translated
+        """
+        # (address, decoded instruction, emitter, uses PC or AR) of the instructions of the block
+        instructions :List[Tuple[int, "DecodedInstruction", Emitter, bool]] = []
+        current :int = address
+        while len(instructions) < MAX_BLOCK_INSTRUCTIONS:
+            decoded = self.emu.decode(current)
+            emitter = EMITTERS.get(decoded.handler)
+            if emitter is None:
+                break
+            # PC and AR are only kept up to date at the end of the block, an instruction using them needs them now
+            uses_pc :bool = any(kind == Operand.REGISTER and operand in (PC, AR)
+                                for kind, operand in zip(decoded.operand_types, decoded.operands))
+            instructions.append((current, decoded, emitter, uses_pc))
+            current += decoded.size
+            if decoded.handler in TERMINATORS or uses_pc:
+                break
+        if not instructions:
+            self.blocks[address] = None
+            return None
+
+        # a result is stored in emu.flags only if it can be read before the next flag setting instruction : by a
+        # jump, after an exception, or after the block
+        live :List[bool] = [False] * len(instructions)
+        read :bool = True
+        for i in range(len(instructions) - 1, -1, -1):
+            handler = instructions[i][1].handler
+            reads_here :bool = handler in FAULTING or handler in TERMINATORS or instructions[i][3]
+            if handler in FLAG_SETTERS:
+                live[i] = read
+                read = reads_here
+            else:
+                read = read or reads_here
+
+        lines :List[str] = []
+        # set once the emitted code wrote PC and AR itself
+        ended :bool = False
+        for i, (current, decoded, emitter, uses_pc) in enumerate(instructions):
+            if decoded.handler in FAULTING:
+                lines.append(f"at = {current}")
+            if uses_pc:
+                lines.append(f"r[{PC}] = r[{AR}] = {current}")
+            if decoded.handler in FLAG_SETTERS:
+                lines.extend(emitter(decoded, current, live[i]))
+            else:
+                lines.extend(emitter(decoded, current))
+            if decoded.handler in TERMINATORS:
+                ended = True
+            elif uses_pc:
+                # the instruction may have written PC, move from its value like Dispatch._advance does
+                lines.append(f"r[{PC}] = r[{AR}] = (r[{PC}] + {decoded.size}) & {MASK}")
+                ended = True
+        current = instructions[-1][0] + instructions[-1][1].size
+        count :int = len(instructions)
+        if not ended:
+            # cut by the size limit or by an instruction left to the interpreter
+            lines.append(f"r[{PC}] = r[{AR}] = {current & MASK}")
+
+        body :str = "\n".join("        " + line for line in lines)
+        source :str = (f"def block(emu):\n"
+                       f"    r = emu.regs.regs\n"
+                       f"    data = emu.memory.data\n"
+                       f"    stack = emu.memory.stack\n"
+                       f"    dm = data.memory\n"
+                       f"    sm = stack.memory\n"
+                       f"    smask = stack.mask\n"
+                       f"    hooks = stack.write_hooks\n"
+                       f"    f = emu.flags\n"
+                       f"    at = {address}\n"
+                       f"    try:\n{body}\n"
+                       f"    except BaseException:\n"
+                       f"        r[{PC}] = r[{AR}] = at\n"
+                       f"        raise\n")
+        namespace :Dict = {"PARITY": PARITY}
+        exec(compile(source, f"<block {address}>", "exec"), namespace)
+        block :TranslatedBlock = TranslatedBlock(address, current, count, namespace["block"], source)
+        self.blocks[address] = block
+        if log.enabled:
+            log.debug("translated %s\n%s", block, source)
+        return block
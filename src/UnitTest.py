@@ -1,49 +1,690 @@
 from Memory import UnitTestMemory
-from AssemblerV2 import AssemblerV2
+from MemoryV2 import MemoryV2UnitTests
+from AssemblerV2 import AssemblerV2, ASSEMBLER_VERSION
 from Emulator import EmulatorV1
-from Memory import Segment
-import os, pathlib
-from typing import Dict, List
-from Dbg import dbg
+from Debugger import Debugger, Breakpoint
+from Memory import Segment, Memory
+from CPU import Register, Symbol, Operand
+from SymbolMap import SymbolMap
+from Lexer import TokenKind, lex_line, MNEMONICS, REGISTERS
+from Image import Image, load_image, IMAGE_VERSION, HEADER, SECTION_ALIGNMENT
+from MultiCore import MultiCore, CoreStatus
+from Linker import build, LinkError, assemble_object
+from Host import Host, Session
+from BatchEmulator import BatchEmulator
+import BatchEmulator as batch_engine
+import Linker
+import tempfile
+from multiprocessing.connection import Connection, wait
+from xml.etree import ElementTree
+import os, pathlib, hashlib, time, json, argparse, sys, multiprocessing, asyncio, struct
+from typing import Dict, List, Tuple
+from Dbg import dbg, DbgUnitTests
 import Dbg
-Dbg.is_debug = False
+Dbg.set_debug(False)
 
-unit_tests_folder :str = "\\tests"
+unit_tests_folder :pathlib.Path = pathlib.Path(__file__).resolve().parent.parent / "tests"
+cache_folder :pathlib.Path = pathlib.Path(__file__).resolve().parent.parent / ".oacache"
 
+# instructions executed between two wall clock checks
+QUANTUM :int = 10000
+# seconds a worker may run past the wall clock budget of its test before the runner kills it
+GRACE :float = 1.0
 
 def assert_memory(assm :AssemblerV2, segment :Segment, index :int, value :int|List[int]):
-    red = assm.memory.read_array(segment, index, len(value))
+    red = assm.memory.read_array(segment, index, len(value)).tolist()
     if  red == value:
         return True
     else:
         raise Exception(f"ASSERT_MEMORY Failed : Value at index {index} was {red}, expected {value}")
 
-if __name__ == "__main__":
+# data, stack and string reads, calls and flag driven jumps, used by the unit tests comparing two ways of running a program
+STATE_PROGRAM :str = """v: di 3
+w: di 0
+text: dc "state"
+
+JMP main
+
+main:
+MOV x1, 10
+MOV x0, 0
+
+loop:
+ADD x0, [v]
+PUSH x0
+PUSH 7
+POP x2
+POP x2
+CMP x1, 5
+JNS big
+ADD x0, 1
+
+big:
+MOV x2, 2
+XADD [w], x2
+SUB x1, 1
+JNZ loop
+MOV x2, [text]
+CALL done
+
+done:
+POP x1
+HALT
+"""
+
+def program_of(program :AssemblerV2 | Image) -> Tuple:
+    """Everything the emulator runs : the used code and data words, the symbols and the relocations
+    """
+    memory = program.memory
+    return (memory.code[0:memory.code.used_size()].tolist(), memory.data[0:memory.data.used_size()].tolist(),
+            [(entry.name, entry.type, entry.location, entry.size) for entry in program.symbol_map.symbols],
+            sorted((relocation.offset, relocation.symbol, relocation.kind) for relocation in program.relocations.values()))
+
+def final_state(emu :EmulatorV1) -> Tuple:
+    """Registers, flags, data and stack segments of an emulator
+    """
+    return (list(emu.regs.regs), list(emu.flags.flags), emu.flags.result, emu.is_halted,
+            bytes(emu.memory.data.view), bytes(emu.memory.stack.view))
+
+def run_program(program :AssemblerV2 | Image, budget :int = 100_000, **options) -> EmulatorV1:
+    # the emulator runs on the memory of the program, two runs to compare need two assemblies (or loads)
+    emu :EmulatorV1 = EmulatorV1(program, **options)
+    emu.run(budget)
+    assert emu.is_halted, ("ERROR the program did not halt")
+    return emu
+
+def load_program(path :pathlib.Path, cache :pathlib.Path | None) -> AssemblerV2 | Image:
+    """Assemble a test program, the executable image is cached by the hash of its source, the image format and the
+    assembler versions
+    """
+    source :str = path.read_text()
+    if cache is None:
+        return AssemblerV2(source)
+    key :str = hashlib.sha256(f"{IMAGE_VERSION}\n{ASSEMBLER_VERSION}\n{source}".encode()).hexdigest()
+    cached :pathlib.Path = cache / (key + ".oai")
+    if cached.is_file():
+        return load_image(str(cached))
+    assembler :AssemblerV2 = AssemblerV2(source)
+    cache.mkdir(parents=True, exist_ok=True)
+    # write then rename, so a worker never reads a half written image
+    temporary :pathlib.Path = cached.with_suffix(f".{os.getpid()}.tmp")
+    assembler.save(str(temporary))
+    os.replace(temporary, cached)
+    return assembler
+
+def run_test(path :str, max_instructions :int, timeout :float, cache :str | None) -> Dict:
+    """Assemble and run a single test program, this is what the worker processes execute
+
+    Returns:
+        the result of the test : name, status (passed, failed, error, timeout), executed instructions, time and message
+    """
+    start :float = time.perf_counter()
+    result :Dict = {"name": pathlib.Path(path).name, "status": "passed", "instructions": 0, "time": 0.0, "message": ""}
+    try:
+        assembler :AssemblerV2 | Image = load_program(pathlib.Path(path), pathlib.Path(cache) if cache else None)
+        emu :EmulatorV1 = EmulatorV1(assembler)
+        deadline :float = start + timeout
+        while not emu.is_halted:
+            if result["instructions"] >= max_instructions:
+                result["status"] = "timeout"
+                result["message"] = f"instruction budget of {max_instructions} exhausted"
+                break
+            if time.perf_counter() > deadline:
+                result["status"] = "timeout"
+                result["message"] = f"wall clock budget of {timeout}s exhausted"
+                break
+            result["instructions"] += emu.run(min(QUANTUM, max_instructions - result["instructions"]))
+    except AssertionError as e:
+        result["status"] = "failed"
+        result["message"] = str(e)
+    except BaseException as e:
+        # the assembler calls exit() on malformed programs, it must not take the worker down
+        result["status"] = "error"
+        result["message"] = f"{type(e).__name__}: {e}"
+    result["time"] = time.perf_counter() - start
+    return result
+
+def _worker(connection :Connection, path :str, max_instructions :int, timeout :float, cache :str | None):
+    connection.send(run_test(path, max_instructions, timeout, cache))
+    connection.close()
+
+def _killed(path :pathlib.Path, status :str, message :str, elapsed :float) -> Dict:
+    return {"name": path.name, "status": status, "instructions": 0, "time": elapsed, "message": message}
+
+def run_tests(files :List[pathlib.Path], jobs :int | None, max_instructions :int, timeout :float, cache :pathlib.Path | None) -> List[Dict]:
+    """Run every test in its own worker process, at most jobs at once
+
+    The workers check the budgets between emulator slices, the runner also enforces the wall clock budget itself :
+    a worker still running GRACE seconds after its budget (stuck assembling...) is killed and its test times out,
+    a worker that dies without a result is an error. Either way the other tests go on
+    """
+    jobs = jobs or os.cpu_count() or 1
+    results :List[Dict | None] = [None] * len(files)
+    pending :List[int] = list(range(len(files)))
+    # test index -> (worker, result pipe, start time)
+    running :Dict[int, Tuple[multiprocessing.Process, Connection, float]] = {}
+    while pending or running:
+        while pending and len(running) < jobs:
+            i :int = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            worker = multiprocessing.Process(target=_worker, args=(sender, str(files[i]), max_instructions, timeout, str(cache) if cache else None), daemon=True)
+            worker.start()
+            # the worker holds the only writer, the pipe reports the end of file when it dies
+            sender.close()
+            running[i] = (worker, receiver, time.perf_counter())
+        deadline :float = min(start for worker, receiver, start in running.values()) + timeout + GRACE
+        wait([receiver for worker, receiver, start in running.values()], max(0.0, deadline - time.perf_counter()))
+        now :float = time.perf_counter()
+        for i, (worker, receiver, start) in list(running.items()):
+            if receiver.poll():
+                try:
+                    results[i] = receiver.recv()
+                except EOFError:
+                    worker.join()
+                    results[i] = _killed(files[i], "error", f"worker crashed with exit code {worker.exitcode}", now - start)
+            elif now - start > timeout + GRACE:
+                worker.kill()
+                results[i] = _killed(files[i], "timeout", f"wall clock budget of {timeout}s exhausted, worker killed", now - start)
+            else:
+                continue
+            worker.join()
+            receiver.close()
+            del running[i]
+    return results
+
+def write_junit(results :List[Dict], path :str):
+    suite = ElementTree.Element("testsuite", name="OpenArchitecture", tests=str(len(results)),
+                                failures=str(sum(r["status"] == "failed" for r in results)),
+                                errors=str(sum(r["status"] in ("error", "timeout") for r in results)),
+                                time=f"{sum(r['time'] for r in results):.6f}")
+    for result in results:
+        case = ElementTree.SubElement(suite, "testcase", classname="tests", name=result["name"], time=f"{result['time']:.6f}")
+        if result["status"] == "failed":
+            ElementTree.SubElement(case, "failure", message=result["message"])
+        elif result["status"] != "passed":
+            ElementTree.SubElement(case, "error", message=result["message"], type=result["status"])
+    ElementTree.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+
+def StreamingUnitTests():
+    # a streamed file assembles to the program of the loaded file, with the same source lines
+    with tempfile.TemporaryDirectory() as folder:
+        state :pathlib.Path = pathlib.Path(folder) / "state.s"
+        state.write_text(STATE_PROGRAM)
+        for path in sorted(unit_tests_folder.glob("*.s")) + [state]:
+            streamed :AssemblerV2 = AssemblerV2(str(path), streaming=True)
+            loaded :AssemblerV2 = AssemblerV2(str(path))
+            assert streamed.parser.streaming and not streamed.parser.blocks, ("ERROR in BlockParser, the streamed file was loaded")
+            assert program_of(streamed) == program_of(loaded), (f"ERROR in BlockParser, {path.name} streamed is not the loaded program")
+            assert streamed.line_map == loaded.line_map, (f"ERROR in BlockParser, {path.name} streamed has other source lines")
+
+def ImageUnitTests():
+    assm :AssemblerV2 = AssemblerV2(STATE_PROGRAM)
+    with tempfile.TemporaryDirectory() as folder:
+        path :str = os.path.join(folder, "state.oai")
+        assm.save(path)
+        image :Image = load_image(path)
+        assert program_of(image) == program_of(assm), ("ERROR in load_image, the image is not the saved program")
+        assert final_state(run_program(image)) == final_state(run_program(assm)), ("ERROR in load_image, the image runs differently")
+        # the words are little endian whatever the host
+        with open(path, "rb") as file:
+            raw :bytes = file.read()
+        fields = HEADER.unpack_from(raw, 0)
+        code_used, code_offset = fields[6], fields[8]
+        assert raw[code_offset:code_offset + code_used * 4] == struct.pack(f"<{code_used}I", *assm.memory.code[0:code_used]), ("ERROR in write_image, the code words are not little endian")
+        # the loaded segments are copy on write, running the image never changes the file
+        image.memory.code[0] = 0
+        assert pathlib.Path(path).read_bytes() == raw, ("ERROR in load_image, a write to the segments reached the file")
+        # the segments of a paged program cover the address space, only their used words go to the file
+        paged :AssemblerV2 = AssemblerV2(STATE_PROGRAM, paged=True)
+        # a symbol past 2**31 words, the locations of the symbols are unsigned
+        far :int = 2**31 + 5
+        paged.symbol_map._declare(Symbol.INTEGER, "far", far, 1)
+        paged.save(path)
+        assert os.path.getsize(path) < 4 * SECTION_ALIGNMENT, ("ERROR in write_image, the image of a paged program is not as small as the program")
+        image = load_image(path)
+        assert image.memory.code.size == paged.memory.code.size and image.memory.data.size == paged.memory.data.size, ("ERROR in load_image, wrong segment sizes")
+        assert program_of(image) == program_of(paged), ("ERROR in load_image, the paged image is not the saved program")
+        assert image.symbol_map.get_symbol("far") == far, ("ERROR in load_image, wrong location past 2**31")
+        used :int = paged.memory.data.used_size()
+        loaded, assembled = [(emu.regs.regs, emu.flags.result, emu.memory.data[0:used].tolist()) for emu in (run_program(image), run_program(paged))]
+        assert loaded == assembled, ("ERROR in load_image, the paged image runs differently")
+        # a program with assembly errors is never written
+        broken :str = os.path.join(folder, "broken.oai")
+        try:
+            AssemblerV2("JMP main\n\nmain:\nMOV x0,\nHALT\n").save(broken)
+        except ValueError:
+            pass
+        assert not os.path.exists(broken), ("ERROR in save, the image of a program with errors was written")
+
+def BlockCacheUnitTests():
+    with tempfile.TemporaryDirectory() as folder:
+        for optimize in (False, True):
+            first :AssemblerV2 = AssemblerV2(STATE_PROGRAM, cache_dir=folder, optimize=optimize)
+            cached :AssemblerV2 = AssemblerV2(STATE_PROGRAM, cache_dir=folder, optimize=optimize)
+            assert cached.block_cache.hits > 0 and cached.block_cache.misses == 0, ("ERROR in the block cache, unchanged blocks were encoded again")
+            assert program_of(cached) == program_of(first) == program_of(AssemblerV2(STATE_PROGRAM, optimize=optimize)), ("ERROR in the block cache, the cached program differs")
+            # a changed block is encoded again, the others still come from the cache
+            source :str = STATE_PROGRAM.replace("MOV x2, 2", "MOV x2, 4")
+            changed :AssemblerV2 = AssemblerV2(source, cache_dir=folder, optimize=optimize)
+            assert changed.block_cache.misses == 1 and changed.block_cache.hits > 0, ("ERROR in the block cache, a changed block was reused")
+            assert program_of(changed) == program_of(AssemblerV2(source, optimize=optimize)), ("ERROR in the block cache, the changed program differs")
+
+def TranslatorUnitTests():
+    for source in (STATE_PROGRAM, (unit_tests_folder / "loop.s").read_text()):
+        interpreted :EmulatorV1 = EmulatorV1(AssemblerV2(source))
+        count :int = interpreted.run(100_000)
+        translated :EmulatorV1 = run_program(AssemblerV2(source), translate=True)
+        assert any(block is not None for block in translated.translator.blocks.values()), ("ERROR in the translator, nothing was translated")
+        assert final_state(translated) == final_state(interpreted), ("ERROR in the translator, the final state differs from the interpreter")
+        # budgets ending inside the blocks, the rest of a block is interpreted
+        sliced :EmulatorV1 = EmulatorV1(AssemblerV2(source), translate=True)
+        executed :int = 0
+        while not sliced.is_halted:
+            executed += sliced.run(7)
+        assert executed == count and final_state(sliced) == final_state(interpreted), ("ERROR in the translator, a budget inside a block changed the run")
+
+# every rewrite of the optimizer, MOVADD included, in a loop closed by a flag driven jump
+OPTIMIZER_PROGRAM :str = """v: di 3
+w: di 0
+
+JMP main
+
+main:
+MOV x0, 0
+MOV x2, 0
+
+loop:
+MOV x1, x0
+ADD x1, [v]
+ADD x2, 1
+ADD x2, 2
+PUSH x1
+POP x2
+MOV x1, 0
+ADD x1, 4
+MOV x1, 7
+XADD [w], x1
+ADD x0, 1
+CMP x0, 20
+JNZ loop
+HALT
+"""
+
+def OptimizerUnitTests():
+    def state(emu :EmulatorV1) -> Tuple:
+        # the code moves, PC and AR differ. A PUSH POP pair does not leave its word on the stack once it is a MOV
+        regs :List[int] = [value for i, value in enumerate(emu.regs.regs) if i not in (Register.PC.value, Register.AR.value)]
+        return (regs, list(emu.flags.flags), emu.flags.result, bytes(emu.memory.data.view))
+    # CALL pushes a code location, it moves with the optimizer
+    for source in (OPTIMIZER_PROGRAM, STATE_PROGRAM.replace("CALL done", "PUSH x2")):
+        expected :EmulatorV1 = EmulatorV1(AssemblerV2(source))
+        count :int = expected.run(100_000)
+        emu :EmulatorV1 = EmulatorV1(AssemblerV2(source, optimize=True))
+        assert emu.run(100_000) < count and emu.is_halted, ("ERROR in the optimizer, the program was not shortened")
+        assert state(emu) == state(expected), ("ERROR in the optimizer, the optimized program ends in another state")
+        assert state(run_program(AssemblerV2(source, optimize=True), translate=True)) == state(expected), ("ERROR in the optimizer, the translated optimized program ends in another state")
+    assert AssemblerV2(OPTIMIZER_PROGRAM, optimize=True).memory.code.used_size() < AssemblerV2(OPTIMIZER_PROGRAM).memory.code.used_size(), ("ERROR in the optimizer, the code did not shrink")
+
+def ProfilerUnitTests():
+    count :int = EmulatorV1(AssemblerV2(STATE_PROGRAM)).run(100_000)
+    # the emulator trace is on when debugging, a profiled cycle must still go through the profiler
+    Dbg.set_level(Dbg.Level.DEBUG, "emulator")
+    try:
+        emu :EmulatorV1 = EmulatorV1(AssemblerV2(STATE_PROGRAM), profile=True)
+        emu.cycle()
+    finally:
+        Dbg.reset_level("emulator")
+    assert emu.is_halted and emu.profiler.total == count, ("ERROR in the profiler, the executed instructions were not counted")
+    costs = {name: own for name, own, inclusive in emu.profiler.label_costs()}
+    assert costs.get("loop", 0) > 0 and costs.get("big", 0) > 0, ("ERROR in the profiler, a label has no cost")
+    assert emu.profiler.opcode_counts().get("XADD") == 10, ("ERROR in the profiler, wrong opcode count")
+    assert "big;done 1" in emu.profiler.flamegraph().splitlines(), ("ERROR in the profiler, the call is not in the flamegraph")
+
+def SnapshotUnitTests():
+    expected :Tuple = final_state(run_program(AssemblerV2(STATE_PROGRAM)))
+    emu :EmulatorV1 = EmulatorV1(AssemblerV2(STATE_PROGRAM))
+    start :Tuple = final_state(emu)
+    first = emu.snapshot()
+    emu.run(30)
+    middle :Tuple = final_state(emu)
+    second = emu.snapshot()
+    emu.run(100_000)
+    assert final_state(emu) == expected, ("ERROR in the snapshots, they changed the run")
+    # the run wrote w (XADD) and the stack since both snapshots
+    emu.restore(second)
+    assert final_state(emu) == middle, ("ERROR in restore, the state is not the one of the snapshot")
+    emu.run(100_000)
+    assert final_state(emu) == expected, ("ERROR in restore, the run from a restored snapshot differs")
+    emu.restore(first)
+    assert final_state(emu) == start and not second.valid, ("ERROR in restore, the state is not the one of the first snapshot")
+    emu.run(100_000)
+    assert final_state(emu) == expected, ("ERROR in restore, the run from the first snapshot differs")
+    # the first snapshot stays valid after its restore
+    emu.restore(first)
+    assert final_state(emu) == start, ("ERROR in restore, a snapshot can not be restored twice")
+
+def DebuggerUnitTests():
+    expected :Tuple = final_state(run_program(AssemblerV2(STATE_PROGRAM)))
+    emu :EmulatorV1 = EmulatorV1(AssemblerV2(STATE_PROGRAM))
+    debugger :Debugger = Debugger(emu)
+    loop :int = emu.symbol_map.get_symbol("loop")
+    debugger.add_breakpoint("loop", "x1 == 3")
+    assert debugger.cont() == "breakpoint", ("ERROR in the debugger, the conditional breakpoint did not stop")
+    assert emu.regs[Register.AR] == loop and emu.regs[Register.x1] == 3, ("ERROR in the debugger, stopped at the wrong place")
+    debugger.remove_breakpoint("loop")
+    w :int = emu.symbol_map.get_symbol("w")
+    before :int = emu.memory.data[w]
+    watch = debugger.watch_symbol("w")
+    assert debugger.cont() == "watchpoint", ("ERROR in the debugger, the watch on a written symbol did not stop")
+    assert [(hit, index, old) for hit, index, old in debugger.watch_hits] == [(watch, w, before)] and emu.memory.data[w] == before + 2, ("ERROR in the debugger, wrong watch hit")
+    debugger.remove_watchpoint(watch)
+    assert debugger.cont() == "halted" and final_state(emu) == expected, ("ERROR in the debugger, the run did not end like without debugger")
+    # a breakpoint on the pc fires before the first instruction, the next cont goes past it
+    emu = EmulatorV1(AssemblerV2(STATE_PROGRAM))
+    debugger = Debugger(emu)
+    entry :Breakpoint = debugger.add_breakpoint(0)
+    assert debugger.cont() == "breakpoint" and emu.regs[Register.AR] == 0 and entry.hits == 1, ("ERROR in the debugger, the breakpoint on the entry point did not stop")
+    every :Breakpoint = debugger.add_breakpoint("loop")
+    stops :int = 0
+    while debugger.cont() == "breakpoint":
+        assert emu.regs[Register.AR] == loop, ("ERROR in the debugger, stopped at the wrong place")
+        stops += 1
+    assert entry.hits == 1 and stops == every.hits > 1, ("ERROR in the debugger, a breakpoint did not stop at every pass")
+    assert final_state(emu) == expected, ("ERROR in the debugger, the run did not end like without debugger")
+
+COUNTER_PROGRAM :str = """
+counter: di 0
+
+JMP main
+
+main:
+MOV x1, 500
+
+loop:
+MOV x0, 1
+XADD [counter], x0
+SUB x1, 1
+JNZ loop
+HALT
+"""
+
+def MultiCoreUnitTests():
+    with tempfile.TemporaryDirectory() as folder:
+        path :str = os.path.join(folder, "counter.oai")
+        AssemblerV2(COUNTER_PROGRAM).save(path)
+        # the spawned cores only get the symbols of the image, its segments are shared
+        for options in ({"context": "spawn"}, {"deterministic": True}):
+            image :Image = load_image(path)
+            counter :int = image.symbol_map.get_symbol("counter")
+            with MultiCore(image, cores=3, **options) as machine:
+                states = machine.run(timeout=60)
+                assert all(state.status == CoreStatus.HALTED for state in states), (f"ERROR in MultiCore, a core did not halt {machine.errors}")
+                assert machine.data[counter] == 3 * 500, ("ERROR in MultiCore, the cores did not share the counter")
+
+def LinkerUnitTests():
+    modules :List[str] = [str(unit_tests_folder / "modules" / name) for name in ("main.s", "counter.s")]
+    with tempfile.TemporaryDirectory() as folder:
+        program, rebuilt = build(modules, os.path.join(folder, "objects"))
+        assert rebuilt == ["main", "counter"], ("ERROR in build, the modules were not assembled")
+        # the ASSERT of both modules check the shared symbols
+        emu :EmulatorV1 = run_program(program)
+        assert emu.memory.data[program.symbol_map.get_symbol("count")] == 10, ("ERROR in link, the modules do not share count")
+        assert build(modules, os.path.join(folder, "objects"))[1] == [], ("ERROR in build, unchanged modules were assembled again")
+        # an object of another assembler is stale even when its source did not change
+        version :str = Linker.ASSEMBLER_VERSION
+        try:
+            Linker.ASSEMBLER_VERSION = "stale"
+            assert assemble_object(modules[0], os.path.join(folder, "objects", "main.oai")), ("ERROR in build, an object of another assembler was reused")
+        finally:
+            Linker.ASSEMBLER_VERSION = version
+
+        def fails(sources :Dict[str, str], error :str):
+            paths :List[str] = []
+            for name, source in sources.items():
+                paths.append(os.path.join(folder, name + ".s"))
+                pathlib.Path(paths[-1]).write_text(source)
+            try:
+                build(paths, os.path.join(folder, "failing"))
+            except LinkError as e:
+                assert any(error in message for message in e.errors), (f"ERROR in build, expected {error} in {e.errors}")
+                return
+            assert False, (f"ERROR in build, no LinkError for {error}")
+
+        fails({"first": "global done\n\nJMP done\n\ndone:\nHALT\n", "second": "global done\n\ndone:\nHALT\n"}, "duplicate symbol done")
+        fails({"alone": "extern missing\n\nJMP missing\n"}, "undefined reference to missing")
+        # the assembler reports the missing operand and goes on, the module must still fail
+        fails({"broken": "JMP main\n\nmain:\nMOV x0,\nHALT\n"}, "broken failed to assemble")
+
+SPIN_PROGRAM :str = """
+JMP loop
+
+loop:
+ADD x0, 1
+JMP loop
+"""
+
+def HostUnitTests():
+    async def scenario():
+        host :Host = Host(quantum=100)
+        # a priority 2 session gets twice the turns of a priority 1 one, sessions of the same priority get the same
+        high :Session = host.add(EmulatorV1(AssemblerV2(SPIN_PROGRAM)), priority=2)
+        low :List[Session] = [host.add(EmulatorV1(AssemblerV2(SPIN_PROGRAM))) for i in range(2)]
+        runs = [asyncio.create_task(session.run()) for session in [high] + low]
+        while high.instructions < 20_000:
+            await asyncio.sleep(0)
+        assert abs(low[0].instructions - low[1].instructions) <= 100, ("ERROR in the host, same priority sessions got different turns")
+        assert abs(high.instructions - 2 * low[0].instructions) <= 200, ("ERROR in the host, the turns do not follow the priorities")
+        for session, run in zip([high] + low, runs):
+            executed :int = await session.halt()
+            assert run.done() and run.result() == executed == session.instructions, ("ERROR in the host, the halted run did not get its instructions")
+            assert not session.running, ("ERROR in the host, a halted session is still running")
+
+        # step runs exactly the asked instructions
+        session :Session = host.add(EmulatorV1(AssemblerV2(STATE_PROGRAM)))
+        assert await session.step(5) == 5 and await session.step() == 1 and await session.step(3) == 3, ("ERROR in the host, step ran a wrong count")
+        plain :EmulatorV1 = EmulatorV1(AssemblerV2(STATE_PROGRAM))
+        plain.run(9)
+        assert session.emu.regs.regs == plain.regs.regs, ("ERROR in the host, the stepped session is not where the plain run is")
+
+        # a cancelled run parks its session, the next run starts it again
+        spinning :Session = host.add(EmulatorV1(AssemblerV2(SPIN_PROGRAM)))
+        run = asyncio.create_task(spinning.run())
+        while spinning.instructions == 0:
+            await asyncio.sleep(0)
+        run.cancel()
+        try:
+            await run
+        except asyncio.CancelledError:
+            pass
+        parked :int = spinning.instructions
+        for i in range(10):
+            await asyncio.sleep(0)
+        assert spinning.instructions == parked and not spinning.running, ("ERROR in the host, a cancelled session is still scheduled")
+        assert await spinning.step(4) == 4 and spinning.instructions == parked + 4, ("ERROR in the host, a parked session does not run again")
+        await host.close()
+
+    asyncio.run(scenario())
+
+SUM_PROGRAM :str = """
+n: di 0
+
+JMP main
+
+main:
+MOV x0, 0
+MOV x1, [n]
+
+loop:
+CMP x1, 0
+JZ done
+ADD x0, x1
+SUB x1, 1
+JMP loop
+
+done:
+HALT
+"""
+
+def BatchEmulatorUnitTests():
+    if batch_engine.np is None:
+        print("numpy is not installed, the batch engine is not tested")
+        return
+    # every lane ends like the interpreter, a failed ASSERT fails the lane
+    for source in [path.read_text() for path in sorted(unit_tests_folder.glob("*.s"))] + [STATE_PROGRAM]:
+        batch :BatchEmulator = BatchEmulator(AssemblerV2(source), 4)
+        batch.cycle(100_000)
+        emu :EmulatorV1 = EmulatorV1(AssemblerV2(source))
+        try:
+            emu.run(100_000)
+            failed :bool = False
+        except AssertionError:
+            failed = True
+        assert batch.failed.tolist() == [failed] * 4, ("ERROR in the batch engine, the lanes did not fail like the interpreter")
+        for lane in range(4):
+            assert batch.regs[lane].tolist() == emu.regs.regs, ("ERROR in the batch engine, the registers differ from the interpreter")
+    # lanes that diverge, every one runs its own loop count
+    counts :List[int] = [0, 1, 5, 40]
+    batch = BatchEmulator(AssemblerV2(SUM_PROGRAM), len(counts))
+    batch.set_symbol("n", counts)
+    batch.cycle(100_000)
+    assert batch.halted.all() and not batch.failed.any(), ("ERROR in the batch engine, a lane did not halt")
+    for lane, count in enumerate(counts):
+        assm :AssemblerV2 = AssemblerV2(SUM_PROGRAM)
+        assm.memory.data[assm.symbol_map.get_symbol("n")] = count
+        emu = run_program(assm)
+        assert batch.regs[lane].tolist() == emu.regs.regs, (f"ERROR in the batch engine, lane {lane} differs from the interpreter")
+        assert batch.data[lane].tolist() == emu.memory.data[0:emu.memory.data.size].tolist(), (f"ERROR in the batch engine, the data of lane {lane} differs")
+
+def DecodeCacheUnitTests():
+    assm :AssemblerV2 = AssemblerV2("JMP main\n\nmain:\nMOV x0, 5\nMOV x1, 7\nHALT\n")
+    emu :EmulatorV1 = run_program(assm)
+    main :int = assm.symbol_map.get_symbol("main")
+    first = emu.decode_cache[main]
+    second :int = main + first.size
+    assert second in emu.decode_cache, ("ERROR in the decode cache, an executed instruction was not cached")
+    # rewriting an operand drops the instruction holding it and only that one
+    operand :int = main + emu.memory.code[main:second].tolist().index(5)
+    emu.memory.code[operand] = 9
+    assert main not in emu.decode_cache and second in emu.decode_cache, ("ERROR in the decode cache, the written instruction was not dropped")
+    # a slice over both instructions drops both
+    emu.decode(main)
+    emu.memory.code[operand:second + 1] = emu.memory.code[operand:second + 1].tolist()
+    assert main not in emu.decode_cache and second not in emu.decode_cache, ("ERROR in the decode cache, a written instruction was kept")
+    # the program runs the new code
+    emu.regs[Register.PC] = emu.regs[Register.AR] = 0
+    emu.is_halted = False
+    emu.run(100)
+    assert emu.regs[Register.x0] == 9 and emu.regs[Register.x1] == 7, ("ERROR in the decode cache, the old instruction ran")
+
+def SymbolMapUnitTests():
+    symbol_map :SymbolMap = SymbolMap(Memory())
+    symbol_map.add_symbol(Symbol.INTEGER, "a", 5)
+    symbol_map.add_symbol(Symbol.DOUBLE, "b", 6)
+    symbol_map.add_symbol(Symbol.LABEL, "start", 12)
+    # ids follow the declarations, labels keep their code location, data symbols get theirs from the allocator
+    assert [symbol_map.get_symbol_index(name) for name in ("a", "b", "start")] == [0, 1, 2], ("ERROR in SymbolMap, wrong ids")
+    assert symbol_map.get_symbol_name_from_index(1) == "b" and symbol_map.get_symbol("start") == 12, ("ERROR in SymbolMap, wrong lookup")
+    a :int = symbol_map.get_symbol("a")
+    assert symbol_map.mem.data[a] == 5 and symbol_map.get_entry("b").size == 2 and symbol_map.get_symbol_type("b") == Symbol.DOUBLE, ("ERROR in SymbolMap, wrong entry")
+    # a redeclared symbol keeps its id
+    symbol_map._declare(Symbol.LABEL, "a", 40, 0)
+    assert symbol_map.get_symbol_index("a") == 0 and symbol_map.get_symbol("a") == 40 and len(symbol_map.symbols) == 3, ("ERROR in SymbolMap, a redeclaration added a symbol")
+    for lookup, error in ((symbol_map.get_entry, IndexError), (symbol_map.get_symbol_index, ValueError)):
+        try:
+            lookup("missing")
+            assert False, ("ERROR in SymbolMap, an unknown name was found")
+        except error:
+            pass
+    # moved data blocks are followed, labels do not move
+    b :int = symbol_map.get_symbol("b")
+    symbol_map.relocate({b: b + 100, 12: 0})
+    assert symbol_map.get_symbol("b") == b + 100 and symbol_map.get_symbol("start") == 12, ("ERROR in SymbolMap, relocate moved the wrong symbols")
+
+    # every symbol operand has its relocation and holds the location of its symbol
+    assm :AssemblerV2 = AssemblerV2(STATE_PROGRAM)
+    code = assm.memory.code
+    names :Dict[str, Operand] = {assm.symbol_map.symbols[relocation.symbol].name: relocation.kind for relocation in assm.relocations.values()}
+    assert names == {"main": Operand.SYMBOL, "loop": Operand.SYMBOL, "big": Operand.SYMBOL, "done": Operand.SYMBOL,
+                     "v": Operand.VALUE, "w": Operand.VALUE, "text": Operand.VALUE}, ("ERROR in the relocations, wrong symbol operands")
+    for offset, relocation in assm.relocations.items():
+        assert assm.get_relocation(offset) is relocation and code[offset] == assm.symbol_map.symbols[relocation.symbol].location, ("ERROR in link, an operand does not hold its symbol location")
+    # linking again follows a moved symbol
+    w :int = assm.symbol_map.get_symbol("w")
+    assm.symbol_map.update_symbol("w", w + 50)
+    assm.link()
+    assert all(code[offset] == w + 50 for offset, relocation in assm.relocations.items() if assm.symbol_map.symbols[relocation.symbol].name == "w"), ("ERROR in link, the operands did not follow the symbol")
+
+def LexerUnitTests():
+    def kinds(line :str) -> List[Tuple]:
+        return [(token.kind, token.value) for token in lex_line(line)]
+    assert kinds("MOV x0, [count]") == [(TokenKind.MNEMONIC, MNEMONICS["MOV"]), (TokenKind.REGISTER, REGISTERS["x0"]), (TokenKind.VALUE, "count")], ("ERROR in lex_line, wrong kinds")
+    assert kinds("total: di 0x1F") == [(TokenKind.LABEL, "total"), (TokenKind.DIRECTIVE, Symbol.INTEGER), (TokenKind.INTEGER, 31)], ("ERROR in lex_line, wrong kinds")
+    # a mnemonic only starts a line, a directive only follows a label
+    assert kinds("JMP HALT di") == [(TokenKind.MNEMONIC, MNEMONICS["JMP"]), (TokenKind.NAME, "HALT"), (TokenKind.NAME, "di")], ("ERROR in lex_line, wrong kinds")
+
+    # line and columns of every token, the text of a string literal is one token
+    tokens :List = lex_line('MOV x1,  42', 7, 5)
+    assert [(token.line, token.col, token.end) for token in tokens] == [(7, 5, 8), (7, 9, 11), (7, 14, 16)], ("ERROR in lex_line, wrong spans")
+    tokens = lex_line('msg: dc "a, b;" x0', 3)
+    assert [(token.kind, token.text, token.col) for token in tokens] == [(TokenKind.LABEL, "msg:", 1), (TokenKind.DIRECTIVE, "dc", 6), (TokenKind.STRING, '"a, b;"', 9), (TokenKind.REGISTER, "x0", 17)], ("ERROR in lex_line, wrong string span")
+
+    # escapes of the literals, an unknown escape is the character itself
+    assert lex_line(r'"\t\x41\"\\\q"')[0].value == '\tA"\\q', ("ERROR in lex_line, wrong escapes")
+    assert AssemblerV2('text: dc "a\\tb\\x41\\n"\n\nHALT\n').symbol_map.get_string("text") == "a\tbA\n", ("ERROR in the assembler, wrong dc escapes")
+
+    # bad input : a literal without its closing quote has no value, a bad number is a name
+    tokens = lex_line('text: dc "open, x0', 2)
+    assert (tokens[-1].kind, tokens[-1].text, tokens[-1].value, tokens[-1].col) == (TokenKind.STRING, '"open, x0', None, 10), ("ERROR in lex_line, wrong unclosed string")
+    assert kinds("MOV x0, 0xZZ")[-1] == (TokenKind.NAME, "0xZZ"), ("ERROR in lex_line, a bad number is not a name")
+    assert not AssemblerV2('text: dc "open\n\nHALT\n').symbol_map.has_symbol("text"), ("ERROR in the assembler, an unclosed dc was declared")
+
+def unit_tests():
     print("=====================[ASSEMBLER UNIT TESTS]=========================")
     assm :AssemblerV2 = AssemblerV2("JMP start\n\n start:\n HALT\n")
     print(assm.memory.hexdump(assm.memory.code.memory, 16, 0, 10))
-    assert_memory(assm, Segment.CODE, 0, [2, 16, 1])
+    assert_memory(assm, Segment.CODE, 0, [2, 16, 3, 1])
+    LexerUnitTests()
+    DecodeCacheUnitTests()
+    SymbolMapUnitTests()
+    UnitTestMemory()
+    MemoryV2UnitTests()
+    DbgUnitTests()
+    StreamingUnitTests()
+    ImageUnitTests()
+    BlockCacheUnitTests()
+    TranslatorUnitTests()
+    OptimizerUnitTests()
+    ProfilerUnitTests()
+    SnapshotUnitTests()
+    DebuggerUnitTests()
+    MultiCoreUnitTests()
+    LinkerUnitTests()
+    HostUnitTests()
+    BatchEmulatorUnitTests()
     print("=====================| END ASSEMBLER TEST |=========================")
-    cwd = os.getcwd()
-    real = cwd + unit_tests_folder
-    results : Dict[int, int] = {}
-    for i, file in enumerate(os.listdir(real)):
-        print(f"==========================[RUNNING UNIT TEST #{i} ({file})]==========================")
-        try:
-            assembler :AssemblerV2 = AssemblerV2(f"{real}\\{file}")
-            emu :EmulatorV1 = EmulatorV1(assembler)
-            emu.cycle()
-            results[i] = 1
-        except Exception as e:
-            if isinstance(e, AssertionError):
-                print("An assert failed")
-                idk :AssertionError = e
-                print(idk)
-            else:
-                print("An error occured ", e.with_traceback)
-            results[i] = 0
-    
-    for result in results:
-        print(f"TEST #{result} HAS {"FAILED" if results[result] == 0 else "SUCCEEDED"}")
-    
-    
\ No newline at end of file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='OpenArchitecture Unit Tests', description="Run every test program of a folder in parallel")
+    parser.add_argument('folder', nargs='?', default=str(unit_tests_folder), help="folder containing the .s test programs")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes, defaults to the number of cores")
+    parser.add_argument('--max-instructions', type=int, default=1_000_000, help="instruction budget of each test")
+    parser.add_argument('--timeout', type=float, default=10.0, help="wall clock budget of each test in seconds")
+    parser.add_argument('--no-cache', action='store_true', help="always assemble the programs again")
+    parser.add_argument('--json', help="write the results to this json file")
+    parser.add_argument('--junit', help="write the results to this JUnit xml file")
+    args = parser.parse_args(sys.argv[1:])
+
+    unit_tests()
+    files :List[pathlib.Path] = sorted(pathlib.Path(args.folder).glob("*.s"))
+    results :List[Dict] = run_tests(files, args.jobs, args.max_instructions, args.timeout, None if args.no_cache else cache_folder)
+
+    for i, result in enumerate(results):
+        status :str = "SUCCEEDED" if result["status"] == "passed" else result["status"].upper()
+        print(f"TEST #{i} ({result['name']}) HAS {status} {result['message']}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"results": results, "passed": sum(r["status"] == "passed" for r in results), "total": len(results)}, file, indent=2)
+    if args.junit:
+        write_junit(results, args.junit)
+    sys.exit(0 if all(r["status"] == "passed" for r in results) else 1)
@@ -0,0 +1,8 @@
+"""Benchmarks of the assembler, the allocator, the symbol map and the emulator
+
+Run them from the src folder :
+
+    python -m benchmarks run --save baseline.json
+    python -m benchmarks compare baseline.json --threshold 0.1
+"""
+from benchmarks.suite import BENCHMARKS, Result, run_benchmarks, compare, load_results, save_results
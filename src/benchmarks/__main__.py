@@ -0,0 +1,39 @@
+import Dbg
+Dbg.set_debug(False)
+from benchmarks.suite import BENCHMARKS, run_benchmarks, compare, load_results, save_results
+import argparse, sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="OpenArchitecture benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run the benchmarks and print their throughput")
+    run.add_argument('names', nargs='*', help="benchmarks to run (or prefixes like emulator), everything by default")
+    run.add_argument('--repeat', type=int, default=3, help="repetitions of each benchmark, the best one is kept")
+    run.add_argument('--save', help="write the results to this json file, to be used as a baseline")
+    check = commands.add_parser("compare", help="run the benchmarks again and compare them with a baseline")
+    check.add_argument('baseline', help="json file written by run --save")
+    check.add_argument('names', nargs='*', help="benchmarks to run, everything by default")
+    check.add_argument('--current', help="compare this json file instead of running the benchmarks")
+    check.add_argument('--threshold', type=float, default=0.1, help="allowed slowdown, 0.1 means 10%%")
+    check.add_argument('--repeat', type=int, default=3, help="repetitions of each benchmark, the best one is kept")
+    commands.add_parser("list", help="list the benchmarks")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.command == "list":
+        for name, (benchmark, unit) in BENCHMARKS.items():
+            print(f"{name:<30} {unit}")
+        sys.exit(0)
+
+    if args.command == "run":
+        results = run_benchmarks(args.names, args.repeat)
+        for result in results:
+            print(f"{result.name:<30} {result.value:>16,.0f} {result.unit}")
+        if args.save:
+            save_results(results, args.save)
+        sys.exit(0)
+
+    current = load_results(args.current) if args.current else run_benchmarks(args.names, args.repeat)
+    rows = compare(load_results(args.baseline), current, args.threshold)
+    for name, before, after, ratio, regressed in rows:
+        print(f"{name:<30} {before:>16,.0f} {after:>16,.0f} {ratio:>7.2f}x {'REGRESSION' if regressed else ''}")
+    sys.exit(1 if any(row[4] for row in rows) else 0)
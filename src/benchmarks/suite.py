@@ -0,0 +1,190 @@
+from typing import List, Dict, Callable, Tuple
+from AssemblerV2 import AssemblerV2
+from Emulator import EmulatorV1
+from CPU import Register
+from Memory import Memory, Segment
+from SymbolMap import SymbolMap
+import Linker
+from benchmarks import workloads
+import time, json, platform, random, tempfile, os, shutil, atexit
+
+# instructions executed by the endless emulator workloads
+BUDGET :int = 200_000
+
+class Result:
+    """Throughput of a benchmark, value is always "more is better"
+    """
+    __slots__ = ("name", "value", "unit", "time")
+
+    def __init__(self, name :str, value :float, unit :str, time :float) -> None:
+        self.name = name
+        self.value = value
+        self.unit = unit
+        # best wall clock time of one repetition
+        self.time = time
+
+    def to_dict(self) -> Dict:
+        return {"name": self.name, "value": self.value, "unit": self.unit, "time": self.time}
+
+# A benchmark prepares its workload and returns the function to time, that function returns the amount of work it did
+Benchmark = Callable[[], Callable[[], int]]
+
+def _emulate(source :str, translate :bool = False, optimize :bool = False, profile :bool = False, paged :bool = False) -> Benchmark:
+    def prepare():
+        assembler :AssemblerV2 = AssemblerV2(source, optimize=optimize, paged=paged)
+        def work():
+            # a fresh emulator on the same code, the translator cache is part of the measure
+            emu :EmulatorV1 = EmulatorV1(assembler, translate=translate, profile=profile)
+            emu.run(BUDGET)
+            # loop iterations, the optimizer changes the number of instructions of an iteration
+            return emu.regs[Register.x0]
+        return work
+    return prepare
+
+def _snapshots(source :str, every :int = 100) -> Benchmark:
+    def prepare():
+        assembler :AssemblerV2 = AssemblerV2(source)
+        def work():
+            emu :EmulatorV1 = EmulatorV1(assembler)
+            snapshots = []
+            for i in range(BUDGET // every):
+                snapshots.append(emu.snapshot())
+                emu.run(every)
+            # rewind one snapshot at a time, like reverse stepping
+            for snapshot in reversed(snapshots):
+                emu.restore(snapshot)
+            return len(snapshots)
+        return work
+    return prepare
+
+def _assemble(source :str) -> Benchmark:
+    def prepare():
+        lines :int = source.count("\n")
+        def work():
+            AssemblerV2(source)
+            return lines
+        return work
+    return prepare
+
+def _build(sources :List[str], rebuild :bool = False) -> Benchmark:
+    def prepare():
+        folder :str = tempfile.mkdtemp(prefix="oa-build-")
+        atexit.register(shutil.rmtree, folder, True)
+        paths :List[str] = []
+        for i, source in enumerate(sources):
+            paths.append(os.path.join(folder, f"m{i}.s"))
+            with open(paths[-1], "w") as file:
+                file.write(source)
+        lines :int = sum(source.count("\n") for source in sources)
+        builds :List[int] = [0]
+        if rebuild:
+            Linker.build(paths, os.path.join(folder, "objects"))
+        def work():
+            # a fresh object folder builds everything, the same one only links
+            builds[0] += 1
+            objects :str = os.path.join(folder, "objects" if rebuild else f"objects{builds[0]}")
+            Linker.build(paths, objects)
+            return lines
+        return work
+    return prepare
+
+def _alloc() -> Benchmark:
+    def prepare():
+        sizes :List[int] = [random.Random(i).randint(1, 12) for i in range(4000)]
+        def work():
+            memory :Memory = Memory(data_size=65536)
+            locations :List[int] = [memory._alloc(Segment.DATA, size) for size in sizes]
+            # punch holes then fill them again, first fit has to walk the free blocks
+            for location in locations[::2]:
+                memory._free(Segment.DATA, location)
+            for size in sizes[::2]:
+                memory._alloc(Segment.DATA, size)
+            return len(sizes) * 2
+        return work
+    return prepare
+
+def _lookup() -> Benchmark:
+    def prepare():
+        assembler :AssemblerV2 = AssemblerV2(workloads.symbol_program())
+        symbol_map :SymbolMap = assembler.symbol_map
+        names :List[str] = [entry.name for entry in symbol_map.symbols]
+        def work():
+            for name in names:
+                symbol_map.has_symbol(name)
+                symbol_map.get_symbol_type(name)
+                symbol_map.get_symbol(name)
+                symbol_map.get_symbol_name_from_index(symbol_map.get_symbol_index(name))
+            return len(names) * 5
+        return work
+    return prepare
+
+# name -> (benchmark, unit)
+BENCHMARKS :Dict[str, Tuple[Benchmark, str]] = {
+    "emulator.loop": (_emulate(workloads.loop_program()), "iterations/s"),
+    "emulator.call": (_emulate(workloads.call_program()), "iterations/s"),
+    "emulator.stack": (_emulate(workloads.stack_program()), "iterations/s"),
+    "emulator.stack.paged": (_emulate(workloads.stack_program(), paged=True), "iterations/s"),
+    "emulator.loop.translated": (_emulate(workloads.loop_program(), translate=True), "iterations/s"),
+    "emulator.countdown": (_emulate(workloads.countdown_program()), "iterations/s"),
+    "emulator.countdown.translated": (_emulate(workloads.countdown_program(), translate=True), "iterations/s"),
+    "emulator.stack.translated": (_emulate(workloads.stack_program(), translate=True), "iterations/s"),
+    "emulator.loop.profiled": (_emulate(workloads.loop_program(), profile=True), "iterations/s"),
+    "emulator.call.profiled": (_emulate(workloads.call_program(), profile=True), "iterations/s"),
+    "emulator.arith": (_emulate(workloads.arith_program()), "iterations/s"),
+    "emulator.arith.optimized": (_emulate(workloads.arith_program(), optimize=True), "iterations/s"),
+    "emulator.arith.optimized.translated": (_emulate(workloads.arith_program(), translate=True, optimize=True), "iterations/s"),
+    "emulator.snapshots": (_snapshots(workloads.stack_program()), "snapshots/s"),
+    "assembler.data": (_assemble(workloads.data_program()), "lines/s"),
+    "assembler.symbols": (_assemble(workloads.symbol_program()), "lines/s"),
+    "assembler.strings": (_assemble(workloads.text_program()), "lines/s"),
+    "linker.build": (_build(workloads.module_programs()), "lines/s"),
+    "linker.rebuild": (_build(workloads.module_programs(), rebuild=True), "lines/s"),
+    "memory.alloc": (_alloc(), "operations/s"),
+    "symbols.lookup": (_lookup(), "lookups/s"),
+}
+
+def run_benchmarks(names :List[str] | None = None, repeat :int = 3) -> List[Result]:
+    """Run the benchmarks, each one is timed repeat times and the best time is kept
+
+    Args:
+        names (List[str], optional): names (or name prefixes like "emulator") to run, everything by default
+        repeat (int, optional): number of repetitions
+    """
+    results :List[Result] = []
+    for name, (benchmark, unit) in BENCHMARKS.items():
+        if names and not any(name == wanted or name.startswith(wanted + ".") for wanted in names):
+            continue
+        work = benchmark()
+        best :float = float("inf")
+        for i in range(repeat):
+            start :float = time.perf_counter()
+            amount :int = work()
+            best = min(best, time.perf_counter() - start)
+        results.append(Result(name, amount / best, unit, best))
+    return results
+
+def save_results(results :List[Result], path :str):
+    with open(path, "w") as file:
+        json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                   "results": [result.to_dict() for result in results]}, file, indent=2)
+
+def load_results(path :str) -> List[Result]:
+    with open(path, "r") as file:
+        return [Result(r["name"], r["value"], r["unit"], r["time"]) for r in json.load(file)["results"]]
+
+def compare(baseline :List[Result], current :List[Result], threshold :float) -> List[Tuple[str, float, float, float, bool]]:
+    """Compare two runs
+
+    Args:
+        threshold (float): allowed slowdown, 0.1 flags anything more than 10% slower than the baseline
+    Returns:
+        (name, baseline value, current value, ratio, is regression) for every benchmark of both runs
+    """
+    reference :Dict[str, Result] = {result.name: result for result in baseline}
+    rows = []
+    for result in current:
+        if result.name not in reference:
+            continue
+        ratio :float = result.value / reference[result.name].value
+        rows.append((result.name, reference[result.name].value, result.value, ratio, ratio < 1 - threshold))
+    return rows
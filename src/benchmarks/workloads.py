@@ -0,0 +1,85 @@
+from typing import List
+
+# Source generators, every workload isolates one hot path. The programs fit the default Memory sizes
+# (256 words of stack, 1024 of data, 4096 of code). The endless programs add 1 to x0 once per iteration,
+# so runs of the same workload with different engines or optimizations can be compared.
+
+def loop_program(body :int = 8) -> str:
+    """An endless loop of register arithmetic, run with a budget
+    """
+    lines :List[str] = ["ADD x0, 1"]
+    for i in range(body):
+        lines.append(f"ADD x{i % 2 + 1}, {i + 1}" if i % 2 == 0 else f"SUB x{i % 2 + 1}, x{(i + 1) % 2 + 1}")
+    return "JMP loop\n\nloop:\n" + "\n".join(lines) + "\nJMP loop\n"
+
+def call_program(depth :int = 16) -> str:
+    """An endless chain of calls, every function drops its return address and calls the next one
+    """
+    blocks :List[str] = ["JMP start"]
+    for i in range(depth):
+        blocks.append(f"f{i}:\nPOP x2\nADD x0, 1\nCALL f{(i + 1) % depth}")
+    blocks.append("start:\nCALL f0")
+    return "\n\n".join(blocks) + "\n"
+
+def stack_program(pushes :int = 32) -> str:
+    """An endless loop pushing registers, immediates and data then popping everything back
+    """
+    lines :List[str] = ["ADD x0, 1"]
+    for i in range(pushes):
+        lines.append(("PUSH x0", "PUSH 7", "PUSH [v]")[i % 3])
+    for i in range(pushes):
+        lines.append(f"POP x{i % 2 + 1}")
+    return "v: di 3\n\nJMP loop\n\nloop:\n" + "\n".join(lines) + "\nJMP loop\n"
+
+def arith_program(repeat :int = 8) -> str:
+    """An endless loop written like naive generated code, the peephole optimizer can shrink it
+    """
+    lines :List[str] = ["ADD x0, 1"]
+    for i in range(repeat):
+        lines += ["MOV x1, x0", "ADD x1, [v]", "ADD x2, 1", "ADD x2, 2", "PUSH x1", "POP x2", "MOV x1, 0", "ADD x1, 4"]
+    return "v: di 3\n\nJMP loop\n\nloop:\n" + "\n".join(lines) + "\nJMP loop\n"
+
+def countdown_program(count :int = 100) -> str:
+    """An endless loop around a countdown closed by a conditional jump, the CMP result is replaced by the SUB one
+    """
+    return (f"JMP outer\n\nouter:\nMOV x1, {count}\n\ninner:\nADD x0, 1\nADD x2, x1\nCMP x2, 0\n"
+            f"SUB x1, 1\nJNZ inner\nJMP outer\n")
+
+def data_program(symbols :int = 500) -> str:
+    """Many data symbols, and one instruction reading each of them
+    """
+    declarations :str = "\n".join(f"s{i}: {('db', 'ds', 'di')[i % 3]} {i}" for i in range(symbols))
+    code :str = "\n".join(f"MOV x{i % 3}, [s{i}]" for i in range(symbols))
+    return f"{declarations}\n\nJMP start\n\nstart:\n{code}\nHALT\n"
+
+def text_program(strings :int = 500, distinct :int = 50) -> str:
+    """Many dc strings, most of them repeating a few literals, and one instruction reading each of them
+    """
+    declarations :str = "\n".join(f's{i}: dc "message number {i % distinct}, with some text around it"' for i in range(strings))
+    code :str = "\n".join(f"MOV x{i % 3}, [s{i}]" for i in range(strings))
+    return f"{declarations}\n\nJMP start\n\nstart:\n{code}\nHALT\n"
+
+def symbol_program(labels :int = 200, uses :int = 4) -> str:
+    """Many small labels referencing each other and the data, stresses the symbol lookups
+    """
+    blocks :List[str] = ["\n".join(f"d{i}: di {i}" for i in range(labels)), "JMP l0"]
+    for i in range(labels):
+        lines :List[str] = [f"ADD x0, [d{(i * 7 + k) % labels}]" for k in range(uses - 1)]
+        lines.append(f"JMP l{(i + 1) % labels}")
+        blocks.append(f"l{i}:\n" + "\n".join(lines))
+    return "\n\n".join(blocks) + "\n"
+
+def module_programs(modules :int = 8, labels :int = 50) -> List[str]:
+    """Modules calling into each other in a ring, each one with its own data and labels, the first one is the entry
+    """
+    sources :List[str] = []
+    for m in range(modules):
+        following :int = (m + 1) % modules
+        blocks :List[str] = [f"extern m{following}_l0\nglobal m{m}_l0", "\n".join(f"d{i}: di {i}" for i in range(labels))]
+        if m == 0:
+            blocks.append("JMP m0_l0")
+        for i in range(labels):
+            target :str = f"m{m}_l{i + 1}" if i + 1 < labels else f"m{following}_l0"
+            blocks.append(f"m{m}_l{i}:\nADD x0, [d{i}]\nADD x1, [d{(i * 7) % labels}]\nJMP {target}")
+        sources.append("\n\n".join(blocks) + "\n")
+    return sources
@@ -0,0 +1,34 @@
+counter: di 0
+
+JMP main
+
+main:
+MOV x0, 5
+XADD [counter], x0
+ASSERT x0, 0
+MOV x0, 2
+XADD [counter], x0
+ASSERT x0, 5
+MOV x1, [counter]
+ASSERT x1, 7
+MOV x0, 9
+XCHG [counter], x0
+ASSERT x0, 7
+MOV x1, [counter]
+ASSERT x1, 9
+CMPXCHG [counter], x0, 11
+JZ wrong
+ASSERT x0, 9
+MOV x1, [counter]
+ASSERT x1, 9
+CMPXCHG [counter], x0, 11
+JNZ wrong
+MOV x1, [counter]
+ASSERT x1, 11
+FENCE
+MOV x2, CID
+ASSERT x2, 0
+HALT
+
+wrong:
+ASSERT x0, 12345
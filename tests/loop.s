@@ -0,0 +1,55 @@
+JMP main
+
+main:
+MOV x0, 0
+MOV x1, 10
+
+loop:
+ADD x0, 3
+SUB x1, 1
+JNZ loop
+ASSERT x0, 30
+ASSERT x1, 0
+CMP x0, 30
+JE equal
+ASSERT x0, 0
+
+equal:
+CMP x0, 31
+JNE different
+ASSERT x0, 0
+
+different:
+MOV x2, 0
+SUB x2, 1
+JS negative
+ASSERT x2, 0
+
+negative:
+CMP x2, 0
+JNS wrong
+ADD x2, 4
+JS wrong
+ASSERT x2, 3
+CMP x2, 0
+JNP wrong
+JP parity
+ASSERT x2, 0
+
+parity:
+CMP x2, 2
+JP wrong
+JZ wrong
+MOV x1, 5
+MOV x0, 0
+
+countdown:
+ADD x0, x1
+CMP x1, 1
+SUB x1, 1
+JNZ countdown
+ASSERT x0, 15
+HALT
+
+wrong:
+ASSERT x0, 12345
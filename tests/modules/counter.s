@@ -0,0 +1,13 @@
+extern done
+global count, bump
+
+count: di 7
+total: di 2
+
+bump:
+MOV x0, 3
+XADD [count], x0
+ASSERT x0, 7
+MOV x1, [total]
+ASSERT x1, 2
+JMP done
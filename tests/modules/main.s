@@ -0,0 +1,19 @@
+extern count di
+extern bump
+global done
+
+total: di 1
+
+JMP main
+
+main:
+MOV x0, [count]
+ASSERT x0, 7
+JMP bump
+
+done:
+MOV x0, [count]
+ASSERT x0, 10
+MOV x1, [total]
+ASSERT x1, 1
+HALT
@@ -0,0 +1,18 @@
+greeting: dc "hello, world ; not a comment"
+same: dc "hello, world ; not a comment"
+empty: dc ""
+quoted: dc "a \"b\"\n"
+
+JMP main
+
+main:
+MOV x0, [greeting]
+ASSERT x0, 28
+MOV x0, greeting
+MOV x1, same
+ASSERT x0, x1
+MOV x0, [empty]
+ASSERT x0, 0
+MOV x0, [quoted]
+ASSERT x0, 6
+HALT